@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+""" Synthetic binlog events for the offline benchmarks
+
+The events are real :py:class:`pymysqlreplication.row_event.RowsEvent`
+subclasses whose rows are injected instead of being decoded from a packet, so
+they take exactly the same path through :py:mod:`mysqlbinlog2blinker` as the
+events yielded by a :py:class:`pymysqlreplication.BinLogStreamReader`.
+"""
+import datetime
+import decimal
+import itertools
+import time
+
+from pymysqlreplication import row_event
+
+__author__ = 'tarzan'
+
+ACTIONS = {
+    'insert': row_event.WriteRowsEvent,
+    'update': row_event.UpdateRowsEvent,
+    'delete': row_event.DeleteRowsEvent,
+}
+
+
+def make_columns(width):
+    """ Make column names for a table which has *width* columns
+
+    The first column is always the primary key ``id``.
+    """
+    return ['id'] + ['c%d' % i for i in range(1, width)]
+
+
+def _column_value(col_idx, row_id, version=0):
+    """ Make a deterministic value, cycling through common MySQL types """
+    kind = col_idx % 6
+    if kind == 0:
+        return row_id * 31 + col_idx + version
+    if kind == 1:
+        return u'value-%d-%d-%d' % (row_id, col_idx, version)
+    if kind == 2:
+        return decimal.Decimal('%d.%02d' % (row_id + version, col_idx % 100))
+    if kind == 3:
+        return datetime.datetime(2016, 1, 1) + \
+            datetime.timedelta(seconds=row_id + version)
+    if kind == 4:
+        return None if row_id % 7 == 0 else float(row_id) / (col_idx + 1)
+    return (row_id + col_idx) % 2 == 0
+
+
+def make_values(columns, row_id, version=0):
+    values = {'id': row_id}
+    for idx, col in enumerate(columns[1:], 1):
+        values[col] = _column_value(idx, row_id, version)
+    return values
+
+
+def make_rows(action, columns, first_id, count, changed_columns=2):
+    """ Make rows as :py:attr:`RowsEvent.rows` returns them
+
+    Args:
+        action (str): insert, update or delete
+        columns (list[str]): table's column names
+        first_id (int): id of the first row
+        count (int): number of rows
+        changed_columns (int): number of columns updated by an update row
+    """
+    rows = []
+    changed = columns[1:1 + changed_columns]
+    for row_id in range(first_id, first_id + count):
+        values = make_values(columns, row_id)
+        if action == 'update':
+            after_values = dict(values)
+            for col in changed:
+                after_values[col] = _column_value(columns.index(col),
+                                                  row_id, version=1)
+            rows.append({'before_values': values,
+                         'after_values': after_values})
+        else:
+            rows.append({'values': values})
+    return rows
+
+
+def make_event(action, schema, table, rows, timestamp=1451606400):
+    """ Make a RowsEvent of *action* carrying *rows* without any packet """
+    cls = ACTIONS[action]
+    event = cls.__new__(cls)
+    event.schema = schema
+    event.table = table
+    event.primary_key = 'id'
+    event.timestamp = timestamp
+    event._RowsEvent__rows = rows
+    return event
+
+
+class SyntheticStream(object):
+    """ Iterable that replays prebuilt events like a BinLogStreamReader
+
+    ``log_file`` and ``log_pos`` move forward for every yielded event,
+    *read_latency* seconds are slept before each event to mimic the network.
+    """
+    def __init__(self, events, log_file='mysql-bin.000001', event_size=None,
+                 read_latency=0.0):
+        self.events = events
+        self.read_latency = read_latency
+        self.log_file = log_file
+        self.log_pos = 4
+        self.event_size = event_size
+        self.table_map = {}
+
+    def __iter__(self):
+        for event in self.events:
+            if self.read_latency:
+                time.sleep(self.read_latency)
+            self.log_pos += self.event_size or 19 + 64 * len(event.rows)
+            yield event
+
+
+def make_events(action, width, rows_per_event, total_rows,
+                schema='bench', table=None):
+    """ Make the events of one benchmark scenario
+
+    Args:
+        action (str): insert, update or delete
+        width (int): number of table columns
+        rows_per_event (int): number of rows in each event
+        total_rows (int): number of rows over all events
+    """
+    columns = make_columns(width)
+    table = table or 'tbl_%d' % width
+    events = []
+    ids = itertools.count(1, rows_per_event)
+    for _ in range(max(1, total_rows // rows_per_event)):
+        rows = make_rows(action, columns, next(ids), rows_per_event)
+        events.append(make_event(action, schema, table, rows))
+    return events
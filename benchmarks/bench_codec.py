@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+""" Benchmark encoding converted rows for other processes
+
+Bytes per row, encode and decode time per row of
+:py:mod:`mysqlbinlog2blinker.codec` against json (values it does not know
+as strings), pickle of the row dicts and pickle of the compact form made by
+:py:func:`pack_rows`, which worker processes were sent before the codec, on
+tables of 5 and 50 columns.
+
+Usage::
+
+    python benchmarks/bench_codec.py --save codec.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mysqlbinlog2blinker import _subscribers, codec  # noqa: E402
+import _synthetic  # noqa: E402
+
+__author__ = 'tarzan'
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _converted_rows(params):
+    events = _synthetic.make_events(**params)
+    stream = _synthetic.SyntheticStream(events)
+    changes = []
+    for event in events:
+        rows, meta = _subscribers._rows_event_to_dict(event, stream)
+        changes.append(('%s.%s' % (event.schema, event.table),
+                        [dict(row) for row in rows], meta))
+    return changes
+
+
+def pack_rows(rows):
+    """ Pack converted rows into a compact, pickle friendly form, the
+    baseline of :py:mod:`codec <mysqlbinlog2blinker.codec>`
+
+    Returns:
+        tuple: (names, pk_names, values, updated_values) where values is a
+            list of tuples and updated_values a list of dicts, or None when
+            rows have no *updated_values*
+    """
+    if not rows:
+        return (), (), [], None
+    first = rows[0]
+    names = tuple(first['values'])
+    pk_names = tuple(first['keys'])
+    values = [tuple([row['values'][name] for name in names]) for row in rows]
+    updated_values = None
+    if 'updated_values' in first:
+        updated_values = [dict(row['updated_values']) for row in rows]
+    return names, pk_names, values, updated_values
+
+
+def unpack_rows(names, pk_names, values, updated_values):
+    """ Rebuild the row dicts packed by :py:func:`pack_rows` """
+    rows = []
+    for i, row_values in enumerate(values):
+        row_values = dict(zip(names, row_values))
+        row = {
+            'values': row_values,
+            'keys': dict((name, row_values[name]) for name in pk_names),
+        }
+        if updated_values is not None:
+            row['updated_values'] = updated_values[i]
+        rows.append(row)
+    return rows
+
+
+def _json_codec():
+    return (lambda table_name, rows, meta: json.dumps(
+                [table_name, rows, meta], default=str).encode('utf-8'),
+            lambda data: json.loads(data.decode('utf-8')))
+
+
+def _pickle_codec():
+    return (lambda table_name, rows, meta: pickle.dumps(
+                (table_name, rows, meta), pickle.HIGHEST_PROTOCOL),
+            pickle.loads)
+
+
+def _compact_codec():
+    def decode(data):
+        table_name, packed, meta = pickle.loads(data)
+        return table_name, unpack_rows(*packed), meta
+    return (lambda table_name, rows, meta: pickle.dumps(
+                (table_name, pack_rows(rows), meta),
+                pickle.HIGHEST_PROTOCOL),
+            decode)
+
+
+def _binary_codec():
+    return codec.Encoder().encode, codec.Decoder().decode
+
+
+CODECS = (('json', _json_codec), ('pickle', _pickle_codec),
+          ('compact', _compact_codec), ('codec', _binary_codec))
+
+
+def bench_codec(changes, make_codec):
+    rows_count = sum(len(rows) for _, rows, _ in changes)
+    encode, decode = make_codec()
+    gc.collect()
+    started = _timer()
+    encoded = [encode(*change) for change in changes]
+    encode_seconds = _timer() - started
+    started = _timer()
+    for data in encoded:
+        decode(data)
+    decode_seconds = _timer() - started
+    size = sum(len(data) for data in encoded)
+    return {'bytes_per_row': float(size) / rows_count,
+            'encode_us_per_row': encode_seconds * 1e6 / rows_count,
+            'decode_us_per_row': decode_seconds * 1e6 / rows_count}
+
+
+def run(total_rows=20000, out=sys.stdout):
+    results = {}
+    for action in ('insert', 'update'):
+        for width in (5, 50):
+            name = '%s-w%d' % (action, width)
+            changes = _converted_rows(dict(
+                action=action, width=width, rows_per_event=10,
+                total_rows=total_rows))
+            res = results[name] = {}
+            for codec_name, make_codec in CODECS:
+                r = res[codec_name] = bench_codec(changes, make_codec)
+                print('%-10s %-8s %8.0f B/row %7.2f us/row encode '
+                      '%7.2f us/row decode' % (
+                          name, codec_name, r['bytes_per_row'],
+                          r['encode_us_per_row'], r['decode_us_per_row']),
+                      file=out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--total-rows', type=int, default=20000)
+    parser.add_argument('--save', help='save results as JSON to this file')
+    args = parser.parse_args(argv)
+    results = run(total_rows=args.total_rows)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
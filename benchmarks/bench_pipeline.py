@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+""" Offline benchmark of the publish/convert/dispatch pipeline
+
+Synthetic RowsEvents are published through the same code path as
+:py:func:`mysqlbinlog2blinker.start_publishing`, so no MySQL server is needed.
+
+Every scenario is run in 3 passes over freshly built events:
+
+1. throughput: events/sec and rows/sec, without any instrumentation
+2. stages: inclusive time spent in ``_rows_event_to_dict``,
+   ``_get_updated_values`` and blinker's ``send`` of the rows signals
+3. memory: peak memory (tracemalloc) allocated while publishing, the
+   synthetic events themselves are built before tracing starts
+
+Usage::
+
+    python benchmarks/bench_pipeline.py --save results.json
+    python benchmarks/bench_pipeline.py --compare results.json
+    python benchmarks/bench_pipeline.py --scenario 'update-w200-*'
+    python benchmarks/bench_pipeline.py --read-latency 0.0002 --pipeline 1000
+"""
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import functools
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mysqlbinlog2blinker  # noqa: E402
+from mysqlbinlog2blinker import (  # noqa: E402
+    _subscribers,
+    metadata,
+    pipeline,
+    signals,
+)
+import _synthetic  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+__author__ = 'tarzan'
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+ACTIONS = ('insert', 'update', 'delete')
+WIDTHS = (5, 200)
+ROWS_PER_EVENT = (1, 100, 10000)
+
+
+def _scenarios(total_rows):
+    for action in ACTIONS:
+        for width in WIDTHS:
+            for rows_per_event in ROWS_PER_EVENT:
+                name = '%s-w%d-r%d' % (action, width, rows_per_event)
+                yield name, dict(action=action,
+                                 width=width,
+                                 rows_per_event=rows_per_event,
+                                 total_rows=max(total_rows, rows_per_event))
+
+
+class _RowsSink(object):
+    """ Receiver of the rows signals, it only counts the delivered rows """
+    def __init__(self):
+        self.rows = 0
+
+    def __call__(self, table_name, rows, meta):
+        self.rows += len(rows)
+
+    def __enter__(self):
+        for sig in (signals.rows_inserted,
+                    signals.rows_updated,
+                    signals.rows_deleted):
+            sig.connect(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for sig in (signals.rows_inserted,
+                    signals.rows_updated,
+                    signals.rows_deleted):
+            sig.disconnect(self)
+
+
+class _StageTimer(object):
+    """ Wrap pipeline functions to accumulate the time spent in them """
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self._restore = []
+
+    def _wrap(self, name, func):
+        seconds, calls = self.seconds, self.calls
+        seconds[name], calls[name] = 0.0, 0
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            started = _timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds[name] += _timer() - started
+                calls[name] += 1
+        return timed
+
+    def patch(self, owner, attr, name):
+        func = getattr(owner, attr)
+        self._restore.append((owner, attr, owner.__dict__.get(attr)))
+        setattr(owner, attr, self._wrap(name, func))
+
+    def __enter__(self):
+        self.patch(_subscribers, '_rows_event_to_dict', '_rows_event_to_dict')
+        self.patch(_subscribers, '_get_updated_values', '_get_updated_values')
+        for sig in (signals.rows_inserted,
+                    signals.rows_updated,
+                    signals.rows_deleted):
+            self.patch(sig, 'send', 'send')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        while self._restore:
+            owner, attr, orig = self._restore.pop()
+            if orig is None:
+                delattr(owner, attr)
+            else:
+                setattr(owner, attr, orig)
+
+
+def _build(params, read_latency=0.0):
+    """ Build a stream of fresh events for *params* """
+    stream = _synthetic.SyntheticStream(_synthetic.make_events(**params),
+                                        read_latency=read_latency)
+    gc.collect()
+    return stream
+
+
+def _publish(stream, pipeline_queue_size=None):
+    """ Publish all events of *stream*, return elapsed seconds """
+    started = _timer()
+    mysqlbinlog2blinker._publish(
+        stream, pipeline=pipeline.Pipeline(pipeline_queue_size)
+        if pipeline_queue_size else None)
+    return _timer() - started
+
+
+def run_scenario(params, repeat=3, pipeline_queue_size=None,
+                 read_latency=0.0):
+    """ Run one scenario, return its result as a dict """
+    result = {'params': params}
+
+    with _RowsSink() as sink:
+        best = None
+        for _ in range(repeat):
+            stream = _build(params, read_latency)
+            events = len(stream.events)
+            elapsed = _publish(stream, pipeline_queue_size)
+            best = elapsed if best is None else min(best, elapsed)
+        rows = sink.rows // repeat
+    result.update({
+        'events': events,
+        'rows': rows,
+        'seconds': best,
+        'events_per_sec': events / best,
+        'rows_per_sec': rows / best,
+    })
+
+    stream = _build(params, read_latency)
+    with _RowsSink(), _StageTimer() as stages:
+        _publish(stream, pipeline_queue_size)
+    result['stages'] = {
+        name: {'seconds': stages.seconds[name],
+               'calls': stages.calls[name]}
+        for name in stages.seconds
+    }
+
+    if tracemalloc is not None:
+        stream = _build(params, read_latency)
+        with _RowsSink():
+            tracemalloc.start()
+            try:
+                _publish(stream, pipeline_queue_size)
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    else:
+        import resource
+        result['peak_memory'] = \
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result
+
+
+def run(patterns=None, repeat=3, total_rows=20000, pipeline_queue_size=None,
+        read_latency=0.0, out=sys.stdout):
+    results = {}
+    for name, params in _scenarios(total_rows):
+        if patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        res = results[name] = run_scenario(
+            params, repeat=repeat, pipeline_queue_size=pipeline_queue_size,
+            read_latency=read_latency)
+        stages = ' '.join('%s=%.3fs' % (k, v['seconds'])
+                          for k, v in sorted(res['stages'].items()))
+        print('%-22s %10.0f ev/s %12.0f rows/s %8.1f MiB  %s' % (
+            name, res['events_per_sec'], res['rows_per_sec'],
+            res.get('peak_memory', 0) / 1048576.0, stages), file=out)
+    return {
+        'meta': {
+            'package_version': metadata.version,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'repeat': repeat,
+            'total_rows': total_rows,
+            'pipeline_queue_size': pipeline_queue_size,
+            'read_latency': read_latency,
+        },
+        'scenarios': results,
+    }
+
+
+def compare(results, baseline, out=sys.stdout):
+    """ Print the ratio of each scenario against a baseline run
+
+    A ratio > 1 is better for rows/sec and worse for peak memory.
+    """
+    print('\n%-22s %12s %12s' % ('scenario', 'rows/s', 'peak mem'), file=out)
+    for name, res in sorted(results['scenarios'].items()):
+        base = baseline['scenarios'].get(name)
+        if not base:
+            continue
+        speed = res['rows_per_sec'] / base['rows_per_sec']
+        mem = float(res.get('peak_memory') or 0) / \
+            (base.get('peak_memory') or 1)
+        print('%-22s %11.2fx %11.2fx' % (name, speed, mem), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', action='append', dest='patterns',
+                        help='glob of scenario names to run, repeatable')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--total-rows', type=int, default=20000,
+                        help='rows published per scenario')
+    parser.add_argument('--pipeline', type=int, dest='pipeline_queue_size',
+                        help='publish via a pipeline.Pipeline of this '
+                             'queue size')
+    parser.add_argument('--read-latency', type=float, default=0.0,
+                        help='seconds slept before reading each event')
+    parser.add_argument('--save', help='save results as JSON to this file')
+    parser.add_argument('--compare', help='baseline JSON file to compare to')
+    args = parser.parse_args(argv)
+
+    results = run(args.patterns, repeat=args.repeat,
+                  total_rows=args.total_rows,
+                  pipeline_queue_size=args.pipeline_queue_size,
+                  read_latency=args.read_latency)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+""" Benchmark shipping converted rows to worker processes
+
+* serialization: bytes per row and time per row of the :py:mod:`codec
+  <mysqlbinlog2blinker.codec>` messages shipped by
+  :py:mod:`mysqlbinlog2blinker.process_pool`, against pickling the compact
+  form of :py:func:`bench_codec.pack_rows` and the row dicts as they are
+* fan-out: rows/sec of a CPU bound receiver run in the publishing process
+  and in a :py:class:`ProcessPoolFanout` of 1, 2 and 4 workers
+
+Usage::
+
+    python benchmarks/bench_process_pool.py --save process_pool.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mysqlbinlog2blinker  # noqa: E402
+from mysqlbinlog2blinker import _subscribers, codec, process_pool  # noqa
+from mysqlbinlog2blinker import signals  # noqa: E402
+import _synthetic  # noqa: E402
+from bench_codec import pack_rows  # noqa: E402
+
+__author__ = 'tarzan'
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def cpu_bound_receiver(table_name, rows, meta):
+    """ Stand-in for enrichment/serialization: some pure python work """
+    for row in rows:
+        total = 0
+        for value in row['values'].values():
+            total += len(repr(value))
+        for _ in range(200):
+            total = (total * 31 + 7) % 1000003
+
+
+def _converted_rows(params):
+    events = _synthetic.make_events(**params)
+    stream = _synthetic.SyntheticStream(events)
+    return [_subscribers._rows_event_to_dict(e, stream) for e in events]
+
+
+def bench_serialization(params):
+    converted = _converted_rows(params)
+    rows_count = sum(len(rows) for rows, _ in converted)
+    result = {}
+    for name, pack in (('dicts', lambda rows: [dict(r) for r in rows]),
+                       ('compact', pack_rows),
+                       ('codec', None)):
+        encoder = codec.Encoder()
+        gc.collect()
+        started = _timer()
+        size = 0
+        for rows, meta in converted:
+            if pack is None:
+                size += len(encoder.encode(meta['table'], rows, meta))
+            else:
+                size += len(pickle.dumps((pack(rows), meta),
+                                         pickle.HIGHEST_PROTOCOL))
+        elapsed = _timer() - started
+        result[name] = {'bytes_per_row': float(size) / rows_count,
+                        'us_per_row': elapsed * 1e6 / rows_count}
+    return result
+
+
+def bench_fanout(params, workers):
+    stream = _synthetic.SyntheticStream(_synthetic.make_events(**params))
+    rows = sum(len(e.rows) for e in stream.events)
+    if not workers:
+        signals.rows_updated.connect(cpu_bound_receiver)
+        try:
+            started = _timer()
+            mysqlbinlog2blinker._publish(stream)
+            elapsed = _timer() - started
+        finally:
+            signals.rows_updated.disconnect(cpu_bound_receiver)
+        return {'rows_per_sec': rows / elapsed}
+
+    fanout = process_pool.ProcessPoolFanout(workers=workers, partition='key')
+    fanout.on_rows_updated(cpu_bound_receiver)
+    fanout.start()
+    try:
+        started = _timer()
+        mysqlbinlog2blinker._publish(stream)
+    finally:
+        fanout.stop()
+    elapsed = _timer() - started
+    return dict(fanout.stats(), rows_per_sec=rows / elapsed)
+
+
+def run(total_rows=20000, out=sys.stdout):
+    results = {'serialization': {}, 'fanout': {}}
+    for width in (5, 50):
+        params = dict(action='update', width=width, rows_per_event=100,
+                      total_rows=total_rows)
+        res = results['serialization']['w%d' % width] = \
+            bench_serialization(params)
+        for name, r in sorted(res.items()):
+            print('serialize w%-4d %-8s %8.0f B/row %6.2f us/row' % (
+                width, name, r['bytes_per_row'], r['us_per_row']), file=out)
+
+    params = dict(action='update', width=20, rows_per_event=100,
+                  total_rows=total_rows)
+    for workers in (0, 1, 2, 4):
+        res = results['fanout'][str(workers)] = bench_fanout(params, workers)
+        print('fan-out %d workers %10.0f rows/s' % (
+            workers, res['rows_per_sec']), file=out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--total-rows', type=int, default=20000)
+    parser.add_argument('--save', help='save results as JSON to this file')
+    args = parser.parse_args(argv)
+    results = run(total_rows=args.total_rows)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
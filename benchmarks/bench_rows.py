@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+""" Benchmark the row formats: memory per row and conversion time
+
+For each scenario, events are converted by ``_subscribers._rows_event_to_dict``
+with ``row_format='dict'`` and ``row_format='compact'``:
+
+* convert: best time to convert all rows, per row
+* memory: bytes per row still allocated once the events are gone and only
+  the converted rows are kept (as a receiver or a batch would keep them),
+  after *keys* and *updated_values* have been read once. Column values are
+  included and are the same for both formats.
+
+Usage::
+
+    python benchmarks/bench_rows.py --save rows.json
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mysqlbinlog2blinker import _subscribers  # noqa: E402
+import _synthetic  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+__author__ = 'tarzan'
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+ROW_FORMATS = ('dict', 'compact')
+
+
+def _convert(events, stream, row_format):
+    rows = []
+    for event in events:
+        rows.extend(_subscribers._rows_event_to_dict(
+            event, stream, row_format=row_format)[0])
+    return rows
+
+
+def _touch(rows):
+    for row in rows:
+        row['keys']
+        if 'updated_values' in row:
+            row['updated_values']
+
+
+def _convert_time(params, row_format, repeat):
+    best = None
+    for _ in range(repeat):
+        events = _synthetic.make_events(**params)
+        stream = _synthetic.SyntheticStream(events)
+        gc.collect()
+        started = _timer()
+        _convert(events, stream, row_format)
+        elapsed = _timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _retained_memory(params, row_format):
+    """ Memory still allocated by the converted rows once events are gone
+
+    It includes the column values, which are the same objects for every
+    format, so the difference between formats is the containers' cost.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        events = _synthetic.make_events(**params)
+        stream = _synthetic.SyntheticStream(events)
+        rows = _convert(events, stream, row_format)
+        _touch(rows)
+        del events, stream
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return retained, len(rows)
+
+
+def run(widths=(5, 50, 200), total_rows=20000, repeat=3, out=sys.stdout):
+    results = {}
+    for action in ('insert', 'update'):
+        for width in widths:
+            params = dict(action=action, width=width, rows_per_event=1000,
+                          total_rows=total_rows)
+            name = '%s-w%d' % (action, width)
+            res = results[name] = {}
+            for row_format in ROW_FORMATS:
+                seconds = _convert_time(params, row_format, repeat)
+                r = res[row_format] = {
+                    'convert_us_per_row': seconds * 1e6 / total_rows,
+                }
+                if tracemalloc is not None:
+                    retained, rows = _retained_memory(params, row_format)
+                    r['bytes_per_row'] = retained / float(rows)
+            print('%-12s %s' % (name, '  '.join(
+                '%s: %6.2f us/row %8.0f B/row' % (
+                    fmt, res[fmt]['convert_us_per_row'],
+                    res[fmt].get('bytes_per_row', 0))
+                for fmt in ROW_FORMATS)), file=out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--total-rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='save results as JSON to this file')
+    args = parser.parse_args(argv)
+    results = run(total_rows=args.total_rows, repeat=args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
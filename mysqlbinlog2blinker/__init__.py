@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
+import functools
 import logging
+import os
 import random
 
 import pymysqlreplication
@@ -7,6 +9,9 @@ from pymysqlreplication import row_event
 from mysqlbinlog2blinker import (
     _subscribers,
     binlog_pos_memory as _bpm,
+    dispatchers,
+    reconnect as _reconnect,
+    schema_cache as _schema_cache,
     signals,
 )
 
@@ -15,42 +20,166 @@ __author__ = 'tarzan'
 _logger = logging.getLogger(__name__)
 
 
-def start_publishing(mysql_settings, **kwargs):
+def start_publishing(mysql_settings, dispatcher=None,
+                     only_subscribed_tables=True, row_format='dict',
+                     columnar_min_rows=1, pipeline=None, reconnect=None,
+                     schema_cache=None, **kwargs):
     """Start publishing MySQL row-based binlog events to blinker signals
 
     Args:
         mysql_settings (dict): information to connect to mysql via pymysql
+        dispatcher (dispatchers.BaseDispatcher): delivers the rows signals
+            and the position signal, e.g.
+            :py:class:`dispatchers.BatchingDispatcher` to coalesce events or
+            :py:class:`dispatchers.TransactionDispatcher` to publish whole
+            transactions. Default is
+            :py:class:`dispatchers.ImmediateDispatcher`
+        only_subscribed_tables (bool): when neither *only_tables* nor
+            *only_schemas* is given, derive them from the tables that the
+            rows signals' receivers subscribe to (via sender), so the stream
+            does not decode rows of other tables. Receivers connected after
+            publishing starts will not get rows of other tables. Ignored
+            for dispatchers which take the rows of every table, like
+            :py:class:`spool.SpoolDispatcher`.
+        row_format (str): *dict* (default) delivers rows as dicts,
+            *compact* delivers read only :py:class:`rows.CompactRow`
+            mappings which use much less memory, *columnar* delivers
+            :py:class:`rows.ColumnarRows`, one array per column
+        columnar_min_rows (int): in *columnar* format, events having less
+            rows than this are still delivered as lists of dicts
+        pipeline (pipeline.Pipeline): read, convert and dispatch events in
+            overlapping stages instead of one after another
+        reconnect (reconnect.Reconnect|bool): reconnect when the connection
+            drops, resuming after the last event, with this policy (True for
+            the default one), see :py:mod:`mysqlbinlog2blinker.reconnect`
+        schema_cache (schema_cache.SchemaCache): take columns of tables from
+            this on-disk cache, see :py:mod:`mysqlbinlog2blinker.schema_cache`
         **kwargs: The additional kwargs will be passed to
         :py:class:`pymysqlreplication.BinLogStreamReader`.
     """
     _logger.info('Start publishing from %s with:\n%s'
                  % (mysql_settings, kwargs))
 
-    kwargs.setdefault('server_id', random.randint(1000000000, 4294967295))
+    if schema_cache is not None:
+        schema_cache.validate_server(mysql_settings)
+    try:
+        if reconnect:
+            if reconnect is True:
+                reconnect = _reconnect.Reconnect()
+            # the same server id lets MySQL drop the dump thread of a lost
+            # connection
+            kwargs.setdefault('server_id', _random_server_id())
+            stream = _reconnect.ReconnectingStream(
+                functools.partial(_make_stream, mysql_settings, dispatcher,
+                                  only_subscribed_tables,
+                                  schema_cache=schema_cache),
+                reconnect, **kwargs)
+        else:
+            stream = _make_stream(mysql_settings, dispatcher,
+                                  only_subscribed_tables, schema_cache,
+                                  **kwargs)
+        _publish(stream, dispatcher, row_format, columnar_min_rows, pipeline)
+    finally:
+        if schema_cache is not None:
+            schema_cache.save()
+
+
+def _random_server_id():
+    return random.randint(1000000000, 4294967295)
+
+
+def _make_stream(mysql_settings, dispatcher=None, only_subscribed_tables=True,
+                 schema_cache=None, **kwargs):
+    """ Connect to the binlog stream, see :py:func:`start_publishing`
+
+    Returns:
+        pymysqlreplication.BinLogStreamReader: the stream
+    """
+    kwargs.setdefault('server_id', _random_server_id())
     kwargs.setdefault('freeze_schema', True)
 
+    if only_subscribed_tables and not getattr(dispatcher, 'all_rows', False) \
+            and 'only_tables' not in kwargs and 'only_schemas' not in kwargs:
+        tables = _subscribers.subscribed_tables()
+        if tables:
+            schemas_and_tables = [t.split('.', 1) for t in tables]
+            kwargs['only_schemas'] = sorted(set(s for s, _ in
+                                                schemas_and_tables))
+            kwargs['only_tables'] = sorted(set(t for _, t in
+                                               schemas_and_tables))
+            _logger.info('Only publishing subscribed tables %s'
+                         % sorted(tables))
+
+    if schema_cache is not None:
+        kwargs['schema_cache'] = schema_cache
+        reader_class = _schema_cache.CachingBinLogStreamReader
+    else:
+        reader_class = pymysqlreplication.BinLogStreamReader
+
     # connect to binlog stream
-    stream = pymysqlreplication.BinLogStreamReader(
+    stream = reader_class(
         mysql_settings,
         only_events=[row_event.DeleteRowsEvent,
                      row_event.UpdateRowsEvent,
-                     row_event.WriteRowsEvent],
+                     row_event.WriteRowsEvent] +
+        list(getattr(dispatcher, 'only_events', ())) +
+        _bpm.only_events(),
         **kwargs
     )
     """:type list[RowsEvent]"""
+    return stream
 
-    for event in stream:
-        # ignore non row events
-        if not isinstance(event, row_event.RowsEvent):
-            continue
 
-        _logger.debug('Send binlog signal "%s@%s.%s"' % (
-            event.__class__.__name__,
-            event.schema,
-            event.table
-        ))
-        signals.binlog_signal.send(event, stream=stream)
-        signals.binlog_position_signal.send((stream.log_file, stream.log_pos))
+def _publish(stream, dispatcher=None, row_format='dict', columnar_min_rows=1,
+             pipeline=None):
+    """ Publish events yielded by *stream* to blinker signals
+
+    Args:
+        stream (pymysqlreplication.BinLogStreamReader): the stream, or any
+            iterable of events that exposes ``log_file`` and ``log_pos``
+        dispatcher (dispatchers.BaseDispatcher): see
+            :py:func:`start_publishing`
+        row_format (str): see :py:func:`start_publishing`
+        columnar_min_rows (int): see :py:func:`start_publishing`
+        pipeline (pipeline.Pipeline): see :py:func:`start_publishing`
+    """
+    dispatcher = dispatcher or dispatchers.ImmediateDispatcher()
+    previous_row_format = _subscribers.set_row_format(row_format,
+                                                      columnar_min_rows)
+    previous_dispatcher = _subscribers.set_dispatcher(dispatcher)
+    try:
+        if pipeline is not None:
+            pipeline.run(stream, dispatcher)
+            dispatcher.flush()
+            return
+        for event in stream:
+            # non row events are only yielded when the dispatcher wants them
+            if not isinstance(event, row_event.RowsEvent):
+                _bpm.handle_event(event, stream)
+                dispatcher.handle_event(event, stream)
+                dispatcher.position(stream.log_file, stream.log_pos)
+                continue
+
+            _logger.debug('Send binlog signal "%s@%s.%s"',
+                          event.__class__.__name__, event.schema, event.table)
+            signals.binlog_signal.send(event, stream=stream)
+            dispatcher.position(stream.log_file, stream.log_pos)
+        dispatcher.flush()
+    finally:
+        dispatcher.close()
+        _subscribers.set_dispatcher(previous_dispatcher)
+        _subscribers.set_row_format(*previous_row_format)
+
+
+def _make_binlog_pos_memory(binlog_pos_memory):
+    """ Get the binlog position memory given to :py:func:`start_replication`
+    """
+    if not isinstance(binlog_pos_memory, _bpm.BaseBinlogPosMemory):
+        if not isinstance(binlog_pos_memory, (tuple, list)):
+            raise ValueError('Invalid binlog position memory: %s'
+                             % binlog_pos_memory)
+        binlog_pos_memory = _bpm.FileBasedBinlogPosMemory(*binlog_pos_memory)
+    return binlog_pos_memory
 
 
 def start_replication(mysql_settings,
@@ -69,21 +198,25 @@ def start_replication(mysql_settings,
             for default :py:class:`_bpm.FileBasedBinlogPosMemory`. It the file-
             name is None, it will be *`cwd`\mysqlbinlog2blinker.binlog.pos*
         **kwargs: any arguments that are accepted by
-            :py:class:`pymysqlreplication.BinLogStreamReader`'s constructor
+            :py:func:`start_publishing` (e.g. *dispatcher*, *reconnect*) or
+            :py:class:`pymysqlreplication.BinLogStreamReader`'s constructor.
+            *schema_cache* may also be True, to keep it next to the position
+            file
     """
-    if not isinstance(binlog_pos_memory, _bpm.BaseBinlogPosMemory):
-        if not isinstance(binlog_pos_memory, (tuple, list)):
-            raise ValueError('Invalid binlog position memory: %s'
-                             % binlog_pos_memory)
-        binlog_pos_memory = _bpm.FileBasedBinlogPosMemory(*binlog_pos_memory)
+    binlog_pos_memory = _make_binlog_pos_memory(binlog_pos_memory)
+    if kwargs.get('schema_cache') is True:
+        kwargs['schema_cache'] = _schema_cache.SchemaCache(
+            '%s.schema' % (getattr(binlog_pos_memory, 'pos_storage_filename',
+                                   None) or
+                           os.path.join(os.getcwd(), 'mysqlbinlog2blinker')))
 
     mysql_settings.setdefault('connect_timeout', 5)
     kwargs.setdefault('blocking', True)
     kwargs.setdefault('resume_stream', True)
 
     with binlog_pos_memory:
-        kwargs.setdefault('log_file', binlog_pos_memory.log_file)
-        kwargs.setdefault('log_pos', binlog_pos_memory.log_pos)
+        for key, value in binlog_pos_memory.resume_kwargs().items():
+            kwargs.setdefault(key, value)
         _logger.info('Start replication from %s with:\n%s'
                      % (mysql_settings, kwargs))
 
@@ -1,13 +1,187 @@
 # coding=utf-8
 import logging
+import operator
+import sys
+import time
 
+import blinker
 from pymysqlreplication import row_event
 
-from mysqlbinlog2blinker import signals
+from mysqlbinlog2blinker import dispatchers, signals, stats as _stats
+from mysqlbinlog2blinker.rows import (
+    ColumnarRows,
+    CompactRow,
+    LazyRow,
+    TableColumns,
+)
 
 __author__ = 'Tarzan'
 _logger = logging.getLogger(__name__)
 
+_dispatcher = dispatchers.ImmediateDispatcher()
+
+ROW_FORMATS = ('dict', 'compact', 'columnar')
+_row_format = 'dict'
+# smaller events are still delivered as dicts in columnar format
+_columnar_min_rows = 1
+
+# dicts keep insertion order, so values of an event's rows are in the same
+# order as the keys of its first row
+_ORDERED_DICTS = sys.version_info >= (3, 6)
+
+# table name => TableColumns shared by compact rows of the table
+_table_columns = {}
+
+_ROWS_SIGNALS = (signals.rows_inserted,
+                 signals.rows_updated,
+                 signals.rows_deleted)
+_string_types = (str, type(u''))
+
+_ACTIONS = {
+    signals.rows_inserted: 'insert',
+    signals.rows_updated: 'update',
+    signals.rows_deleted: 'delete',
+}
+
+_UNSUBSCRIBED = object()
+
+# schema.table names whose rows are published, None for all tables
+_only_tables = None
+
+# (signal name, table name) => _UNSUBSCRIBED, or the columns its receivers
+# need (None for all columns)
+_subscriptions_cache = {}
+# signals.connections_version() the cache was filled at
+_subscriptions_version = [None]
+
+# id(event) => (rows, meta) or _UNSUBSCRIBED, for events that a pipeline
+# has converted ahead of sending the binlog signal
+_precomputed = {}
+
+
+def set_dispatcher(dispatcher):
+    """ Set the dispatcher that delivers converted rows
+
+    Args:
+        dispatcher (dispatchers.BaseDispatcher|None): the new dispatcher,
+            None means the default :py:class:`dispatchers.ImmediateDispatcher`
+
+    Returns:
+        dispatchers.BaseDispatcher: the previous dispatcher
+    """
+    global _dispatcher
+    previous = _dispatcher
+    _dispatcher = dispatcher or dispatchers.ImmediateDispatcher()
+    _subscriptions_cache.clear()
+    return previous
+
+
+def set_row_format(row_format, columnar_min_rows=1):
+    """ Set the type of rows that are delivered to the rows signals
+
+    Args:
+        row_format (str): *dict* for lists of :py:class:`rows.LazyRow`,
+            *compact* for lists of :py:class:`rows.CompactRow` or
+            *columnar* for :py:class:`rows.ColumnarRows`
+        columnar_min_rows (int): in *columnar* format, events having less
+            rows than this are still delivered as lists of dicts
+
+    Returns:
+        tuple: the previous (row_format, columnar_min_rows)
+    """
+    global _row_format, _columnar_min_rows
+    if row_format not in ROW_FORMATS:
+        raise ValueError('Invalid row format "%s"' % row_format)
+    previous = _row_format, _columnar_min_rows
+    _row_format, _columnar_min_rows = row_format, columnar_min_rows
+    return previous
+
+
+def set_only_tables(tables):
+    """ Only publish rows of *tables*, whoever subscribes to other tables
+
+    Args:
+        tables (iterable[str]|None): schema.table names, None publishes all
+            tables
+
+    Returns:
+        frozenset|None: the previous tables
+    """
+    global _only_tables
+    previous = _only_tables
+    _only_tables = frozenset(tables) if tables is not None else None
+    _subscriptions_cache.clear()
+    return previous
+
+
+def _subscription(sig, table_name):
+    """ Get how *table_name*'s rows are subscribed via *sig*
+
+    The answer is cached per table until a receiver of the rows signals is
+    connected, disconnected or garbage collected.
+
+    Returns:
+        _UNSUBSCRIBED if nobody receives the rows, otherwise the union of
+        columns that the receivers need, None means all columns
+    """
+    version = signals.connections_version()
+    if _subscriptions_version[0] != version:
+        _subscriptions_cache.clear()
+        _subscriptions_version[0] = version
+    key = (sig.name, table_name)
+    try:
+        return _subscriptions_cache[key]
+    except KeyError:
+        pass
+    if _only_tables is not None and table_name not in _only_tables:
+        subscription = _UNSUBSCRIBED
+    elif signals.transaction_signal.receivers or \
+            getattr(_dispatcher, 'all_rows', False):
+        subscription = None
+    # has_receivers_for() is still True after disconnecting a receiver
+    # which has a sender, so check the actual receivers
+    elif not any(True for _ in sig.receivers_for(table_name)):
+        subscription = _UNSUBSCRIBED
+    else:
+        subscription = signals.subscribed_columns(sig, table_name)
+    _subscriptions_cache[key] = subscription
+    return subscription
+
+
+def subscribed_tables():
+    """ Get the tables that the current receivers subscribe to
+
+    Returns:
+        set[str]|None: set of schema.table, None if all tables are needed
+            (a receiver does not specify its table as sender, or there are
+            receivers of the binlog or transaction signal)
+    """
+    if signals.transaction_signal.receivers:
+        return None
+    # on_binlog is always connected to the binlog signal
+    if len(signals.binlog_signal.receivers) > 1:
+        return None
+
+    tables = set()
+    for sig in _ROWS_SIGNALS:
+        for sender in signals.connected_senders(sig):
+            if sender is blinker.ANY or \
+                    not isinstance(sender, _string_types):
+                return None
+            tables.add(sender)
+    return tables
+
+
+def _signal_for(e):
+    """ Get the rows signal of a RowsEvent """
+    if isinstance(e, row_event.UpdateRowsEvent):
+        return signals.rows_updated
+    elif isinstance(e, row_event.WriteRowsEvent):
+        return signals.rows_inserted
+    elif isinstance(e, row_event.DeleteRowsEvent):
+        return signals.rows_deleted
+    assert False, 'Invalid binlog event'
+
 
 def _get_updated_values(before_values, after_values):
     """ Get updated values from 2 dicts of values
@@ -26,39 +200,157 @@ def _get_updated_values(before_values, after_values):
                  if before_values[k] != after_values[k]])
 
 
-def _convert_write_row(row):
-    """ Convert a row for write/delete event """
-    return row
+def _get_keys(values, pk_cols):
+    """ Get primary key's values of a row """
+    return {k: values[k] for k in pk_cols}
+
+
+def _project(values, columns):
+    """ Keep only *columns* of a values dict """
+    return {k: values[k] for k in columns if k in values}
+
+
+def _convert_write_row(row, pk_cols, columns=None):
+    """ Convert a row for write/delete event
 
+    Args:
+        row (dict): event row data
+        pk_cols (tuple): primary key's columns
+        columns (tuple|None): only keep these columns, None keeps all
+    """
+    if columns is not None:
+        row = {'values': _project(row['values'], columns)}
+    return LazyRow(row, {'keys': (_get_keys, (row['values'], pk_cols))})
 
-def _convert_update_row(row):
+
+def _convert_update_row(row, pk_cols, columns=None):
     """ Convert a row for update event
 
+    *updated_values* and *keys* are computed on first access.
+
     Args:
         row (dict): event row data
+        pk_cols (tuple): primary key's columns
+        columns (tuple|None): only keep and diff these columns, None keeps
+            all
     """
     after_values = row['after_values']  # type: dict
     before_values = row['before_values']  # type: dict
+    if columns is not None:
+        after_values = _project(after_values, columns)
+        before_values = _project(before_values, columns)
     values = after_values
-    return {
-        'values': values,
-        'updated_values': _get_updated_values(before_values, after_values)
-    }
+    return LazyRow({'values': values}, {
+        'updated_values': (_get_updated_values, (before_values, after_values)),
+        'keys': (_get_keys, (values, pk_cols)),
+    })
+
+
+def _get_table_columns(table_name, names, pk_cols):
+    """ Get the shared TableColumns of a table, renew it when columns change
+    """
+    table_columns = _table_columns.get(table_name)
+    if table_columns is None or table_columns.names != names or \
+            tuple(name for name, _ in table_columns.pk) != pk_cols:
+        table_columns = _table_columns[table_name] = \
+            TableColumns(names, pk_cols)
+    return table_columns
+
+
+def _tuple_maker(first_values, columns):
+    """ Make a function which gets values of an event's rows as tuples
+
+    Args:
+        first_values (dict): values of the event's first row
+        columns (tuple|None): only keep these columns, None keeps all
+
+    Returns:
+        tuple: (names, to_tuple) where names are the kept columns in the
+            order of the tuples
+    """
+    if columns is None:
+        names = tuple(first_values)
+    else:
+        names = tuple(name for name in columns if name in first_values)
 
+    if columns is None and _ORDERED_DICTS:
+        def to_tuple(values):
+            return tuple(values.values())
+    elif len(names) > 1:
+        to_tuple = operator.itemgetter(*names)
+    else:
+        def to_tuple(values):
+            return tuple([values[name] for name in names])
+    return names, to_tuple
+
+
+def _convert_compact_rows(e, pk_cols, columns, is_update):
+    """ Convert rows of an event to :py:class:`rows.CompactRow`
+
+    Args:
+        e (pymysqlreplication.row_event.RowsEvent): the event
+        pk_cols (tuple): primary key's columns
+        columns (tuple|None): only keep these columns, None keeps all
+        is_update (bool): whether it is an update event
+    """
+    event_rows = e.rows
+    if not event_rows:
+        return []
+    values_key = 'after_values' if is_update else 'values'
+    names, to_tuple = _tuple_maker(event_rows[0][values_key], columns)
+    table_columns = _get_table_columns('%s.%s' % (e.schema, e.table),
+                                       names, tuple(pk_cols))
+
+    if is_update:
+        return [CompactRow(table_columns,
+                           to_tuple(row['after_values']),
+                           to_tuple(row['before_values']))
+                for row in event_rows]
+    return [CompactRow(table_columns, to_tuple(row['values']))
+            for row in event_rows]
+
+
+def _convert_columnar_rows(e, pk_cols, columns, is_update):
+    """ Convert rows of an event to one :py:class:`rows.ColumnarRows`
+
+    Args: see :py:func:`_convert_compact_rows`
+    """
+    event_rows = e.rows
+    values_key = 'after_values' if is_update else 'values'
+    names, to_tuple = _tuple_maker(event_rows[0][values_key], columns)
 
-def _rows_event_to_dict(e, stream):
+    def transpose(key):
+        return list(zip(*[to_tuple(row[key]) for row in event_rows]))
+
+    return ColumnarRows(
+        names, transpose(values_key),
+        transpose('before_values') if is_update else None,
+        pk_cols,
+    )
+
+
+def _rows_event_to_dict(e, stream, columns=None, row_format='dict',
+                        columnar_min_rows=1):
     """ Convert RowsEvent to a dict
 
     Args:
         e (pymysqlreplication.row_event.RowsEvent): the event
         stream (pymysqlreplication.BinLogStreamReader):
             the stream that yields event
+        columns (set|None): only keep these columns (and the primary key)
+            in rows, None keeps all columns
+        row_format (str): type of rows, see :py:func:`set_row_format`
+        columnar_min_rows (int): see :py:func:`set_row_format`
 
     Returns:
         dict: event's data as a dict
     """
-    pk_cols = e.primary_key if isinstance(e.primary_key, (list, tuple)) \
-        else (e.primary_key, )
+    if not e.primary_key:
+        pk_cols = ()
+    elif isinstance(e.primary_key, (list, tuple)):
+        pk_cols = tuple(e.primary_key)
+    else:
+        pk_cols = (e.primary_key, )
 
     if isinstance(e, row_event.UpdateRowsEvent):
         sig = signals.rows_updated
@@ -83,25 +375,66 @@ def _rows_event_to_dict(e, stream):
         'table': e.table,
         'action': action,
     }
-    rows = list(map(row_converter, e.rows))
-    for row in rows:
-        row['keys'] = {k: row['values'][k] for k in pk_cols}
+    if columns is not None:
+        columns = tuple(set(columns).union(pk_cols))
+    if row_format == 'compact':
+        rows = _convert_compact_rows(e, pk_cols, columns,
+                                     row_converter is _convert_update_row)
+    elif row_format == 'columnar' and \
+            len(e.rows) >= max(1, columnar_min_rows):
+        rows = _convert_columnar_rows(e, pk_cols, columns,
+                                      row_converter is _convert_update_row)
+    else:
+        rows = [row_converter(row, pk_cols, columns) for row in e.rows]
     return rows, meta
 
 
+def _convert_event(event, stream):
+    """ Convert a RowsEvent with the subscribed columns and current format
+
+    Returns:
+        tuple|_UNSUBSCRIBED: (rows, meta), _UNSUBSCRIBED if nobody receives
+            its table's rows
+    """
+    table_name = '%s.%s' % (event.schema, event.table)
+    sig = _signal_for(event)
+    stats = _stats.current
+    if stats is not None:
+        stats.incr('events', (table_name, _ACTIONS[sig]))
+        stats.set_gauge('lag_seconds', None, time.time() - event.timestamp)
+    columns = _subscription(sig, table_name)
+    if columns is _UNSUBSCRIBED:
+        return _UNSUBSCRIBED
+    if stats is None:
+        return _rows_event_to_dict(event, stream, columns, _row_format,
+                                   _columnar_min_rows)
+    started = _stats._timer()
+    converted = _rows_event_to_dict(event, stream, columns, _row_format,
+                                    _columnar_min_rows)
+    stats.observe('convert_seconds', table_name, _stats._timer() - started)
+    stats.incr('rows', (table_name, _ACTIONS[sig]), len(converted[0]))
+    return converted
+
+
 @signals.on_binlog
 def on_binlog(event, stream):
     """ Process on a binlog event
 
-    1. Convert event instance into a dict
-    2. Send corresponding schema/table/signals
+    1. Skip the event if nobody receives its table's rows
+    2. Convert event instance into a dict, keeping only the subscribed
+       columns (unless it has been converted ahead by a pipeline)
+    3. Send corresponding schema/table/signals via current dispatcher
 
     Args:
         event (pymysqlreplication.row_event.RowsEvent): the event
     """
-    rows, meta = _rows_event_to_dict(event, stream)
-
-    table_name = '%s.%s' % (meta['schema'], meta['table'])
+    converted = _precomputed.pop(id(event), None)
+    if converted is None:
+        converted = _convert_event(event, stream)
+    if converted is _UNSUBSCRIBED:
+        return
+    rows, meta = converted
+    table_name = '%s.%s' % (event.schema, event.table)
 
     if meta['action'] == 'insert':
         sig = signals.rows_inserted
@@ -112,4 +445,4 @@ def on_binlog(event, stream):
     else:
         raise RuntimeError('Invalid action "%s"' % meta['action'])
 
-    sig.send(table_name, rows=rows, meta=meta)
\ No newline at end of file
+    _dispatcher.dispatch(sig, table_name, rows, meta)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+""" Publish binlog events to asyncio receivers (Python 3.5+)
+
+:py:func:`start_publishing_async` and :py:func:`start_replication_async` are
+coroutines. The blocking :py:class:`pymysqlreplication.BinLogStreamReader`
+runs in a reader thread, which also converts the events, then hands rows to
+the event loop where the rows signals' receivers are called. A receiver may
+be a coroutine function, its result is awaited:
+
+    @signals.on_rows_inserted(sender='db.orders')
+    async def on_orders(table_name, rows, meta):
+        await writer.write(rows)
+
+    asyncio.run(
+        start_replication_async({'host': 'localhost', 'user': 'root'}))
+
+Rows of different tables are delivered concurrently, up to *concurrency*
+deliveries at a time, rows of the same table are delivered in binlog order.
+When receivers fall behind, the queue of *queue_size* events between the
+reader and the loop fills up and reading pauses.
+
+The position signal is sent from the loop, once everything before that
+position has been delivered. Other receivers are plain functions called in
+the loop, they should not block it.
+"""
+import asyncio
+import functools
+import logging
+import threading
+
+import mysqlbinlog2blinker as _publisher
+from mysqlbinlog2blinker import binlog_pos_memory as _bpm, dispatchers
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+# Python < 3.7 has no get_running_loop, get_event_loop is equivalent there
+# when called from a coroutine
+_get_running_loop = getattr(asyncio, 'get_running_loop',
+                            asyncio.get_event_loop)
+
+
+async def send_async(sig, sender, **kwargs):
+    """ Send a signal, awaiting receivers which return awaitables
+
+    Args:
+        sig (blinker.NamedSignal): the signal
+        sender: the sender
+        **kwargs: the signal's data
+
+    Returns:
+        list[tuple]: (receiver, result) of every receiver, like
+            :py:meth:`blinker.Signal.send`
+    """
+    results = []
+    awaiting = []
+    for receiver in sig.receivers_for(sender):
+        result = receiver(sender, **kwargs)
+        if hasattr(result, '__await__') or asyncio.iscoroutine(result):
+            awaiting.append(len(results))
+        results.append((receiver, result))
+    if awaiting:
+        done = await asyncio.gather(*[results[i][1] for i in awaiting])
+        for i, result in zip(awaiting, done):
+            results[i] = (results[i][0], result)
+    return results
+
+
+class _Stopped(Exception):
+    """ The loop side does not take events anymore """
+
+
+class _LoopBridgeDispatcher(dispatchers.BaseDispatcher):
+    """ Dispatcher of the reader thread: hand rows/positions to the loop
+
+    At most *queue_size* items are pending in the loop's queue, putting more
+    blocks the reader thread.
+    """
+    def __init__(self, loop, items, queue_size, stopped):
+        self._loop = loop
+        self._items = items
+        self._slots = threading.Semaphore(queue_size)
+        self._stopped = stopped
+
+    def put(self, item):
+        while not self._slots.acquire(timeout=0.1):
+            if self._stopped.is_set():
+                raise _Stopped()
+        if self._stopped.is_set():
+            raise _Stopped()
+        self._loop.call_soon_threadsafe(self._items.put_nowait, item)
+
+    def taken(self):
+        """ Called by the loop once it has taken an item """
+        self._slots.release()
+
+    def dispatch(self, sig, table_name, rows, meta):
+        self.put(('rows', sig, table_name, rows, meta))
+
+    def position(self, log_file, log_pos):
+        self.put(('position', (log_file, log_pos)))
+
+    def run(self, stream, row_format, columnar_min_rows):
+        """ Body of the reader thread """
+        try:
+            _publisher._publish(stream, self, row_format, columnar_min_rows)
+        except _Stopped:
+            return
+        except Exception as e:
+            _logger.exception('Reading binlog stream failed')
+            item = ('error', e)
+        else:
+            item = ('end', )
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+        try:
+            self.put(item)
+        except _Stopped:
+            pass
+
+
+class _AsyncDelivery(object):
+    """ Deliver rows on the loop: concurrent across tables, ordered within a
+    table, positions are sent once everything before them is delivered
+    """
+    def __init__(self, concurrency):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # table name => latest delivery of the table
+        self._tails = {}
+        self._tasks = set()
+        self._tracker = _bpm.AckTracker()
+        self.error = None
+
+    async def deliver(self, sig, table_name, rows, meta):
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._send(
+            self._tails.get(table_name), sig, table_name, rows, meta))
+        self._tails[table_name] = task
+        self._tasks.add(task)
+        task.add_done_callback(functools.partial(
+            self._on_done, table_name, self._tracker.ticket()))
+
+    async def _send(self, previous, sig, table_name, rows, meta):
+        try:
+            if previous is not None and not previous.done():
+                await asyncio.wait((previous, ))
+            if self.error is None:
+                await send_async(sig, table_name, rows=rows, meta=meta)
+        finally:
+            self._semaphore.release()
+
+    def _on_done(self, table_name, ticket, task):
+        self._tasks.discard(task)
+        if self._tails.get(table_name) is task:
+            del self._tails[table_name]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            if self.error is None:
+                _logger.error('Sending rows of %s failed', table_name,
+                              exc_info=task.exception())
+                self.error = task.exception()
+        elif self.error is None:
+            ticket.ack()
+
+    def position(self, pos):
+        self._tracker.position(*pos)
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    async def join(self):
+        """ Wait for every pending delivery """
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        self.raise_error()
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._tracker.reset()
+
+
+async def _publish_async(stream, concurrency=100, queue_size=1000,
+                         row_format='dict', columnar_min_rows=1):
+    """ Publish events yielded by *stream* to the rows signals' receivers
+
+    Args: see :py:func:`start_publishing_async`, *stream* is like for
+        :py:func:`mysqlbinlog2blinker._publish`
+    """
+    loop = _get_running_loop()
+    items = asyncio.Queue()
+    stopped = threading.Event()
+    bridge = _LoopBridgeDispatcher(loop, items, queue_size, stopped)
+    delivery = _AsyncDelivery(concurrency)
+    reader = threading.Thread(target=bridge.run,
+                              args=(stream, row_format, columnar_min_rows),
+                              name='mysqlbinlog2blinker-reader')
+    reader.daemon = True
+    reader.start()
+
+    completed = False
+    try:
+        while True:
+            item = await items.get()
+            bridge.taken()
+            kind = item[0]
+            if kind == 'rows':
+                await delivery.deliver(*item[1:])
+            elif kind == 'position':
+                delivery.position(item[1])
+            elif kind == 'error':
+                raise item[1]
+            else:
+                break
+            delivery.raise_error()
+        await delivery.join()
+        completed = True
+    finally:
+        stopped.set()
+        if not completed:
+            delivery.cancel()
+
+
+async def start_publishing_async(mysql_settings, concurrency=100,
+                                 queue_size=1000, only_subscribed_tables=True,
+                                 row_format='dict', columnar_min_rows=1,
+                                 **kwargs):
+    """ Start publishing binlog events to asyncio receivers
+
+    It returns when the stream ends (it never does with ``blocking=True``)
+    or raises the error of the stream or of a receiver.
+
+    Args:
+        mysql_settings (dict): information to connect to mysql via pymysql
+        concurrency (int): max rows signals being delivered at a time
+        queue_size (int): max events read ahead of the delivery, reading
+            pauses when it is reached
+        only_subscribed_tables (bool): see
+            :py:func:`mysqlbinlog2blinker.start_publishing`
+        row_format (str): see :py:func:`mysqlbinlog2blinker.start_publishing`
+        columnar_min_rows (int): see
+            :py:func:`mysqlbinlog2blinker.start_publishing`
+        **kwargs: The additional kwargs will be passed to
+        :py:class:`pymysqlreplication.BinLogStreamReader`.
+    """
+    _logger.info('Start publishing asynchronously from %s with:\n%s'
+                 % (mysql_settings, kwargs))
+    stream = _publisher._make_stream(
+        mysql_settings, only_subscribed_tables=only_subscribed_tables,
+        **kwargs)
+    await _publish_async(stream, concurrency, queue_size, row_format,
+                         columnar_min_rows)
+
+
+async def start_replication_async(mysql_settings, binlog_pos_memory=(None, 2),
+                                  **kwargs):
+    """ Start replication to asyncio receivers, resuming from the position
+    in *binlog_pos_memory*
+
+    Args:
+        mysql_settings (dict): mysql settings that is used to connect to
+            mysql via pymysql
+        binlog_pos_memory (_bpm.BaseBinlogPosMemory): see
+            :py:func:`mysqlbinlog2blinker.start_replication`
+        **kwargs: any arguments that are accepted by
+            :py:func:`start_publishing_async`
+    """
+    binlog_pos_memory = _publisher._make_binlog_pos_memory(binlog_pos_memory)
+
+    mysql_settings.setdefault('connect_timeout', 5)
+    kwargs.setdefault('blocking', True)
+    kwargs.setdefault('resume_stream', True)
+
+    with binlog_pos_memory:
+        for key, value in binlog_pos_memory.resume_kwargs().items():
+            kwargs.setdefault(key, value)
+        _logger.info('Start replication asynchronously from %s with:\n%s'
+                     % (mysql_settings, kwargs))
+
+        await start_publishing_async(mysql_settings, **kwargs)
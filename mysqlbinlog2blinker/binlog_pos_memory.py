@@ -1,18 +1,57 @@
 # -*- coding: utf-8 -*-
+import collections
+import json
 import logging
+import mmap
 import os
+import re
+import struct
 import sys
 import threading
-from mysqlbinlog2blinker import signals
+import time
+import zlib
+
+from pymysqlreplication import event as binlog_event
+
+from mysqlbinlog2blinker import signals, stats as _stats
+from mysqlbinlog2blinker.gtid import GtidSet
 
 __author__ = 'tarzan'
 _logger = logging.getLogger(__name__)
 
+_timer = getattr(time, 'perf_counter', time.time)
+
+# os.rename does not replace an existing file on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+# statements logged inside a transaction which do not end it
+_IN_TRANSACTION_QUERY = re.compile(
+    r'(BEGIN|SAVEPOINT|RELEASE|ROLLBACK\s+(WORK\s+)?TO)\b')
+
+
+def _query_of(event):
+    query = event.query
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return query.strip().upper()
+
+
+def _ends_transaction(query):
+    """ Tell whether the query of a QueryEvent ends the transaction being
+    read: COMMIT, ROLLBACK or a DDL, which commits implicitly. BEGIN and
+    savepoints do not
+    """
+    return not _IN_TRANSACTION_QUERY.match(query)
+
 
 class BaseBinlogPosMemory(object):
     """ This class will receive binlog position signal from mysqlbinlog2blinker
     and store it into a persistent storage.
     """
+    #: name of the source whose positions are stored, when replicating from
+    #: several servers (see :py:mod:`mysqlbinlog2blinker.multi_source`)
+    source = None
+
     def start(self):
         """ Start listening the signal and monitoring position changing
         """
@@ -33,6 +72,12 @@ class BaseBinlogPosMemory(object):
         """ Return current or last saved binlog file """
         raise NotImplementedError()
 
+    def resume_kwargs(self):
+        """ Get arguments of :py:class:`pymysqlreplication.BinLogStreamReader`
+        to resume from the saved position
+        """
+        return {'log_file': self.log_file, 'log_pos': self.log_pos}
+
     def __enter__(self):
         self.start()
 
@@ -40,6 +85,232 @@ class BaseBinlogPosMemory(object):
         self.stop()
 
 
+class SourceLogFile(str):
+    """ Name of a binlog file which tells the source it belongs to
+
+    With several sources, positions carry it as their log file, so they get
+    to the memory of their source through any dispatcher.
+    """
+    def __new__(cls, log_file, source):
+        self = str.__new__(cls, log_file)
+        self.source = source
+        return self
+
+    def __reduce__(self):
+        return SourceLogFile, (str(self), self.source)
+
+
+def _source_of(log_file):
+    return getattr(log_file, 'source', None)
+
+
+def _binlog_order(log_file, log_pos):
+    """ Sort key of a position, binlog files by their numeric suffix, as
+    mysql-bin.999999 is followed by mysql-bin.1000000
+    """
+    _, _, index = log_file.rpartition('.')
+    return (int(index) if index.isdigit() else 0), log_pos
+
+
+# memories which take positions from publish_position() directly
+_attached = []
+
+
+def attach(memory):
+    """ Make *memory* receive positions of :py:func:`publish_position`
+    through its ``set_binlog_pos(log_file, log_pos)``, bypassing the signal
+    """
+    if memory not in _attached:
+        _attached.append(memory)
+
+
+def detach(memory):
+    """ Stop giving positions to *memory*, see :py:func:`attach` """
+    if memory in _attached:
+        _attached.remove(memory)
+
+
+def only_events():
+    """ Get the non rows event classes that attached memories need """
+    classes = []
+    for memory in _attached:
+        for cls in getattr(memory, 'only_events', ()):
+            if cls not in classes:
+                classes.append(cls)
+    return classes
+
+
+def handle_event(event, stream):
+    """ Give a non rows event to the attached memories which want it """
+    source = _source_of(stream.log_file)
+    for memory in _attached:
+        if memory.source == source and \
+                isinstance(event, tuple(getattr(memory, 'only_events', ()))):
+            memory.handle_event(event, stream)
+
+
+def publish_position(log_file, log_pos):
+    """ Publish the stream's position, it is called by the dispatchers
+
+    The position is given directly to the attached memories, the binlog
+    position signal is only sent when it has receivers.
+    """
+    source = _source_of(log_file)
+    for memory in _attached:
+        if memory.source == source:
+            memory.set_binlog_pos(log_file, log_pos)
+    if signals.binlog_position_signal.receivers:
+        signals.binlog_position_signal.send((log_file, log_pos))
+
+
+def _send_position(pos):
+    publish_position(*pos)
+
+
+class Ticket(object):
+    """ Acknowledgement of the delivery of dispatched rows, see
+    :py:class:`AckTracker`
+    """
+    __slots__ = ('_tracker', 'remaining')
+
+    def __init__(self, tracker, acks=1):
+        self._tracker = tracker
+        self.remaining = acks
+
+    def add(self, acks=1):
+        """ Require more acknowledgements, e.g. when rows are split """
+        with self._tracker._lock:
+            self.remaining += acks
+
+    def ack(self):
+        """ Acknowledge that (a part of) the rows have been processed """
+        self._tracker._ack(self)
+
+    @property
+    def done(self):
+        return self.remaining <= 0
+
+
+class AckTracker(object):
+    """ Publish the low-watermark of acknowledged positions
+
+    Dispatchers which deliver rows concurrently take a :py:class:`Ticket`
+    per rows signal, then tell the tracker the stream's position after each
+    event. A position is sent to the binlog position signal, so saved by the
+    position memories, only once every ticket taken before it has been
+    acknowledged, whatever the order in which the deliveries complete.
+
+    Tickets may be acknowledged from any thread, and from the publish
+    callback. A ticket which is never acknowledged holds every later
+    position back, a warning is logged when the backlog reaches
+    *warn_backlog*, then each time it doubles.
+    """
+    def __init__(self, publish=None, warn_backlog=100000):
+        """ Create an AckTracker
+
+        Args:
+            publish (callable|None): called with (log_file, log_pos) when the
+                low-watermark moves, default sends the position signal
+            warn_backlog (int|None): number of tickets and positions waiting
+                for an acknowledgement which logs a warning, None to not
+        """
+        self._publish = publish or _send_position
+        self.warn_backlog = warn_backlog
+        self._warn_at = warn_backlog
+        self._lock = threading.Lock()
+        # tickets and positions in binlog order
+        self._pending = collections.deque()
+        # low-watermarks to publish, outside of the lock, in order
+        self._outbox = collections.deque()
+        self._publishing = False
+        self.low_watermark = None
+
+    def ticket(self, acks=1):
+        """ Take a ticket for rows which are being dispatched
+
+        Args:
+            acks (int): number of acknowledgements it needs
+        """
+        ticket = Ticket(self, acks)
+        with self._lock:
+            self._pending.append(ticket)
+            backlog = len(self._pending)
+            warn = self._warn_at and backlog >= self._warn_at
+            if warn:
+                self._warn_at = backlog * 2
+        if warn:
+            _logger.warning('%d tickets and positions wait for '
+                            'acknowledgements, position is held at %s',
+                            backlog, self.low_watermark)
+        return ticket
+
+    def position(self, log_file, log_pos):
+        """ Mark the stream's position after the tickets taken so far """
+        with self._lock:
+            self._pending.append((log_file, log_pos))
+            self._advance()
+        self._publish_outbox()
+
+    def _ack(self, ticket):
+        with self._lock:
+            if ticket.remaining <= 0:
+                raise ValueError('Ticket is already acknowledged')
+            ticket.remaining -= 1
+            if ticket.remaining == 0:
+                self._advance()
+        self._publish_outbox()
+
+    def _advance(self):
+        pending = self._pending
+        # source => its latest acknowledged position
+        positions = collections.OrderedDict()
+        while pending:
+            item = pending[0]
+            if isinstance(item, tuple):
+                source = _source_of(item[0])
+                positions.pop(source, None)
+                positions[source] = item
+            elif item.remaining > 0:
+                break
+            pending.popleft()
+        for pos in positions.values():
+            self.low_watermark = pos
+            self._outbox.append(pos)
+        if self.warn_backlog and len(pending) < self.warn_backlog:
+            self._warn_at = self.warn_backlog
+
+    def _publish_outbox(self):
+        """ Publish the low-watermarks, one thread at a time so that they
+        stay in order. Calls made while publishing, e.g. by the callback,
+        leave theirs to the publishing thread
+        """
+        while True:
+            with self._lock:
+                if self._publishing or not self._outbox:
+                    return
+                self._publishing = True
+                pos = self._outbox.popleft()
+            try:
+                self._publish(pos)
+            finally:
+                with self._lock:
+                    self._publishing = False
+
+    @property
+    def pending(self):
+        """ Number of tickets which are not acknowledged yet """
+        with self._lock:
+            return sum(1 for item in self._pending
+                       if not isinstance(item, tuple) and item.remaining > 0)
+
+    def reset(self):
+        """ Forget pending tickets and positions """
+        with self._lock:
+            self._pending.clear()
+            self._outbox.clear()
+            self._warn_at = self.warn_backlog
+
+
 class FileBasedBinlogPosMemory(BaseBinlogPosMemory):
     """ This class store binlog position into file.
 
@@ -96,7 +367,8 @@ class FileBasedBinlogPosMemory(BaseBinlogPosMemory):
             self._pos_changed = True
 
     def on_binlog_pos_signal(self, pos):
-        self.set_binlog_pos(*pos)
+        if _source_of(pos[0]) == self.source:
+            self.set_binlog_pos(*pos)
 
     def start(self):
         _logger.debug('Start binlog position memory at %s'
@@ -119,12 +391,15 @@ class FileBasedBinlogPosMemory(BaseBinlogPosMemory):
         """
         if not self._pos_changed:
             return
+        started = _timer()
         with open(self.pos_storage_filename, 'w+') as f:
             _pos = '%s:%s' % (self._log_file, self._log_pos)
-            _logger.debug('Saving position %s to file %s'
-                          % (_pos, self.pos_storage_filename))
+            _logger.debug('Saving position %s to file %s',
+                          _pos, self.pos_storage_filename)
             f.write(_pos)
             self._pos_changed = False
+        _stats.observe('position_save_seconds', type(self).__name__,
+                       _timer() - started)
 
     def _read_file_and_pos(self):
         """ Read last position from file, store as current position
@@ -146,4 +421,364 @@ class FileBasedBinlogPosMemory(BaseBinlogPosMemory):
                 self._log_file = log_file
                 self._log_pos = log_pos
         except IOError as e:
-            _logger.error(e)
\ No newline at end of file
+            _logger.error(e)
+
+
+class MmapBinlogPosMemory(BaseBinlogPosMemory):
+    """ This class stores binlog position into a memory mapped file.
+
+    The file holds 2 fixed size records, each one is (sequence, position,
+    binlog file, crc32). A new position overwrites the older record in place,
+    so the other one stays intact if the process crashes in the middle of
+    the write. At start, the valid record having the highest sequence is
+    read.
+
+    Saving a position is a copy into the mapped memory, the OS writes it
+    back to the file, even if the process crashes. *msync_interval* also
+    forces it to disk at most that often, to survive an OS crash.
+    """
+    #: sequence, log_pos, length of the log file name, log file name
+    _FIELDS = struct.Struct('<QQH256s')
+    _CRC = struct.Struct('<I')
+    RECORD_SIZE = _FIELDS.size + _CRC.size
+
+    def __init__(self, pos_filename, msync_interval=None):
+        """ Create instance of MmapBinlogPosMemory
+
+        Args:
+            pos_filename (str|None): position storage file. None will makes
+                *mysqlbinlog2blinker.binlog.pos.mmap* at current working dir
+            msync_interval (float|None): msync the file after a position
+                change when the last msync is older than this in seconds,
+                0 syncs every change, None never syncs explicitly
+        """
+        if not pos_filename:
+            pos_filename = os.path.join(os.getcwd(),
+                                        'mysqlbinlog2blinker.binlog.pos.mmap')
+        self.pos_storage_filename = pos_filename
+        self.msync_interval = msync_interval
+
+        self._log_file = None
+        self._log_pos = None
+        self._seq = 0
+        self._last_msync = 0.0
+        self._fd = None
+        self._mmap = None
+
+    @property
+    def log_pos(self):
+        return self._log_pos
+
+    @property
+    def log_file(self):
+        return self._log_file
+
+    @classmethod
+    def _unpack(cls, record):
+        """ Get (seq, log_file, log_pos) of a record, None if it is invalid
+        """
+        fields = record[:cls._FIELDS.size]
+        crc, = cls._CRC.unpack(record[cls._FIELDS.size:])
+        if crc != zlib.crc32(fields) & 0xffffffff:
+            return None
+        seq, log_pos, length, name = cls._FIELDS.unpack(fields)
+        if not seq:
+            return None
+        return seq, name[:length].decode('utf-8'), log_pos
+
+    def _read_records(self):
+        size = self.RECORD_SIZE
+        records = [self._unpack(self._mmap[i * size:(i + 1) * size])
+                   for i in (0, 1)]
+        valid = [r for r in records if r is not None]
+        if valid:
+            self._seq, self._log_file, self._log_pos = max(valid)
+            _logger.debug('Got position "%s:%s" from file %s'
+                          % (self._log_file, self._log_pos,
+                             self.pos_storage_filename))
+
+    def set_binlog_pos(self, log_file, log_pos):
+        if log_file == self._log_file and log_pos == self._log_pos:
+            return
+        started = _timer()
+        name = log_file.encode('utf-8')
+        if len(name) > 256:
+            raise ValueError('Binlog file name is too long: %s' % log_file)
+        seq = self._seq + 1
+        fields = self._FIELDS.pack(seq, log_pos, len(name), name)
+        record = fields + self._CRC.pack(zlib.crc32(fields) & 0xffffffff)
+        offset = (seq % 2) * self.RECORD_SIZE
+        self._mmap[offset:offset + self.RECORD_SIZE] = record
+        self._seq = seq
+        self._log_file, self._log_pos = log_file, log_pos
+
+        if self.msync_interval is not None:
+            now = time.time()
+            if now - self._last_msync >= self.msync_interval:
+                self._mmap.flush()
+                self._last_msync = now
+        _stats.observe('position_save_seconds', type(self).__name__,
+                       _timer() - started)
+
+    def on_binlog_pos_signal(self, pos):
+        if _source_of(pos[0]) == self.source:
+            self.set_binlog_pos(*pos)
+
+    def start(self):
+        _logger.debug('Start binlog position memory at %s'
+                      % self.pos_storage_filename)
+        size = 2 * self.RECORD_SIZE
+        self._fd = os.open(self.pos_storage_filename, os.O_RDWR | os.O_CREAT,
+                           0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._read_records()
+        signals.binlog_position_signal.connect(self.on_binlog_pos_signal)
+
+    def stop(self):
+        signals.binlog_position_signal.disconnect(self.on_binlog_pos_signal)
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            os.close(self._fd)
+            self._mmap = self._fd = None
+        _logger.debug('Finish binlog position memory at %s'
+                      % self.pos_storage_filename)
+
+
+class EventDrivenBinlogPosMemory(FileBasedBinlogPosMemory):
+    """ This class stores binlog position into a file, like
+    :py:class:`FileBasedBinlogPosMemory`, when enough has changed.
+
+    The position is saved once *max_events* positions or *max_bytes* binlog
+    bytes have gone by since the last save, or *max_time* seconds have
+    passed, whichever comes first, and at once when the binlog file changes.
+    Nothing is written while the position does not change.
+
+    It is attached to :py:func:`publish_position` instead of connecting to
+    the binlog position signal, so taking a position is a few attribute
+    writes, the file is written by a background thread.
+    """
+    def __init__(self, pos_filename, max_events=1000,
+                 max_bytes=1024 * 1024, max_time=2.0):
+        """ Create instance of EventDrivenBinlogPosMemory
+
+        Args:
+            pos_filename (str|None): see :py:class:`FileBasedBinlogPosMemory`
+            max_events (int|None): save after this number of positions
+            max_bytes (int|None): save after this number of binlog bytes
+            max_time (float|None): save a changed position older than this
+                in seconds
+        """
+        super(EventDrivenBinlogPosMemory, self).__init__(pos_filename,
+                                                         max_time)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+
+        self._events = 0
+        self._bytes = 0
+        self._save_flag = threading.Event()
+        self._stopping = False
+
+    def set_binlog_pos(self, log_file, log_pos):
+        if log_pos == self._log_pos and log_file == self._log_file:
+            return
+        events = self._events = self._events + 1
+        if log_file == self._log_file and log_pos > self._log_pos:
+            binlog_bytes = self._bytes = \
+                self._bytes + log_pos - self._log_pos
+            save = (self.max_events and events >= self.max_events) or \
+                (self.max_bytes and binlog_bytes >= self.max_bytes)
+        else:
+            # the first position, or a new binlog file
+            save = True
+        self._log_file, self._log_pos = log_file, log_pos
+        self._pos_changed = True
+        if save:
+            self._save_flag.set()
+
+    def _save_log_pos_thread_runner(self):
+        _logger.debug('Start log pos saving thread')
+        while True:
+            self._save_flag.wait(self.max_time)
+            self._save_flag.clear()
+            if self._stopping:
+                break
+            self._events = self._bytes = 0
+            self._save_file_and_pos()
+        _logger.debug('Finish log pos saving thread')
+
+    def start(self):
+        _logger.debug('Start binlog position memory at %s'
+                      % self.pos_storage_filename)
+        self._read_file_and_pos()
+        self._stopping = False
+        attach(self)
+        self.save_log_pos_thread.start()
+
+    def stop(self):
+        detach(self)
+        self._stopping = True
+        self._save_flag.set()
+        # not started when e.g. a with block exits before start()
+        if self.save_log_pos_thread.is_alive():
+            self.save_log_pos_thread.join()
+        _logger.debug('Finish binlog position memory at %s'
+                      % self.pos_storage_filename)
+        self._save_file_and_pos()
+
+
+class GtidBinlogPosMemory(BaseBinlogPosMemory):
+    """ This class stores the set of executed GTIDs into a file.
+
+    It reads the GtidEvents of the stream and adds the GTID of each
+    transaction to the set when the transaction commits (XidEvent, COMMIT,
+    ROLLBACK or a DDL, not a savepoint) and the dispatcher has published a
+    position past that commit.
+    The set is kept as merged intervals (see :py:class:`gtid.GtidSet`) and
+    saved with the binlog position each interval, atomically.
+
+    Replication resumes with ``auto_position``, so it continues from the
+    right transaction on any server of the replication topology, e.g. after
+    a failover. Until the set has a GTID, it resumes from the position.
+
+    Only transactions read are added to the set. When replication starts
+    from a position, give the server's ``gtid_executed`` as *gtid_set*,
+    otherwise resuming with ``auto_position`` would read again the
+    transactions executed before.
+    """
+    only_events = (binlog_event.GtidEvent,
+                   binlog_event.XidEvent,
+                   binlog_event.QueryEvent)
+
+    def __init__(self, pos_filename, interval=2, gtid_set=None):
+        """ Create instance of GtidBinlogPosMemory
+
+        Args:
+            pos_filename (str|None): position storage file. None will makes
+                *mysqlbinlog2blinker.gtid.pos* at current working dir
+            interval (float): the saving interval in second
+            gtid_set (str|None): GTIDs already executed, merged with the
+                set of the file
+        """
+        if not pos_filename:
+            pos_filename = os.path.join(os.getcwd(),
+                                        'mysqlbinlog2blinker.gtid.pos')
+        self.pos_storage_filename = pos_filename
+        self.interval = interval
+        self.gtid_set = GtidSet(gtid_set)
+
+        self._log_file = None
+        self._log_pos = None
+        # (uuid, gno) of the transaction being read
+        self._gtid = None
+        # (log_file, log_pos, uuid, gno) of commits read but not published
+        self._commits = collections.deque()
+        self._changed = False
+        self._lock = threading.Lock()
+
+        self._stop_flag = threading.Event()
+        self._save_thread = None
+
+    @property
+    def log_pos(self):
+        return self._log_pos
+
+    @property
+    def log_file(self):
+        return self._log_file
+
+    def resume_kwargs(self):
+        with self._lock:
+            if not self.gtid_set:
+                return super(GtidBinlogPosMemory, self).resume_kwargs()
+            return {'auto_position': str(self.gtid_set)}
+
+    def handle_event(self, event, stream):
+        if isinstance(event, binlog_event.GtidEvent):
+            uuid, gno = event.gtid.rsplit(':', 1)
+            self._gtid = (uuid, int(gno))
+            return
+        if self._gtid is None:
+            return
+        if isinstance(event, binlog_event.QueryEvent) and \
+                not _ends_transaction(_query_of(event)):
+            return
+        uuid, gno = self._gtid
+        self._gtid = None
+        self._commits.append((stream.log_file, stream.log_pos, uuid, gno))
+
+    def set_binlog_pos(self, log_file, log_pos):
+        self._log_file, self._log_pos = log_file, log_pos
+        self._changed = True
+        commits = self._commits
+        published = _binlog_order(log_file, log_pos)
+        while commits and _binlog_order(*commits[0][:2]) <= published:
+            _, _, uuid, gno = commits.popleft()
+            with self._lock:
+                if not self.gtid_set.intervals(uuid):
+                    _logger.warning('First transaction %s:%d of server is '
+                                    'not in the GTID set, its transactions '
+                                    'before are taken as not executed',
+                                    uuid, gno)
+                self.gtid_set.add(uuid, gno)
+
+    def _save_thread_runner(self):
+        while not self._stop_flag.wait(self.interval):
+            self._save()
+
+    def _save(self):
+        if not self._changed:
+            return
+        self._changed = False
+        started = _timer()
+        with self._lock:
+            data = {'gtid_set': str(self.gtid_set),
+                    'log_file': self._log_file,
+                    'log_pos': self._log_pos}
+        tmp_filename = self.pos_storage_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+        _replace(tmp_filename, self.pos_storage_filename)
+        _stats.observe('position_save_seconds', type(self).__name__,
+                       _timer() - started)
+        _logger.debug('Saved GTID set %s to file %s',
+                      data['gtid_set'], self.pos_storage_filename)
+
+    def _read(self):
+        try:
+            with open(self.pos_storage_filename) as f:
+                data = json.load(f)
+        except IOError as e:
+            _logger.error(e)
+            return
+        except ValueError as e:
+            _logger.critical('Can not read GTID set: %s' % e)
+            sys.exit(13)
+        _logger.debug('Got GTID set "%s" from file %s'
+                      % (data.get('gtid_set'), self.pos_storage_filename))
+        if data.get('gtid_set'):
+            with self._lock:
+                self.gtid_set.update(data['gtid_set'])
+        self._log_file = data.get('log_file')
+        self._log_pos = data.get('log_pos')
+
+    def start(self):
+        _logger.debug('Start GTID memory at %s' % self.pos_storage_filename)
+        self._read()
+        attach(self)
+        self._stop_flag.clear()
+        self._save_thread = threading.Thread(target=self._save_thread_runner)
+        self._save_thread.daemon = True
+        self._save_thread.start()
+
+    def stop(self):
+        detach(self)
+        self._stop_flag.set()
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+        _logger.debug('Finish GTID memory at %s' % self.pos_storage_filename)
+        self._save()
@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+""" Compact binary encoding of converted rows
+
+An :py:class:`Encoder` turns the ``(table_name, rows, meta)`` of an event
+into a message, a :py:class:`Decoder` turns it back into plain row dicts:
+
+    encoder = Encoder()
+    data = encoder.encode(table_name, rows, meta)
+
+    decoder = Decoder()
+    table_name, rows, meta = decoder.decode(data)
+
+Column names and primary key are sent once per table schema: the first
+message of a schema defines it under a small id, the next ones only refer to
+it, so messages must be decoded in the order they were encoded, by a decoder
+which saw the same messages (:py:meth:`Encoder.reset` starts over). Each row
+is then its values in column order, an update row also has the indexes of
+the changed columns with their old and new values.
+
+Values are tagged. None, booleans, integers (of any size), floats, text,
+bytes, ``Decimal``, naive ``datetime``/``date``/``time``, ``timedelta``,
+lists, tuples, sets and dicts are encoded natively, anything else is pickled.
+
+Messages are length prefixed, so they can be concatenated into a stream and
+split again by :py:meth:`Decoder.feed`. ``benchmarks/bench_codec.py``
+compares them with json and pickle.
+"""
+import datetime
+import decimal
+import pickle
+import struct
+
+__author__ = 'tarzan'
+
+_PY2 = str is bytes
+_text_type = type(u'')
+_integer_types = (int, type(2 ** 64))
+
+(_NONE, _TRUE, _FALSE, _INT, _FLOAT, _TEXT, _BYTES, _DECIMAL, _DATETIME,
+ _DATE, _TIME, _TIMEDELTA, _LIST, _TUPLE, _DICT, _SET, _PICKLE) = range(17)
+
+_DOUBLE = struct.Struct('<d')
+#: year, month, day, hour, minute, second, microsecond
+_DATETIME_FIELDS = struct.Struct('<HBBBBBI')
+#: year, month, day
+_DATE_FIELDS = struct.Struct('<HBB')
+#: hour, minute, second, microsecond
+_TIME_FIELDS = struct.Struct('<BBBI')
+
+#: kinds of schemas, rows of updates carry their changed columns
+_PLAIN, _UPDATES = 0, 1
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    shift = n = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _write_text(out, value):
+    encoded = value.encode('utf-8')
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _write_bytes_body(out, value):
+    _write_varint(out, len(value))
+    out += value
+
+
+def _read_text(data, pos):
+    length = data[pos]
+    if length < 0x80:
+        pos += 1
+    else:
+        length, pos = _read_varint(data, pos)
+    end = pos + length
+    return data[pos:end].decode('utf-8'), end
+
+
+def _write_none(out, value):
+    out.append(_NONE)
+
+
+def _write_bool(out, value):
+    out.append(_TRUE if value else _FALSE)
+
+
+def _write_int(out, value):
+    out.append(_INT)
+    # zigzag, so small negative numbers stay short
+    _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _write_float(out, value):
+    out.append(_FLOAT)
+    out += _DOUBLE.pack(value)
+
+
+def _write_text_value(out, value):
+    out.append(_TEXT)
+    _write_text(out, value)
+
+
+def _write_bytes(out, value):
+    out.append(_BYTES)
+    _write_bytes_body(out, value)
+
+
+def _write_decimal(out, value):
+    out.append(_DECIMAL)
+    _write_text(out, str(value))
+
+
+def _write_datetime(out, value):
+    if value.tzinfo is not None:
+        return _write_pickle(out, value)
+    out.append(_DATETIME)
+    out += _DATETIME_FIELDS.pack(value.year, value.month, value.day,
+                                 value.hour, value.minute, value.second,
+                                 value.microsecond)
+
+
+def _write_date(out, value):
+    out.append(_DATE)
+    out += _DATE_FIELDS.pack(value.year, value.month, value.day)
+
+
+def _write_time(out, value):
+    if value.tzinfo is not None:
+        return _write_pickle(out, value)
+    out.append(_TIME)
+    out += _TIME_FIELDS.pack(value.hour, value.minute, value.second,
+                             value.microsecond)
+
+
+def _write_timedelta(out, value):
+    out.append(_TIMEDELTA)
+    days = value.days
+    _write_varint(out, days * 2 if days >= 0 else -days * 2 - 1)
+    _write_varint(out, value.seconds)
+    _write_varint(out, value.microseconds)
+
+
+def _items_writer(tag):
+    def write(out, value):
+        out.append(tag)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    return write
+
+
+def _write_dict(out, value):
+    out.append(_DICT)
+    _write_varint(out, len(value))
+    for key, item in value.items():
+        _write_value(out, key)
+        _write_value(out, item)
+
+
+def _write_pickle(out, value):
+    # e.g. numpy scalars of columnar rows
+    if hasattr(value, 'item') and type(value).__module__ == 'numpy':
+        return _write_value(out, value.item())
+    out.append(_PICKLE)
+    _write_bytes_body(out, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+# type => writer, subclasses are looked up along their MRO then cached
+_WRITERS = {
+    type(None): _write_none,
+    bool: _write_bool,
+    float: _write_float,
+    _text_type: _write_text_value,
+    bytes: _write_bytes,
+    bytearray: _write_bytes,
+    decimal.Decimal: _write_decimal,
+    # before date, which it subclasses
+    datetime.datetime: _write_datetime,
+    datetime.date: _write_date,
+    datetime.time: _write_time,
+    datetime.timedelta: _write_timedelta,
+    list: _items_writer(_LIST),
+    tuple: _items_writer(_TUPLE),
+    set: _items_writer(_SET),
+    frozenset: _items_writer(_SET),
+    dict: _write_dict,
+}
+for _type in _integer_types:
+    _WRITERS[_type] = _write_int
+
+
+def _write_value(out, value):
+    cls = type(value)
+    writer = _WRITERS.get(cls)
+    if writer is None:
+        writer = _write_pickle
+        for base in cls.__mro__[1:]:
+            if base in _WRITERS:
+                writer = _WRITERS[base]
+                break
+        _WRITERS[cls] = writer
+    writer(out, value)
+
+
+def _read_int(data, pos):
+    n = data[pos]
+    if n < 0x80:
+        pos += 1
+    else:
+        n, pos = _read_varint(data, pos)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+
+def _read_bytes(data, pos):
+    length, pos = _read_varint(data, pos)
+    end = pos + length
+    return bytes(data[pos:end]), end
+
+
+def _read_decimal(data, pos):
+    text, pos = _read_text(data, pos)
+    return decimal.Decimal(text), pos
+
+
+def _struct_reader(cls, fields):
+    def read(data, pos):
+        return cls(*fields.unpack_from(data, pos)), pos + fields.size
+    return read
+
+
+def _read_timedelta(data, pos):
+    days, pos = _read_int(data, pos)
+    seconds, pos = _read_varint(data, pos)
+    microseconds, pos = _read_varint(data, pos)
+    return datetime.timedelta(days, seconds, microseconds), pos
+
+
+def _items_reader(cls):
+    def read(data, pos):
+        length, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(length):
+            item, pos = _read_value(data, pos)
+            items.append(item)
+        return (items if cls is list else cls(items)), pos
+    return read
+
+
+def _read_dict(data, pos):
+    length, pos = _read_varint(data, pos)
+    value = {}
+    for _ in range(length):
+        key, pos = _read_value(data, pos)
+        value[key], pos = _read_value(data, pos)
+    return value, pos
+
+
+def _read_pickle(data, pos):
+    value, pos = _read_bytes(data, pos)
+    return pickle.loads(value), pos
+
+
+def _constant_reader(value):
+    def read(data, pos):
+        return value, pos
+    return read
+
+
+# tag => reader
+_READERS = [
+    _constant_reader(None),
+    _constant_reader(True),
+    _constant_reader(False),
+    _read_int,
+    _struct_reader(lambda value: value, _DOUBLE),
+    _read_text,
+    _read_bytes,
+    _read_decimal,
+    _struct_reader(datetime.datetime, _DATETIME_FIELDS),
+    _struct_reader(datetime.date, _DATE_FIELDS),
+    _struct_reader(datetime.time, _TIME_FIELDS),
+    _read_timedelta,
+    _items_reader(list),
+    _items_reader(tuple),
+    _read_dict,
+    _items_reader(set),
+    _read_pickle,
+]
+
+
+def _read_value(data, pos):
+    try:
+        reader = _READERS[data[pos]]
+    except IndexError:
+        raise ValueError('Invalid value tag at %d' % pos)
+    return reader(data, pos + 1)
+
+
+class Encoder(object):
+    """ Encode changes into messages, see module's doc """
+    def __init__(self):
+        # (table_name, names, pk_names, kind) => schema id
+        self._schemas = {}
+
+    def reset(self):
+        """ Forget the schemas sent so far, for a new decoder """
+        self._schemas.clear()
+
+    def encode(self, table_name, rows, meta):
+        """ Encode the rows of an event
+
+        Args:
+            table_name (str): schema.table
+            rows (list[dict]): converted rows, of any row format
+            meta (dict): event's meta, but its *ticket*
+
+        Returns:
+            bytes: the message
+        """
+        if rows:
+            first = rows[0]
+            names = tuple(first['values'])
+            pk_names = tuple(first['keys'])
+            kind = _UPDATES if 'updated_values' in first else _PLAIN
+        else:
+            names = pk_names = ()
+            kind = _PLAIN
+        key = (table_name, names, pk_names, kind)
+
+        body = bytearray()
+        self._write_schema(body, key)
+        _write_rows(body, rows, names, kind)
+
+        if 'ticket' in meta:
+            meta = dict(meta)
+            del meta['ticket']
+        _write_dict(body, meta)
+
+        out = bytearray()
+        _write_varint(out, len(body))
+        out += body
+        return bytes(out)
+
+    def _write_schema(self, body, key):
+        """ Write the id of a schema, with the schema the first time """
+        schema_id = self._schemas.get(key)
+        if schema_id is not None:
+            _write_varint(body, schema_id)
+            body.append(0)
+            return
+        table_name, names, pk_names, kind = key
+        schema_id = self._schemas[key] = len(self._schemas)
+        _write_varint(body, schema_id)
+        body.append(1)
+        _write_text(body, _text(table_name))
+        body.append(kind)
+        for items in (names, pk_names):
+            _write_varint(body, len(items))
+            for name in items:
+                _write_text(body, _text(name))
+
+
+def _write_rows(body, rows, names, kind):
+    """ Write rows whose values are in the order of *names* """
+    _write_varint(body, len(rows))
+    if kind == _UPDATES:
+        indexes = dict((name, i) for i, name in enumerate(names))
+    writers = _WRITERS
+    for row in rows:
+        values = row['values']
+        for name in names:
+            value = values[name]
+            writer = writers.get(value.__class__)
+            if writer is None:
+                _write_value(body, value)
+            else:
+                writer(body, value)
+        if kind == _UPDATES:
+            updated_values = row['updated_values']
+            _write_varint(body, len(updated_values))
+            for name, value in updated_values.items():
+                _write_varint(body, indexes[name])
+                _write_value(body, value)
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+class Decoder(object):
+    """ Decode messages of an :py:class:`Encoder`, see module's doc """
+    def __init__(self):
+        # schema id => (table_name, names, pk_names, kind)
+        self._schemas = {}
+        self._buffer = bytearray()
+
+    def reset(self):
+        """ Forget the schemas, as :py:meth:`Encoder.reset` """
+        self._schemas.clear()
+        del self._buffer[:]
+
+    def decode(self, data):
+        """ Decode one message
+
+        Returns:
+            tuple: (table_name, rows, meta), rows as dicts having *values*,
+                *keys* and, for updates, *updated_values*
+        """
+        if _PY2:
+            data = bytearray(data)
+        _, pos = _read_varint(data, 0)
+        return self._decode_body(data, pos)
+
+    def learn(self, data):
+        """ Only take the schema a message defines, if any, to decode the
+        messages after it
+        """
+        if _PY2:
+            data = bytearray(data)
+        _, pos = _read_varint(data, 0)
+        self._read_schema(data, pos)
+
+    def feed(self, data):
+        """ Decode the messages of a chunk of a stream, keeping an
+        incomplete last message until the next chunk
+
+        Returns:
+            list[tuple]: the (table_name, rows, meta) decoded
+        """
+        buf = self._buffer
+        buf += data
+        changes = []
+        pos = 0
+        while pos < len(buf):
+            try:
+                length, start = _read_varint(buf, pos)
+            except IndexError:
+                break
+            if start + length > len(buf):
+                break
+            changes.append(self._decode_body(buf, start))
+            pos = start + length
+        del buf[:pos]
+        return changes
+
+    def _read_schema(self, data, pos):
+        schema_id, pos = _read_varint(data, pos)
+        defined = data[pos]
+        pos += 1
+        if not defined:
+            try:
+                return self._schemas[schema_id], pos
+            except KeyError:
+                raise ValueError('Unknown schema %d, messages must be '
+                                 'decoded in order' % schema_id)
+        table_name, pos = _read_text(data, pos)
+        kind = data[pos]
+        pos += 1
+        lists = []
+        for _ in range(2):
+            length, pos = _read_varint(data, pos)
+            items = []
+            for _ in range(length):
+                name, pos = _read_text(data, pos)
+                items.append(name)
+            lists.append(tuple(items))
+        schema = self._schemas[schema_id] = \
+            (table_name, lists[0], lists[1], kind)
+        return schema, pos
+
+    def _decode_body(self, data, pos):
+        (table_name, names, pk_names, kind), pos = \
+            self._read_schema(data, pos)
+        count, pos = _read_varint(data, pos)
+        rows = []
+        readers = _READERS
+        for _ in range(count):
+            values = {}
+            for name in names:
+                values[name], pos = readers[data[pos]](data, pos + 1)
+            row = {
+                'values': values,
+                'keys': dict([(name, values[name]) for name in pk_names]),
+            }
+            if kind == _UPDATES:
+                length, pos = _read_varint(data, pos)
+                updated_values = {}
+                for _ in range(length):
+                    i, pos = _read_varint(data, pos)
+                    updated_values[names[i]], pos = _read_value(data, pos)
+                row['updated_values'] = updated_values
+            rows.append(row)
+        meta, pos = _read_value(data, pos)
+        return table_name, rows, meta
@@ -0,0 +1,715 @@
+# -*- coding: utf-8 -*-
+""" Dispatchers deliver converted rows to the rows signals
+
+:py:func:`mysqlbinlog2blinker.start_publishing` converts each RowsEvent into
+``(table_name, rows, meta)`` then hands it to a dispatcher, which decides when
+and how the rows signals are sent. The dispatcher also receives the stream's
+position after each event, so it can hold the position back until the rows
+before it have really been delivered.
+
+The default is :py:class:`ImmediateDispatcher`, which sends everything as soon
+as it comes.
+"""
+import collections
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from pymysqlreplication import event as binlog_event
+
+from mysqlbinlog2blinker import (
+    binlog_pos_memory as _bpm,
+    signals,
+    stats as _stats,
+)
+from mysqlbinlog2blinker.rows import ColumnarRows
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+
+class BaseDispatcher(object):
+    """ Interface of dispatchers """
+
+    #: non rows event classes the dispatcher needs, they are added to
+    #: ``only_events`` of the stream and passed to :py:meth:`handle_event`
+    only_events = ()
+
+    #: the dispatcher takes the rows of every table, with all their
+    #: columns, even the ones that nobody receives
+    all_rows = False
+
+    def dispatch(self, sig, table_name, rows, meta):
+        """ Deliver the rows of an event
+
+        Args:
+            sig (blinker.NamedSignal): rows signal of the event's action
+            table_name (str): schema.table, the signal's sender
+            rows (list[dict]): converted rows
+            meta (dict): event's meta
+        """
+        raise NotImplementedError()
+
+    def position(self, log_file, log_pos):
+        """ Notify the stream's position after an event has been dispatched
+        """
+        raise NotImplementedError()
+
+    def handle_event(self, event, stream):
+        """ Process a non rows event requested via :py:attr:`only_events`
+        """
+        pass
+
+    def flush(self):
+        """ Deliver everything that is still pending """
+        pass
+
+    def close(self):
+        """ Release resources, pending data which is not flushed is dropped
+        """
+        pass
+
+
+class ImmediateDispatcher(BaseDispatcher):
+    """ Send the rows signal and the position right away
+
+    With *receiver_acks*, meta of each rows signal carries a
+    :py:class:`binlog_pos_memory.Ticket` as *ticket*, which each of its
+    receivers must acknowledge (``meta['ticket'].ack()``) once it has
+    processed the rows, e.g. when a write it handed off has completed. The
+    position signal only moves up to the events whose rows are all
+    acknowledged.
+    """
+    def __init__(self, receiver_acks=False):
+        """ Create an ImmediateDispatcher
+
+        Args:
+            receiver_acks (bool): hold positions back until receivers
+                acknowledge the rows
+        """
+        self.receiver_acks = receiver_acks
+        self._tracker = _bpm.AckTracker() if receiver_acks else None
+
+    def dispatch(self, sig, table_name, rows, meta):
+        if self._tracker is not None:
+            meta['ticket'] = self._tracker.ticket(_receiver_acks(
+                sig, table_name))
+        _stats.send(sig, table_name, rows=rows, meta=meta)
+
+    def position(self, log_file, log_pos):
+        if self._tracker is not None:
+            self._tracker.position(log_file, log_pos)
+        else:
+            _bpm.publish_position(log_file, log_pos)
+
+
+def _receiver_acks(sig, table_name):
+    """ Number of acknowledgements a rows signal needs, one per receiver
+    """
+    return sum(1 for _ in sig.receivers_for(table_name))
+
+
+def _row_size(row):
+    """ Roughly estimate the size of a converted row in bytes """
+    size = 0
+    for value in row.get('values', row).values():
+        try:
+            size += len(value)
+        except TypeError:
+            size += 8
+    return size
+
+
+class _Batch(object):
+    __slots__ = ('sig', 'table_name', 'rows', 'meta', 'events',
+                 'size', 'started')
+
+    def __init__(self, sig, table_name, meta):
+        self.sig = sig
+        self.table_name = table_name
+        self.rows = []
+        self.meta = dict(meta,
+                         first_log_file=meta['log_file'],
+                         first_log_pos=meta['log_pos'])
+        self.events = 0
+        self.size = 0
+        self.started = time.time()
+
+
+class BatchingDispatcher(BaseDispatcher):
+    """ Coalesce consecutive events of the same table and action
+
+    The rows of consecutive events which have the same table and action are
+    collected into one batch, which is sent as one rows signal when:
+
+    * it has at least *max_rows* rows, or
+    * its estimated size reaches *max_bytes* bytes, or
+    * it is older than *max_time* seconds, or
+    * an event of another table, action or source comes.
+
+    Besides the usual keys, meta of a batch carries *first_log_file*,
+    *first_log_pos*, *last_log_file*, *last_log_pos* and *events* (number of
+    coalesced events). *log_file* and *log_pos* are the last ones.
+
+    The position signal is held back while a batch is pending, so a saved
+    position never gets ahead of undelivered rows.
+
+    The *max_time* flush runs on a background thread, the rows signals of
+    that batch are sent from there. If a receiver raises there, the error is
+    re-raised by the next call from the publishing thread.
+    """
+    def __init__(self, max_rows=1000, max_bytes=4 * 1024 * 1024,
+                 max_time=1.0):
+        """ Create a BatchingDispatcher
+
+        Args:
+            max_rows (int|None): flush after this number of rows
+            max_bytes (int|None): flush after this estimated size in bytes
+            max_time (float|None): flush a batch older than this in seconds
+        """
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+
+        self._batch = None
+        # source => position held back while the batch is pending
+        self._pending_pos = collections.OrderedDict()
+        self._error = None
+        self._lock = threading.Lock()
+        self._timer_stop_flag = threading.Event()
+        self._timer_thread = None
+
+    def dispatch(self, sig, table_name, rows, meta):
+        if not rows:
+            return
+        with self._lock:
+            self._raise_error()
+            batch = self._batch
+            if batch is not None and (
+                    batch.sig is not sig or batch.table_name != table_name or
+                    batch.meta.get('source') != meta.get('source')):
+                self._flush()
+                batch = None
+            if batch is None:
+                batch = self._batch = _Batch(sig, table_name, meta)
+                self._ensure_timer()
+            batch.rows.extend(rows)
+            batch.events += 1
+            batch.meta.update(time=meta['time'],
+                              log_file=meta['log_file'],
+                              log_pos=meta['log_pos'])
+            if self.max_bytes:
+                batch.size += _row_size(rows[0]) * len(rows)
+
+            if (self.max_rows and len(batch.rows) >= self.max_rows) or \
+                    (self.max_bytes and batch.size >= self.max_bytes):
+                self._flush()
+
+    def position(self, log_file, log_pos):
+        with self._lock:
+            self._raise_error()
+            if self._batch is None:
+                _bpm.publish_position(log_file, log_pos)
+            else:
+                source = _bpm._source_of(log_file)
+                self._pending_pos.pop(source, None)
+                self._pending_pos[source] = (log_file, log_pos)
+
+    def flush(self):
+        with self._lock:
+            self._raise_error()
+            self._flush()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _flush(self):
+        batch, self._batch = self._batch, None
+        if batch is not None:
+            batch.meta.update(last_log_file=batch.meta['log_file'],
+                              last_log_pos=batch.meta['log_pos'],
+                              events=batch.events)
+            _logger.debug('Flush batch of %d rows from %d events of %s',
+                          len(batch.rows), batch.events, batch.table_name)
+            _stats.send(batch.sig, batch.table_name, rows=batch.rows,
+                        meta=batch.meta)
+        while self._pending_pos:
+            _, pos = self._pending_pos.popitem(last=False)
+            _bpm.publish_position(*pos)
+
+    def _ensure_timer(self):
+        if not self.max_time or self._timer_thread is not None:
+            return
+        self._timer_stop_flag.clear()
+        self._timer_thread = threading.Thread(target=self._timer_runner)
+        self._timer_thread.daemon = True
+        self._timer_thread.start()
+
+    def _timer_runner(self):
+        """ Flush the pending batch once it is older than max_time """
+        timeout = self.max_time
+        while not self._timer_stop_flag.wait(timeout):
+            with self._lock:
+                batch = self._batch
+                if batch is None:
+                    timeout = self.max_time
+                    continue
+                age = time.time() - batch.started
+                if age >= self.max_time:
+                    try:
+                        self._flush()
+                    except Exception as e:
+                        _logger.exception('Flushing batch of %s failed',
+                                          batch.table_name)
+                        self._error = e
+                        return
+                    timeout = self.max_time
+                else:
+                    timeout = self.max_time - age
+
+    def close(self):
+        self._timer_stop_flag.set()
+        thread, self._timer_thread = self._timer_thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        with self._lock:
+            self._batch = None
+            self._pending_pos.clear()
+
+
+class _NetChange(object):
+    __slots__ = ('action', 'table_name', 'source', 'values', 'keys',
+                 'before', 'first_meta', 'meta', 'rows', 'first_seq', 'seq')
+
+    def __init__(self, action, table_name, row, meta, seq):
+        self.action = action
+        self.table_name = table_name
+        self.source = meta.get('source')
+        self.values = dict(row['values'])
+        self.keys = dict(row['keys'])
+        # column => value before the window, for updates
+        self.before = {}
+        if action == 'update':
+            for name, (old, _) in row['updated_values'].items():
+                self.before[name] = old
+        self.first_meta = self.meta = meta
+        self.rows = 1
+        # order of arrival of the first and latest changes
+        self.first_seq = self.seq = seq
+
+    def merge(self, action, row, meta, seq):
+        """ Merge a later change of the row
+
+        Returns:
+            bool: False when the row never existed outside of the window or
+                is back to what it was before it
+        """
+        self.rows += 1
+        self.meta = meta
+        self.seq = seq
+        previous = self.action
+        if action == 'update':
+            if previous == 'update':
+                for name, (old, _) in row['updated_values'].items():
+                    self.before.setdefault(name, old)
+            # an inserted row stays inserted, with its latest values
+        elif action == 'delete':
+            if previous == 'insert':
+                return False
+            self.action = 'delete'
+        elif previous == 'delete':
+            # deleted then inserted again: an update of what changed since
+            # before the window
+            before = dict(self.values)
+            before.update(self.before)
+            if before == row['values']:
+                return False
+            self.action = 'update'
+            self.before = before
+        self.values = dict(row['values'])
+        return True
+
+    def row(self):
+        """ Get the net row, None when nothing changed """
+        row = {'values': self.values, 'keys': self.keys}
+        if self.action == 'update':
+            values = self.values
+            updated_values = dict(
+                (name, [old, values[name]])
+                for name, old in self.before.items()
+                if name in values and values[name] != old)
+            if not updated_values:
+                return None
+            row['updated_values'] = updated_values
+        return row
+
+
+class _Window(object):
+    """ Net changes of a :py:class:`CompactingDispatcher` """
+    __slots__ = ('changes', 'started', 'table_name', 'seq')
+
+    def __init__(self):
+        # (source, table_name, keys) => _NetChange, by first change
+        self.changes = collections.OrderedDict()
+        self.started = time.time()
+        # what the timer logs
+        self.table_name = 'compaction window'
+        self.seq = 0
+
+    def add(self, table_name, row, meta):
+        """ Merge a row into the net change of its keys
+
+        Returns:
+            bool: False for a row without primary key or an update of the
+                primary key, which is not merged
+        """
+        action = meta['action']
+        if not row['keys']:
+            return False
+        if action == 'update' and \
+                any(name in row['updated_values'] for name in row['keys']):
+            return False
+        self.seq += 1
+        key = (meta.get('source'), table_name,
+               tuple(sorted(row['keys'].items())))
+        change = self.changes.get(key)
+        if change is None:
+            self.changes[key] = _NetChange(action, table_name, row, meta,
+                                           self.seq)
+        elif not change.merge(action, row, meta, self.seq):
+            del self.changes[key]
+        return True
+
+    def net_rows(self):
+        """ Get the rows signals of the net changes, consecutive changes of
+        the same table and action share one
+
+        Returns:
+            list[tuple]: (sig, table_name, rows, meta)
+        """
+        groups = []
+        for change in self.changes.values():
+            row = change.row()
+            if row is None:
+                continue
+            group = groups[-1] if groups else None
+            if group is None or group[0] != (change.action, change.table_name,
+                                             change.source):
+                group = ((change.action, change.table_name, change.source),
+                         [], [])
+                groups.append(group)
+            group[1].append(row)
+            group[2].append(change)
+
+        signals_by_action = {
+            'insert': signals.rows_inserted,
+            'update': signals.rows_updated,
+            'delete': signals.rows_deleted,
+        }
+        result = []
+        for (action, table_name, _), rows, changes in groups:
+            last = max(changes, key=lambda change: change.seq).meta
+            first = min(changes,
+                        key=lambda change: change.first_seq).first_meta
+            meta = dict(last, action=action,
+                        first_log_file=first['log_file'],
+                        first_log_pos=first['log_pos'],
+                        last_log_file=last['log_file'],
+                        last_log_pos=last['log_pos'],
+                        compacted_rows=sum(c.rows for c in changes))
+            meta.pop('ticket', None)
+            result.append((signals_by_action[action], table_name, rows,
+                           meta))
+        return result
+
+
+class CompactingDispatcher(BatchingDispatcher):
+    """ Send the net change of each row over a time window
+
+    Rows are buffered for *window* seconds by source, table and primary key
+    (their *keys*), the changes of a key are collapsed into one:
+
+    * insert then updates: one insert with the latest values
+    * updates: one update, *updated_values* having the value of each changed
+      column before the window and its latest value. It is dropped when the
+      values are back to where they were
+    * insert then delete: nothing
+    * update then delete: the delete
+    * delete then insert: an update of what changed
+
+    Then the rows signals are sent, in order of the first change of each key,
+    consecutive net changes of the same table and action in one signal. Meta
+    is the one of the latest change, with the net *action*,
+    *first_log_file*, *first_log_pos*, *last_log_file*, *last_log_pos* and
+    *compacted_rows* (number of rows collapsed into the signal's rows).
+
+    The position signal is held back until the window is sent, so a saved
+    position never gets ahead of buffered changes. Receivers see neither the
+    intermediate states of a row nor transaction boundaries. A row of a
+    table without primary key, or an update of the primary key, sends the
+    window, then itself as is.
+    """
+    def __init__(self, window=1.0, max_keys=100000):
+        """ Create a CompactingDispatcher
+
+        Args:
+            window (float|None): seconds changes are buffered, None only
+                sends them on *max_keys* and when the dispatcher is flushed
+            max_keys (int|None): also send the window once it holds net
+                changes of that many keys
+        """
+        super(CompactingDispatcher, self).__init__(
+            max_rows=None, max_bytes=None, max_time=window)
+        self.window = window
+        self.max_keys = max_keys
+
+    def dispatch(self, sig, table_name, rows, meta):
+        with self._lock:
+            self._raise_error()
+            for row in rows:
+                if self._batch is None:
+                    self._batch = _Window()
+                    self._ensure_timer()
+                if not self._batch.add(table_name, row, meta):
+                    self._flush()
+                    _stats.send(sig, table_name, rows=[row], meta=meta)
+            if self.max_keys and self._batch is not None and \
+                    len(self._batch.changes) >= self.max_keys:
+                self._flush()
+
+    def _flush(self):
+        window, self._batch = self._batch, None
+        if window is not None:
+            net_rows = window.net_rows()
+            _logger.debug('Flush %d net changes of %d rows',
+                          sum(len(rows) for _, _, rows, _ in net_rows),
+                          window.seq)
+            for sig, table_name, rows, meta in net_rows:
+                _stats.send(sig, table_name, rows=rows, meta=meta)
+        while self._pending_pos:
+            _, pos = self._pending_pos.popitem(last=False)
+            _bpm.publish_position(*pos)
+
+
+class TransactionDispatcher(BaseDispatcher):
+    """ Buffer row changes of a transaction and emit them at its commit
+
+    A transaction starts at a ``BEGIN`` QueryEvent and ends at a XidEvent
+    (or a ``COMMIT`` or ``ROLLBACK`` QueryEvent for non transactional tables,
+    or a DDL), savepoints are part of it. At the end,
+    :py:data:`signals.transaction_signal` is sent once with the changes of
+    every table, in binlog order.
+
+    The position signal only moves forward at commits, so a saved position
+    is never in the middle of a transaction.
+    """
+    only_events = (binlog_event.QueryEvent, binlog_event.XidEvent)
+
+    def __init__(self, send_rows_signals=True):
+        """ Create a TransactionDispatcher
+
+        Args:
+            send_rows_signals (bool): also send the rows signals of each
+                change at commit, before the transaction signal
+        """
+        self.send_rows_signals = send_rows_signals
+        self._changes = []
+        self._in_transaction = False
+        self._begin_pos = None
+
+    def dispatch(self, sig, table_name, rows, meta):
+        self._changes.append((sig, table_name, rows, meta))
+
+    def position(self, log_file, log_pos):
+        if not self._in_transaction and not self._changes:
+            _bpm.publish_position(log_file, log_pos)
+
+    def handle_event(self, event, stream):
+        if isinstance(event, binlog_event.XidEvent):
+            self._commit(event, stream, xid=event.xid)
+        elif isinstance(event, binlog_event.QueryEvent):
+            query = _bpm._query_of(event)
+            if query == 'BEGIN':
+                self._in_transaction = True
+                self._begin_pos = (stream.log_file, stream.log_pos)
+            elif _bpm._ends_transaction(query):
+                self._commit(event, stream, xid=None)
+
+    def _commit(self, event, stream, xid):
+        changes, self._changes = self._changes, []
+        self._in_transaction = False
+        begin_pos, self._begin_pos = self._begin_pos, None
+        if not changes:
+            return
+
+        if self.send_rows_signals:
+            for sig, table_name, rows, meta in changes:
+                _stats.send(sig, table_name, rows=rows, meta=meta)
+
+        meta = {
+            'xid': xid,
+            'time': event.timestamp,
+            'log_file': stream.log_file,
+            'log_pos': stream.log_pos,
+            'begin_log_file': begin_pos[0] if begin_pos else None,
+            'begin_log_pos': begin_pos[1] if begin_pos else None,
+        }
+        _stats.send(
+            signals.transaction_signal,
+            [(table_name, rows, _meta)
+             for _, table_name, rows, _meta in changes],
+            meta=meta,
+        )
+
+    def close(self):
+        self._changes = []
+        self._in_transaction = False
+        self._begin_pos = None
+
+
+_STOP = object()
+
+
+def _partition_key(table_name, row):
+    """ Get a hashable key of a row's primary key """
+    keys = row['keys']
+    return table_name, tuple(sorted(keys.items()))
+
+
+class ThreadPoolDispatcher(BaseDispatcher):
+    """ Send rows signals concurrently on a pool of worker threads
+
+    Rows are partitioned by their primary key (``row['keys']``) onto the
+    workers, each worker has its own bounded FIFO queue, so changes of the
+    same row are always delivered in order while other rows go in parallel.
+    An event's rows are split into one rows signal per worker, each with
+    its own copy of meta. :py:class:`rows.ColumnarRows` stay column by
+    column, split with :py:meth:`rows.ColumnarRows.take`.
+
+    When the queue of a worker is full, dispatching blocks, so a slow
+    receiver slows reading down instead of piling up memory.
+
+    If a receiver raises, the worker stops delivering and the error is
+    re-raised in the publishing thread by the next call.
+
+    Every rows signal takes a :py:class:`binlog_pos_memory.Ticket` which is
+    acknowledged once its receivers have returned, or by a receiver itself
+    with *receiver_acks* (see :py:class:`ImmediateDispatcher`). The position
+    signal only moves up to the contiguous low-watermark of acknowledged
+    events, so a saved position never gets ahead of undelivered rows.
+    """
+    def __init__(self, workers=4, queue_size=1000, receiver_acks=False):
+        """ Create a ThreadPoolDispatcher
+
+        Args:
+            workers (int): number of worker threads
+            queue_size (int): max pending rows signals per worker
+            receiver_acks (bool): receivers acknowledge the rows via
+                ``meta['ticket']`` instead of the workers
+        """
+        assert workers > 0
+        self.workers = workers
+        self.queue_size = queue_size
+        self.receiver_acks = receiver_acks
+        self._tracker = _bpm.AckTracker()
+        self._queues = []
+        self._threads = []
+        self._error = None
+
+    def _start(self):
+        for i in range(self.workers):
+            q = queue.Queue(self.queue_size)
+            thread = threading.Thread(target=self._worker_runner, args=(q, ),
+                                      name='mysqlbinlog2blinker-worker-%d' % i)
+            thread.daemon = True
+            self._queues.append(q)
+            self._threads.append(thread)
+            thread.start()
+
+    def _worker_runner(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                if self._error is not None:
+                    continue
+                sig, table_name, rows, meta, ticket = item
+                try:
+                    _stats.send(sig, table_name, rows=rows, meta=meta)
+                    if not self.receiver_acks:
+                        ticket.ack()
+                except Exception as e:
+                    _logger.exception('Sending %s of %s failed',
+                                      sig.name, table_name)
+                    self._error = e
+            finally:
+                q.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def dispatch(self, sig, table_name, rows, meta):
+        self._raise_error()
+        if not self._threads:
+            self._start()
+
+        parts = self._partitions(table_name, rows)
+        acks = _receiver_acks(sig, table_name) if self.receiver_acks else 1
+        for idx, part in parts.items():
+            ticket = self._tracker.ticket(acks)
+            part_meta = meta
+            if len(parts) > 1 or self.receiver_acks:
+                part_meta = dict(meta)
+            if self.receiver_acks:
+                part_meta['ticket'] = ticket
+            self._queues[idx].put((sig, table_name, part, part_meta, ticket))
+
+    def _partitions(self, table_name, rows):
+        """ Split rows by worker
+
+        Returns:
+            dict: worker's index => its rows
+        """
+        n = self.workers
+        if n == 1:
+            return {0: rows}
+        if isinstance(rows, ColumnarRows):
+            indexes = {}
+            for i, key in enumerate(rows.key_values()):
+                indexes.setdefault(hash((table_name, key)) % n, []).append(i)
+            if len(indexes) == 1:
+                return dict.fromkeys(indexes, rows)
+            return dict((idx, rows.take(part))
+                        for idx, part in indexes.items())
+        parts = {}
+        for row in rows:
+            idx = hash(_partition_key(table_name, row)) % n
+            parts.setdefault(idx, []).append(row)
+        return parts
+
+    def position(self, log_file, log_pos):
+        self._raise_error()
+        self._tracker.position(log_file, log_pos)
+
+    def flush(self):
+        """ Wait until the workers have delivered every pending rows """
+        for q in self._queues:
+            q.join()
+        self._raise_error()
+
+    def close(self):
+        """ Stop the workers once they have delivered the queued rows """
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._queues, self._threads = [], []
+        self._tracker.reset()
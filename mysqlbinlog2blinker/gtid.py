@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+""" GTID sets, kept as merged intervals per server UUID
+
+A set only holds, for each server UUID, a sorted list of disjoint
+``[start, end]`` intervals of transaction numbers. Adding the next
+transaction of a server, which is by far the most common case, extends its
+last interval in place, so the set stays as small as MySQL's own
+``gtid_executed`` whatever the number of transactions.
+
+    >>> gtids = GtidSet('3e11fa47-71ca-11e1-9e33-c80aa9429562:1-5')
+    >>> gtids.add('3e11fa47-71ca-11e1-9e33-c80aa9429562', 6)
+    >>> gtids.add('3e11fa47-71ca-11e1-9e33-c80aa9429562', 9)
+    >>> str(gtids)
+    '3e11fa47-71ca-11e1-9e33-c80aa9429562:1-6:9'
+"""
+import bisect
+
+__author__ = 'tarzan'
+
+
+class GtidSet(object):
+    """ A set of GTIDs, see module's doc """
+    def __init__(self, gtids=None):
+        """ Create a GtidSet
+
+        Args:
+            gtids (str|None): a GTID set in MySQL's text format, e.g.
+                ``uuid:1-5:7,uuid2:1-3``
+        """
+        # server uuid => sorted disjoint [start, end] intervals
+        self._intervals = {}
+        if gtids:
+            self.update(gtids)
+
+    def update(self, gtids):
+        """ Add the GTIDs of a set in MySQL's text format """
+        for part in gtids.replace('\n', '').split(','):
+            part = part.strip()
+            if not part:
+                continue
+            fields = part.split(':')
+            uuid = fields[0].strip()
+            for interval in fields[1:]:
+                start, _, end = interval.strip().partition('-')
+                self.add_interval(uuid, int(start), int(end or start))
+
+    def add(self, uuid, gno):
+        """ Add the transaction *gno* of server *uuid* """
+        uuid = uuid.lower()
+        intervals = self._intervals.get(uuid)
+        if intervals:
+            last = intervals[-1]
+            if last[1] + 1 == gno:
+                last[1] = gno
+                return
+            if last[1] + 1 < gno:
+                intervals.append([gno, gno])
+                return
+        self.add_interval(uuid, gno, gno)
+
+    def add_interval(self, uuid, start, end):
+        """ Add transactions *start* to *end* (included) of server *uuid* """
+        if start > end:
+            raise ValueError('Invalid interval %d-%d' % (start, end))
+        uuid = uuid.lower()
+        intervals = self._intervals.setdefault(uuid, [])
+        i = bisect.bisect_left(intervals, [start, end])
+        # merge with the previous interval when they overlap or touch
+        if i > 0 and intervals[i - 1][1] + 1 >= start:
+            i -= 1
+            start = intervals[i][0]
+            end = max(end, intervals[i][1])
+        j = i
+        while j < len(intervals) and intervals[j][0] <= end + 1:
+            end = max(end, intervals[j][1])
+            j += 1
+        intervals[i:j] = [[start, end]]
+
+    def contains(self, uuid, gno):
+        """ Get whether transaction *gno* of server *uuid* is in the set """
+        intervals = self._intervals.get(uuid.lower(), ())
+        i = bisect.bisect_right(intervals, [gno, float('inf')])
+        return i > 0 and intervals[i - 1][1] >= gno
+
+    def intervals(self, uuid):
+        """ Get the (start, end) intervals of server *uuid* """
+        return [tuple(interval)
+                for interval in self._intervals.get(uuid.lower(), ())]
+
+    def copy(self):
+        gtids = GtidSet()
+        gtids._intervals = dict((uuid, [list(i) for i in intervals])
+                                for uuid, intervals
+                                in self._intervals.items())
+        return gtids
+
+    def __len__(self):
+        """ Number of transactions in the set """
+        return sum(end - start + 1 for intervals in self._intervals.values()
+                   for start, end in intervals)
+
+    def __bool__(self):
+        return any(self._intervals.values())
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if not isinstance(other, GtidSet):
+            return NotImplemented
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __str__(self):
+        return ','.join(
+            '%s:%s' % (uuid, ':'.join('%d' % start if start == end else
+                                      '%d-%d' % (start, end)
+                                      for start, end in intervals))
+            for uuid, intervals in sorted(self._intervals.items())
+            if intervals
+        )
+
+    def __repr__(self):
+        return 'GtidSet(%r)' % str(self)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+""" Replicate from several MySQL servers in one process
+
+Each :py:class:`Source` is a named server with its own binlog stream, read
+(and its rows converted) by its own thread, and its own position memory.
+The publishing thread takes the events of the sources in turn, one event
+of each source having some, so a busy source does not starve the others,
+and hands them to one shared dispatcher:
+
+    start_multi_source_replication([
+        Source('shard%d' % i, {'host': 'db%d' % i, 'user': 'root'})
+        for i in range(16)
+    ], dispatcher=dispatchers.BatchingDispatcher())
+
+Meta of the rows signals carries the source's name as *source*. Positions
+carry it too (see :py:class:`binlog_pos_memory.SourceLogFile`), so
+whatever the dispatcher, each position gets to the memory of its source.
+
+:py:class:`dispatchers.TransactionDispatcher` can not be shared, events of
+different sources would interleave within its transactions.
+"""
+import logging
+import os
+import threading
+
+from pymysqlreplication import row_event
+
+import mysqlbinlog2blinker as _publisher
+from mysqlbinlog2blinker import (
+    _subscribers,
+    binlog_pos_memory as _bpm,
+    dispatchers,
+    signals,
+)
+from mysqlbinlog2blinker.pipeline import _Channel, _Stopped, _StreamPosition
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class Source(object):
+    """ A MySQL server to replicate from """
+    def __init__(self, name, mysql_settings, binlog_pos_memory=None,
+                 **kwargs):
+        """ Create a Source
+
+        Args:
+            name (str): name of the source, it is *source* of meta
+            mysql_settings (dict): information to connect to mysql via
+                pymysql
+            binlog_pos_memory (_bpm.BaseBinlogPosMemory|tuple|None): see
+                :py:func:`mysqlbinlog2blinker.start_replication`, None
+                saves to *mysqlbinlog2blinker.<name>.binlog.pos* at current
+                working dir
+            **kwargs: arguments of
+                :py:class:`pymysqlreplication.BinLogStreamReader`
+        """
+        self.name = name
+        self.mysql_settings = mysql_settings
+        if binlog_pos_memory is None:
+            binlog_pos_memory = (os.path.join(
+                os.getcwd(), 'mysqlbinlog2blinker.%s.binlog.pos' % name), 2)
+        self.binlog_pos_memory = \
+            _publisher._make_binlog_pos_memory(binlog_pos_memory)
+        self.binlog_pos_memory.source = name
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return 'Source(%r)' % self.name
+
+
+def _reader_runner(name, stream, output, ready):
+    """ Read and convert the events of source *name* """
+    def put(item):
+        output.put(item)
+        ready.release()
+
+    try:
+        for event in stream:
+            position = _StreamPosition(
+                stream, _bpm.SourceLogFile(stream.log_file, name),
+                stream.log_pos)
+            converted = None
+            if isinstance(event, row_event.RowsEvent):
+                converted = _subscribers._convert_event(event, position)
+                if converted is not _subscribers._UNSUBSCRIBED:
+                    converted[1]['source'] = name
+            put((event, position, converted))
+        put(_END)
+    except _Stopped:
+        pass
+    except Exception as e:
+        _logger.exception('Reading binlog stream of %s failed', name)
+        try:
+            put(e)
+        except _Stopped:
+            pass
+
+
+def _publish_sources(streams, dispatcher=None, queue_size=1000,
+                     row_format='dict', columnar_min_rows=1):
+    """ Publish events of several streams, taking them in turn
+
+    Args:
+        streams (list[tuple]): (name, stream) of the sources, a stream is
+            like for :py:func:`mysqlbinlog2blinker._publish`
+        others: see :py:func:`start_multi_source_replication`
+    """
+    dispatcher = dispatcher or dispatchers.ImmediateDispatcher()
+    stop_flag = threading.Event()
+    # released once per item put by any reader
+    ready = threading.Semaphore(0)
+    channels = [_Channel(queue_size, stop_flag) for _ in streams]
+
+    previous_row_format = _subscribers.set_row_format(row_format,
+                                                      columnar_min_rows)
+    previous_dispatcher = _subscribers.set_dispatcher(dispatcher)
+    try:
+        for (name, stream), channel in zip(streams, channels):
+            thread = threading.Thread(
+                target=_reader_runner, args=(name, stream, channel, ready),
+                name='mysqlbinlog2blinker-reader-%s' % name)
+            thread.daemon = True
+            thread.start()
+
+        active = list(channels)
+        turn = 0
+        while active:
+            ready.acquire()
+            # the first source, from the one after the last served, which
+            # has an event
+            for i in range(len(active)):
+                served = (turn + i) % len(active)
+                if not active[served].queue.empty():
+                    break
+            item = active[served].get()
+            if item is _END:
+                del active[served]
+                turn = served % len(active) if active else 0
+                continue
+            turn = (served + 1) % len(active)
+            if isinstance(item, Exception):
+                raise item
+            event, position, converted = item
+            if converted is None:
+                _bpm.handle_event(event, position)
+                dispatcher.handle_event(event, position)
+            else:
+                _subscribers._precomputed[id(event)] = converted
+                try:
+                    signals.binlog_signal.send(event, stream=position)
+                finally:
+                    _subscribers._precomputed.pop(id(event), None)
+            dispatcher.position(position.log_file, position.log_pos)
+        dispatcher.flush()
+    finally:
+        stop_flag.set()
+        dispatcher.close()
+        _subscribers.set_dispatcher(previous_dispatcher)
+        _subscribers.set_row_format(*previous_row_format)
+
+
+def start_multi_source_replication(sources, dispatcher=None, queue_size=1000,
+                                   only_subscribed_tables=True,
+                                   row_format='dict', columnar_min_rows=1):
+    """ Start replication from several sources
+
+    Each source resumes from the position in its own memory.
+
+    Args:
+        sources (list[Source]): the sources, their names must be unique
+        dispatcher (dispatchers.BaseDispatcher): shared by all sources, see
+            :py:func:`mysqlbinlog2blinker.start_publishing`
+        queue_size (int): max events read ahead per source, reading of a
+            source pauses when it is reached
+        only_subscribed_tables (bool): see
+            :py:func:`mysqlbinlog2blinker.start_publishing`
+        row_format (str): see :py:func:`mysqlbinlog2blinker.start_publishing`
+        columnar_min_rows (int): see
+            :py:func:`mysqlbinlog2blinker.start_publishing`
+    """
+    names = [source.name for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError('Source names must be unique: %s' % names)
+    if isinstance(dispatcher, dispatchers.TransactionDispatcher):
+        raise ValueError('TransactionDispatcher can not be shared by sources')
+
+    started = []
+    try:
+        streams = []
+        for source in sources:
+            memory = source.binlog_pos_memory
+            memory.start()
+            started.append(memory)
+
+            source.mysql_settings.setdefault('connect_timeout', 5)
+            kwargs = dict(source.kwargs)
+            kwargs.setdefault('blocking', True)
+            kwargs.setdefault('resume_stream', True)
+            for key, value in memory.resume_kwargs().items():
+                kwargs.setdefault(key, value)
+            _logger.info('Start replication of %s from %s with:\n%s'
+                         % (source.name, source.mysql_settings, kwargs))
+            streams.append((source.name, _publisher._make_stream(
+                source.mysql_settings, dispatcher, only_subscribed_tables,
+                **kwargs)))
+
+        _publish_sources(streams, dispatcher, queue_size, row_format,
+                         columnar_min_rows)
+    finally:
+        for memory in reversed(started):
+            memory.stop()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+""" Read, convert and dispatch binlog events in overlapping stages
+
+By default, :py:func:`mysqlbinlog2blinker.start_publishing` reads an event
+from the network, converts its rows, then sends the signals, one event after
+another. With a :py:class:`Pipeline`, these are 3 stages joined by bounded
+queues, so reading the next events overlaps converting and dispatching the
+previous ones:
+
+1. *read*: a thread iterates the binlog stream
+2. *convert*: a thread converts rows events like the binlog signal's
+   receiver does
+3. *dispatch*: the publishing thread sends the binlog signal and hands the
+   converted rows and positions to the dispatcher, in binlog order
+
+    pipeline = Pipeline(queue_size=1000)
+    start_replication(mysql_settings, pipeline=pipeline)
+
+    pipeline.stats()
+
+Events carry the stream's position as it was when they were read, so
+positions are the same as without the pipeline.
+"""
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from pymysqlreplication import row_event
+
+from mysqlbinlog2blinker import (
+    _subscribers,
+    binlog_pos_memory as _bpm,
+    signals,
+)
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+_END = object()
+
+
+class _Stopped(Exception):
+    """ The pipeline is stopping """
+
+
+class _StreamPosition(object):
+    """ The stream as it was when an event was read """
+    def __init__(self, stream, log_file, log_pos):
+        self._stream = stream
+        self.log_file = log_file
+        self.log_pos = log_pos
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _Channel(object):
+    """ Bounded queue between 2 stages, which measures time spent waiting """
+    def __init__(self, size, stop_flag):
+        self.queue = queue.Queue(size)
+        self.items = 0
+        self.max_depth = 0
+        self.put_blocked_seconds = 0.0
+        self.get_blocked_seconds = 0.0
+        self._stop_flag = stop_flag
+
+    def put(self, item):
+        q = self.queue
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            started = _timer()
+            while True:
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    if self._stop_flag.is_set():
+                        raise _Stopped()
+            self.put_blocked_seconds += _timer() - started
+        self.items += 1
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def get(self):
+        q = self.queue
+        try:
+            return q.get_nowait()
+        except queue.Empty:
+            started = _timer()
+            while True:
+                try:
+                    item = q.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self._stop_flag.is_set():
+                        raise _Stopped()
+            self.get_blocked_seconds += _timer() - started
+            return item
+
+
+class Pipeline(object):
+    """ Run reading, converting and dispatching of events concurrently """
+    def __init__(self, queue_size=1000):
+        """ Create a Pipeline
+
+        Args:
+            queue_size (int): max events waiting between 2 stages, a stage
+                blocks when its output queue is full
+        """
+        assert queue_size > 0
+        self.queue_size = queue_size
+        self._stop_flag = threading.Event()
+        self._read = _Channel(queue_size, self._stop_flag)
+        self._converted = _Channel(queue_size, self._stop_flag)
+        self._dispatched = 0
+
+    def stats(self):
+        """ Get stats of the stages
+
+        Returns:
+            dict: stage => dict of *items* (events that went out of the
+                stage), *queue_depth* and *max_queue_depth* of its output
+                queue, *blocked_seconds* spent waiting for room in that queue
+                and *idle_seconds* spent waiting for input
+        """
+        read, converted = self._read, self._converted
+        return {
+            'read': {
+                'items': read.items,
+                'queue_depth': read.queue.qsize(),
+                'max_queue_depth': read.max_depth,
+                'blocked_seconds': read.put_blocked_seconds,
+            },
+            'convert': {
+                'items': converted.items,
+                'queue_depth': converted.queue.qsize(),
+                'max_queue_depth': converted.max_depth,
+                'blocked_seconds': converted.put_blocked_seconds,
+                'idle_seconds': read.get_blocked_seconds,
+            },
+            'dispatch': {
+                'items': self._dispatched,
+                'idle_seconds': converted.get_blocked_seconds,
+            },
+        }
+
+    @staticmethod
+    def _reader_runner(stream, output):
+        try:
+            for event in stream:
+                output.put((event, _StreamPosition(
+                    stream, stream.log_file, stream.log_pos)))
+            output.put(_END)
+        except _Stopped:
+            pass
+        except Exception as e:
+            _logger.exception('Reading binlog stream failed')
+            try:
+                output.put(e)
+            except _Stopped:
+                pass
+
+    @staticmethod
+    def _converter_runner(source, output):
+        try:
+            while True:
+                item = source.get()
+                if item is _END or isinstance(item, Exception):
+                    output.put(item)
+                    return
+                event, position = item
+                converted = None
+                if isinstance(event, row_event.RowsEvent):
+                    converted = _subscribers._convert_event(event, position)
+                output.put((event, position, converted))
+        except _Stopped:
+            pass
+        except Exception as e:
+            _logger.exception('Converting binlog event failed')
+            try:
+                output.put(e)
+            except _Stopped:
+                pass
+
+    def run(self, stream, dispatcher):
+        """ Publish events of *stream* via *dispatcher*, it is called by
+        :py:func:`mysqlbinlog2blinker.start_publishing`
+        """
+        # threads of a previous run may still be stopping, they keep their
+        # own flag and channels
+        stop_flag = self._stop_flag = threading.Event()
+        read_q = self._read = _Channel(self.queue_size, stop_flag)
+        converted_q = self._converted = _Channel(self.queue_size, stop_flag)
+        self._dispatched = 0
+        reader = threading.Thread(target=self._reader_runner,
+                                  args=(stream, read_q),
+                                  name='mysqlbinlog2blinker-reader')
+        converter = threading.Thread(target=self._converter_runner,
+                                     args=(read_q, converted_q),
+                                     name='mysqlbinlog2blinker-converter')
+        for thread in (reader, converter):
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                item = converted_q.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                event, position, converted = item
+                if converted is None:
+                    # non row events are only yielded when the dispatcher
+                    # wants them
+                    _bpm.handle_event(event, position)
+                    dispatcher.handle_event(event, position)
+                else:
+                    _subscribers._precomputed[id(event)] = converted
+                    try:
+                        signals.binlog_signal.send(event, stream=position)
+                    finally:
+                        _subscribers._precomputed.pop(id(event), None)
+                dispatcher.position(position.log_file, position.log_pos)
+                self._dispatched += 1
+        finally:
+            stop_flag.set()
+            converter.join()
+            # the reader may be blocked reading the network, it is a daemon
+            # thread and stops at its next event
+            reader.join(0.2)
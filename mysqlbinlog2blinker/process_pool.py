@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+""" Run CPU bound receivers of the rows signals in worker processes
+
+Threads do not help receivers that are CPU bound, because of the GIL. A
+:py:class:`ProcessPoolFanout` lets such receivers run in a pool of worker
+processes:
+
+    fanout = ProcessPoolFanout(workers=4, partition='key')
+
+    @fanout.on_rows_updated(sender='db.orders')
+    def enrich(table_name, rows, meta):
+        pass
+
+    with fanout:
+        start_replication(mysql_settings)
+
+In the main process, the fanout receives the rows signals for the registered
+senders and ships rows/meta to the workers encoded by :py:mod:`codec`:
+column names once per table schema and the values of each row. In each
+worker, the registered receivers are connected to the same rows signals,
+which are sent with the rebuilt rows.
+
+Receivers must be importable (module level) functions, so they can be
+pickled when processes are spawned.
+
+Batches of the same table (``partition='table'``) or rows of the same
+primary key (``partition='key'``) always go to the same worker, through a
+FIFO queue, so they are processed in order.
+
+When the dispatcher gives tickets to receivers (``receiver_acks=True``, see
+:py:mod:`mysqlbinlog2blinker.dispatchers`), the fanout acknowledges a ticket
+once the workers have processed all of its rows, so the saved position does
+not get ahead of rows still in the workers' queues.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+
+import blinker
+
+from mysqlbinlog2blinker import codec, signals
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _worker_main(registrations, q, done_q, errors):
+    """ Entry of worker processes: send received batches to the receivers,
+    report ids of the processed batches which carry one on *done_q*
+    """
+    for sig_name, sender, receiver in registrations:
+        signals.ROWS_SIGNALS[sig_name].connect(receiver, sender=sender,
+                                               weak=False)
+    decoder = codec.Decoder()
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        payload, batch_id = item
+        table_name, rows, meta = decoder.decode(payload)
+        sig_name = signals.ACTION_SIGNAL_NAMES[meta['action']]
+        sig = signals.ROWS_SIGNALS[sig_name]
+        try:
+            sig.send(table_name, rows=rows, meta=meta)
+            if batch_id is not None:
+                done_q.put(batch_id)
+        except Exception:
+            _logger.exception('Sending %s of %s failed in worker process',
+                              sig_name, table_name)
+            with errors.get_lock():
+                errors.value += 1
+
+
+class ProcessPoolFanout(object):
+    """ Ship rows signals to receivers that run in worker processes """
+    def __init__(self, workers=2, partition='table', queue_size=1000):
+        """ Create a ProcessPoolFanout
+
+        Args:
+            workers (int): number of worker processes
+            partition (str): *table* sends all rows of a table to the same
+                worker, *key* spreads rows by primary key
+            queue_size (int): max pending batches per worker, shipping
+                blocks when it is full
+        """
+        if partition not in ('table', 'key'):
+            raise ValueError('Invalid partition "%s"' % partition)
+        assert workers > 0
+        self.workers = workers
+        self.partition = partition
+        self.queue_size = queue_size
+
+        self._registrations = []
+        self._queues = []
+        self._processes = []
+        # per worker, (codec.Encoder, lock keeping encoding and queuing in
+        # the same order)
+        self._encoders = []
+        self._errors = multiprocessing.Value('i', 0)
+        self._stats = dict(batches=0, rows=0, bytes=0, serialize_seconds=0.0)
+
+        # batch id => ticket of the rows signal, acknowledged by the
+        # collector thread when a worker reports the batch done
+        self._tickets = {}
+        self._batch_ids = 0
+        self._done_q = None
+        self._collector = None
+
+    def connect(self, sig, receiver, sender=blinker.ANY):
+        """ Register *receiver* of rows signal *sig* to run in the workers
+
+        It must be called before :py:meth:`start`.
+        """
+        if sig.name not in signals.ROWS_SIGNALS:
+            raise ValueError('Only rows signals are supported, not %s'
+                             % sig.name)
+        if self._processes:
+            raise RuntimeError('Can not connect receivers once started')
+        self._registrations.append((sig.name, sender, receiver))
+        return receiver
+
+    def _connector(sig):
+        def connect(self, receiver=None, sender=blinker.ANY):
+            if receiver is None:
+                return lambda fn: self.connect(sig, fn, sender)
+            return self.connect(sig, receiver, sender)
+        connect.__doc__ = 'Register a receiver of %s, may be a decorator' \
+                          % sig.name
+        return connect
+
+    on_rows_inserted = _connector(signals.rows_inserted)
+    on_rows_updated = _connector(signals.rows_updated)
+    on_rows_deleted = _connector(signals.rows_deleted)
+    del _connector
+
+    def stats(self):
+        """ Get shipping stats: batches, rows, pickled bytes, time spent
+        serializing, bytes per row and receiver errors in workers """
+        stats = dict(self._stats)
+        stats['bytes_per_row'] = \
+            float(stats['bytes']) / stats['rows'] if stats['rows'] else 0.0
+        stats['errors'] = self._errors.value
+        return stats
+
+    def start(self):
+        self._done_q = multiprocessing.Queue()
+        self._collector = threading.Thread(target=self._collector_runner,
+                                           args=(self._done_q, ),
+                                           name='mysqlbinlog2blinker-acks')
+        self._collector.daemon = True
+        self._collector.start()
+        for i in range(self.workers):
+            q = multiprocessing.Queue(self.queue_size)
+            self._encoders.append((codec.Encoder(), threading.Lock()))
+            process = multiprocessing.Process(
+                target=_worker_main,
+                args=(self._registrations, q, self._done_q, self._errors),
+                name='mysqlbinlog2blinker-process-%d' % i,
+            )
+            process.daemon = True
+            process.start()
+            self._queues.append(q)
+            self._processes.append(process)
+        for sig_name, sender in set((r[0], r[1])
+                                    for r in self._registrations):
+            signals.ROWS_SIGNALS[sig_name].connect(self._ship, sender=sender)
+        _logger.debug('Started %d worker processes', self.workers)
+
+    def stop(self):
+        """ Stop shipping, wait for workers to process what was shipped """
+        for sig_name, sender in set((r[0], r[1])
+                                    for r in self._registrations):
+            signals.ROWS_SIGNALS[sig_name].disconnect(self._ship,
+                                                      sender=sender)
+        for q in self._queues:
+            q.put(None)
+        for process in self._processes:
+            process.join()
+        self._queues, self._processes, self._encoders = [], [], []
+        if self._collector is not None:
+            self._done_q.put(None)
+            self._collector.join()
+            self._collector = self._done_q = None
+        self._tickets.clear()
+        _logger.debug('Stopped worker processes: %s', self.stats())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _collector_runner(self, done_q):
+        while True:
+            batch_id = done_q.get()
+            if batch_id is None:
+                return
+            ticket = self._tickets.pop(batch_id, None)
+            if ticket is not None:
+                ticket.ack()
+
+    def _ship(self, table_name, rows, meta):
+        # the codec leaves the ticket out
+        ticket = meta.get('ticket')
+        n = self.workers
+        if self.partition == 'table' or n == 1:
+            parts = {hash(table_name) % n: rows}
+        else:
+            parts = {}
+            for row in rows:
+                key = tuple(sorted(row['keys'].items()))
+                parts.setdefault(hash((table_name, key)) % n, []).append(row)
+
+        if ticket is not None:
+            if not parts:
+                ticket.ack()
+            elif len(parts) > 1:
+                ticket.add(len(parts) - 1)
+
+        stats = self._stats
+        for idx, part in parts.items():
+            batch_id = None
+            if ticket is not None:
+                self._batch_ids += 1
+                batch_id = self._batch_ids
+                self._tickets[batch_id] = ticket
+            encoder, lock = self._encoders[idx]
+            with lock:
+                started = _timer()
+                payload = encoder.encode(table_name, part, meta)
+                stats['serialize_seconds'] += _timer() - started
+                stats['batches'] += 1
+                stats['rows'] += len(part)
+                stats['bytes'] += len(payload)
+                self._queues[idx].put((payload, batch_id))
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+""" Find the receivers which hold back replication
+
+A :py:class:`ReceiverProfiler` wraps every call of the receivers of the
+rows, binlog and transaction signals once installed. It keeps the slowest
+calls, with their table and binlog position, totals per receiver and,
+optionally, samples of the memory a call left allocated:
+
+    from mysqlbinlog2blinker.profiling import ReceiverProfiler
+
+    profiler = ReceiverProfiler(budget=0.05, max_overruns=3,
+                                on_overrun='quarantine')
+    with profiler:
+        start_replication(mysql_settings)
+
+    # from another thread
+    profiler.slowest()
+    profiler.stats()
+
+A receiver whose calls exceed their time budget *max_overruns* times in a
+row is logged (``on_overrun='warn'``) or quarantined, i.e. not called
+anymore until :py:meth:`ReceiverProfiler.release`. Quarantined receivers do
+not acknowledge tickets, with ``receiver_acks=True`` the position then stops
+moving forward.
+
+Receivers of this package (rows conversion, position memories...) are
+called as is, their time includes the receivers they send signals to.
+"""
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from mysqlbinlog2blinker import signals
+from mysqlbinlog2blinker.signals import _receiver_key, _receiver_ref
+from mysqlbinlog2blinker.stats import _receiver_name
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+_PACKAGE = __name__.split('.')[0] + '.'
+
+#: signals that are profiled by default
+SIGNALS = (signals.binlog_signal, signals.rows_inserted,
+           signals.rows_updated, signals.rows_deleted,
+           signals.transaction_signal)
+
+
+class _ReceiverStats(object):
+    __slots__ = ('name', 'ref', 'calls', 'seconds', 'max_seconds',
+                 'overruns', 'streak', 'alloc_samples', 'alloc_bytes',
+                 'alloc_max')
+
+    def __init__(self, receiver):
+        self.name = _receiver_name(receiver)
+        # checks that the key, made of ids, is still this receiver's
+        self.ref = _receiver_ref(receiver)
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.overruns = 0
+        self.streak = 0
+        self.alloc_samples = 0
+        self.alloc_bytes = 0
+        self.alloc_max = 0
+
+    def add(self, seconds, allocated):
+        """ Count a call, *allocated* is None when it is not sampled """
+        self.calls += 1
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        if allocated is not None:
+            self.alloc_samples += 1
+            self.alloc_bytes += allocated
+            self.alloc_max = max(self.alloc_max, allocated)
+
+
+def _is(ref, receiver):
+    return ref() is getattr(receiver, '__self__', receiver)
+
+
+def _context(sender, kwargs):
+    """ Get the table and binlog position a signal is sent for """
+    meta = kwargs.get('meta') or {}
+    stream = kwargs.get('stream')
+    schema = getattr(sender, 'schema', None)
+    if schema is not None:
+        table = '%s.%s' % (schema, getattr(sender, 'table', None))
+    elif isinstance(sender, (str, type(u''))):
+        table = sender
+    else:
+        table = None
+    return dict(table=table,
+                log_file=meta.get('log_file',
+                                  getattr(stream, 'log_file', None)),
+                log_pos=meta.get('log_pos', getattr(stream, 'log_pos', None)))
+
+
+class ReceiverProfiler(object):
+    """ Time receivers' calls, see module's doc """
+    def __init__(self, slowest=20, budget=None, budgets=None, max_overruns=3,
+                 on_overrun='warn', tracemalloc_every=0, signals=SIGNALS):
+        """ Create a ReceiverProfiler
+
+        Args:
+            slowest (int): how many of the slowest calls are kept
+            budget (float|None): seconds a call of any receiver may take,
+                None for no budget
+            budgets (dict|None): receiver, or the name of receivers
+                (``module.qualname``) => its own budget in seconds
+            max_overruns (int): overruns in a row which trigger *on_overrun*
+            on_overrun (str): ``warn`` or ``quarantine``
+            tracemalloc_every (int): measure the memory allocated by 1 call
+                out of that many, 0 to not. It starts tracemalloc, which
+                slows down the whole process, and other threads'
+                allocations are counted in too
+            signals (tuple[blinker.NamedSignal]): the profiled signals
+        """
+        if on_overrun not in ('warn', 'quarantine'):
+            raise ValueError('Invalid on_overrun "%s"' % on_overrun)
+        if tracemalloc_every and tracemalloc is None:
+            raise ValueError('tracemalloc requires Python 3.4+')
+        self.slowest_size = slowest
+        self.budget = budget
+        # receiver's key or name => budget
+        self.budgets = dict(
+            (key if isinstance(key, str) else _receiver_key(key), value)
+            for key, value in (budgets or {}).items())
+        self.max_overruns = max_overruns
+        self.on_overrun = on_overrun
+        self.tracemalloc_every = tracemalloc_every
+        self.signals = tuple(signals)
+        self._lock = threading.Lock()
+        # receiver's key (see signals._receiver_key) => _ReceiverStats
+        self._receivers = {}
+        # receiver's key => _ReceiverStats
+        self._quarantined = {}
+        # min heap of (seconds, seq, record)
+        self._slowest = []
+        self._seq = itertools.count()
+        self._calls = itertools.count()
+        self._started_tracemalloc = False
+
+    def install(self):
+        """ Start profiling the signals """
+        for sig in self.signals:
+            if getattr(sig, '_profiler', None) not in (None, self):
+                raise RuntimeError('Signal %s is already profiled' %
+                                   sig.name)
+        if self.tracemalloc_every and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        for sig in self.signals:
+            # shadows blinker's send, and tells stats to call through us
+            sig.send = self._make_send(sig)
+            sig._profiler = self
+
+    def uninstall(self):
+        """ Stop profiling the signals, results are kept """
+        for sig in self.signals:
+            if sig.__dict__.get('_profiler') is self:
+                del sig.send
+                del sig._profiler
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+    def _make_send(self, sig):
+        def send(sender=None, **kwargs):
+            return [(receiver, self.call(sig, receiver, sender, kwargs))
+                    for receiver in self.receivers_for(sig, sender)]
+        return send
+
+    def receivers_for(self, sig, sender):
+        """ Get the receivers of a signal which are not quarantined """
+        for receiver in sig.receivers_for(sender):
+            if self._quarantined:
+                stats = self._quarantined.get(_receiver_key(receiver))
+                if stats is not None and _is(stats.ref, receiver):
+                    continue
+            yield receiver
+
+    def call(self, sig, receiver, sender, kwargs):
+        """ Call a receiver, profiling it """
+        if (getattr(receiver, '__module__', None) or '').startswith(_PACKAGE):
+            return receiver(sender, **kwargs)
+        sampled = self.tracemalloc_every and \
+            next(self._calls) % self.tracemalloc_every == 0 and \
+            tracemalloc.is_tracing()
+        if sampled:
+            allocated = tracemalloc.get_traced_memory()[0]
+        started = _timer()
+        try:
+            return receiver(sender, **kwargs)
+        finally:
+            seconds = _timer() - started
+            if sampled:
+                allocated = tracemalloc.get_traced_memory()[0] - allocated
+            self._record(sig, receiver, sender, kwargs, seconds,
+                         allocated if sampled else None)
+
+    def _record(self, sig, receiver, sender, kwargs, seconds, allocated):
+        key = _receiver_key(receiver)
+        with self._lock:
+            stats = self._receivers.get(key)
+            # a dead receiver's ids may be reused by another one
+            if stats is None or not _is(stats.ref, receiver):
+                stats = self._receivers[key] = _ReceiverStats(receiver)
+                self._quarantined.pop(key, None)
+            name = stats.name
+            budget = self.budgets.get(key, self.budgets.get(name,
+                                                            self.budget))
+            stats.add(seconds, allocated)
+            self._keep_slowest(sig, name, sender, kwargs, seconds, allocated)
+
+            if budget is None:
+                return
+            if seconds <= budget:
+                stats.streak = 0
+                return
+            stats.overruns += 1
+            stats.streak += 1
+            if stats.streak < self.max_overruns:
+                return
+            stats.streak = 0
+            if self.on_overrun == 'quarantine':
+                self._quarantined[key] = stats
+        context = _context(sender, kwargs)
+        if self.on_overrun == 'quarantine':
+            _logger.error('Quarantine receiver %s of %s, %d calls in a row '
+                          'over %.3fs, last %.3fs on %s at %s:%s', name,
+                          sig.name, self.max_overruns, budget, seconds,
+                          context['table'], context['log_file'],
+                          context['log_pos'])
+        else:
+            _logger.warning('Receiver %s of %s is slow, %d calls in a row '
+                            'over %.3fs, last %.3fs on %s at %s:%s', name,
+                            sig.name, self.max_overruns, budget, seconds,
+                            context['table'], context['log_file'],
+                            context['log_pos'])
+
+    def _keep_slowest(self, sig, name, sender, kwargs, seconds, allocated):
+        """ Keep a call among the slowest ones, under the lock """
+        if len(self._slowest) < self.slowest_size or \
+                seconds > self._slowest[0][0]:
+            record = dict(_context(sender, kwargs), receiver=name,
+                          signal=sig.name, seconds=seconds,
+                          allocated=allocated, at=time.time())
+            item = (seconds, next(self._seq), record)
+            if len(self._slowest) < self.slowest_size:
+                heapq.heappush(self._slowest, item)
+            else:
+                heapq.heapreplace(self._slowest, item)
+
+    def _labels(self):
+        """ Get the name to show of each receiver, with its id when several
+        receivers have the same name
+        """
+        counts = collections.Counter(
+            stats.name for stats in self._receivers.values())
+        labels = {}
+        for key, stats in self._receivers.items():
+            labels[key] = stats.name
+            if counts[stats.name] > 1:
+                labels[key] = '%s at 0x%x' % (
+                    stats.name, key[0] if isinstance(key, tuple) else key)
+        return labels
+
+    def quarantined(self):
+        """ Get the names of the quarantined receivers """
+        with self._lock:
+            labels = self._labels()
+            return sorted(labels[key] for key in self._quarantined)
+
+    def release(self, receiver):
+        """ Call a quarantined receiver again
+
+        Args:
+            receiver (callable|str): the receiver, or a name as given by
+                :py:meth:`quarantined` which releases every receiver having it
+        """
+        with self._lock:
+            if isinstance(receiver, str):
+                labels = self._labels()
+                keys = [key for key, stats in self._quarantined.items()
+                        if receiver in (stats.name, labels[key])]
+                name = receiver
+            else:
+                keys = [_receiver_key(receiver)]
+                name = _receiver_name(receiver)
+            for key in keys:
+                self._quarantined.pop(key, None)
+        _logger.info('Release receiver %s', name)
+
+    def slowest(self):
+        """ Get the slowest calls, slowest first
+
+        Returns:
+            list[dict]: *receiver*, *signal*, *seconds*, *table*,
+                *log_file*, *log_pos*, *allocated* (bytes, None when not
+                sampled) and *at* (timestamp)
+        """
+        with self._lock:
+            items = sorted(self._slowest, reverse=True)
+        return [dict(record) for _, _, record in items]
+
+    def stats(self):
+        """ Get the totals per receiver
+
+        Returns:
+            dict: receiver's name (with its id when several receivers have
+                the same name) => *calls*, *seconds*, *mean_seconds*,
+                *max_seconds*, *overruns*, *quarantined* and, for sampled
+                calls, *alloc_samples*, *alloc_mean_bytes*, *alloc_max_bytes*
+        """
+        with self._lock:
+            labels = self._labels()
+            return dict(
+                (labels[key], dict(
+                    calls=stats.calls,
+                    seconds=stats.seconds,
+                    mean_seconds=stats.seconds / stats.calls
+                    if stats.calls else 0.0,
+                    max_seconds=stats.max_seconds,
+                    overruns=stats.overruns,
+                    quarantined=key in self._quarantined,
+                    alloc_samples=stats.alloc_samples,
+                    alloc_mean_bytes=stats.alloc_bytes / stats.alloc_samples
+                    if stats.alloc_samples else 0,
+                    alloc_max_bytes=stats.alloc_max,
+                ))
+                for key, stats in self._receivers.items())
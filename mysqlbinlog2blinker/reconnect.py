@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+""" Reconnect the binlog stream when the connection drops
+
+With a :py:class:`Reconnect` policy, :py:func:`mysqlbinlog2blinker.
+start_publishing` (so :py:func:`mysqlbinlog2blinker.start_replication`)
+reads the binlog through a :py:class:`ReconnectingStream`. When reading the
+stream fails with a connection error, it connects again after a backoff and
+resumes right after the last event it yielded, within the same publishing:
+the dispatcher, its pending rows and positions, the position memory and
+the decoded table maps all stay as they are.
+
+    reconnect = Reconnect(initial_delay=0.5, max_delay=30)
+    start_replication(mysql_settings, reconnect=reconnect)
+
+    # from another thread
+    reconnect.stats()
+
+Delays grow by *multiplier* from *initial_delay* up to *max_delay*, minus a
+random part of up to *jitter* of the delay, so many replicas losing the same
+server do not reconnect all at once.
+
+A stream which resumed from a GTID set resumes from a binlog file and
+position too, so it must still be the same server.
+"""
+import logging
+import random
+import socket
+import time
+
+import pymysql
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+# errors of a dropped connection
+RECONNECT_ERRORS = (pymysql.err.OperationalError,
+                    pymysql.err.InterfaceError,
+                    socket.error)
+
+
+class Reconnect(object):
+    """ Reconnect policy and stats, see module's doc """
+    def __init__(self, initial_delay=0.5, max_delay=30.0, multiplier=2.0,
+                 jitter=0.5, max_attempts=None, errors=RECONNECT_ERRORS):
+        """ Create a Reconnect policy
+
+        Args:
+            initial_delay (float): seconds before the first attempt
+            max_delay (float): max seconds between attempts
+            multiplier (float): growth of the delay after each failed
+                attempt
+            jitter (float): max part of a delay, from 0 to 1, which is
+                randomly taken off
+            max_attempts (int|None): attempts before giving up and raising
+                the error, None never gives up
+            errors (tuple): exception classes which mean that the connection
+                dropped
+        """
+        assert 0 <= jitter <= 1
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.errors = errors
+
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.downtime_seconds = 0.0
+        self.last_error = None
+        self.last_reconnect = None
+
+    def delay(self, attempt):
+        """ Get the seconds to wait before attempt *attempt* (from 0) """
+        delay = min(self.max_delay,
+                    self.initial_delay * self.multiplier ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def stats(self):
+        """ Get reconnects, failed attempts, total seconds without
+        connection, last error and time of the last reconnect
+        """
+        return dict(
+            reconnects=self.reconnects,
+            failed_attempts=self.failed_attempts,
+            downtime_seconds=self.downtime_seconds,
+            last_error=repr(self.last_error) if self.last_error else None,
+            last_reconnect=self.last_reconnect,
+        )
+
+
+class ReconnectingStream(object):
+    """ A binlog stream which reconnects, see module's doc
+
+    Attributes of the current
+    :py:class:`pymysqlreplication.BinLogStreamReader` (*log_file*,
+    *log_pos*, *table_map*...) are available on it.
+    """
+    def __init__(self, make_stream, reconnect, **kwargs):
+        """ Create a ReconnectingStream
+
+        Args:
+            make_stream (callable): makes a stream from *kwargs*
+            reconnect (Reconnect): the policy
+            **kwargs: arguments of the first stream
+        """
+        self._make_stream = make_stream
+        self.reconnect = reconnect
+        self._kwargs = kwargs
+        self._stream = make_stream(**kwargs)
+
+    def __getattr__(self, name):
+        if name == '_stream':
+            raise AttributeError(name)
+        return getattr(self._stream, name)
+
+    def _resume_kwargs(self, stream):
+        """ Get arguments to make a stream which resumes *stream* """
+        kwargs = dict(self._kwargs)
+        if stream.log_file is not None and stream.log_pos is not None:
+            kwargs.pop('auto_position', None)
+            kwargs.update(log_file=stream.log_file, log_pos=stream.log_pos,
+                          resume_stream=True)
+        return kwargs
+
+    def __iter__(self):
+        reconnect = self.reconnect
+        attempt = 0
+        down_since = None
+        while True:
+            stream = self._stream
+            try:
+                for event in stream:
+                    if down_since is not None:
+                        reconnect.downtime_seconds += time.time() - down_since
+                        reconnect.reconnects += 1
+                        reconnect.last_reconnect = time.time()
+                        _logger.info('Reconnected after %d attempt(s)',
+                                     attempt)
+                        down_since = None
+                        attempt = 0
+                    yield event
+                return
+            except reconnect.errors as e:
+                reconnect.last_error = e
+                if down_since is None:
+                    down_since = time.time()
+                    _logger.warning('Binlog stream lost at %s:%s: %r',
+                                    stream.log_file, stream.log_pos, e)
+                else:
+                    reconnect.failed_attempts += 1
+                if reconnect.max_attempts is not None and \
+                        attempt >= reconnect.max_attempts:
+                    raise
+                delay = reconnect.delay(attempt)
+                attempt += 1
+                _logger.info('Reconnecting in %.2fs (attempt %d)', delay,
+                             attempt)
+                _close(stream)
+                time.sleep(delay)
+                self._kwargs = self._resume_kwargs(stream)
+                self._stream = self._make_stream(**self._kwargs)
+                # tables decoded so far do not need to be queried again
+                self._stream.table_map = stream.table_map
+
+    def close(self):
+        _close(self._stream)
+
+
+def _close(stream):
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            _logger.debug('Closing binlog stream failed', exc_info=True)
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+""" Row objects that are delivered to the rows signals' receivers
+
+* :py:class:`LazyRow`: the default, a dict whose *updated_values* and *keys*
+  are computed on first access
+* :py:class:`CompactRow`: tuple backed rows sharing one
+  :py:class:`TableColumns` index, for ``row_format='compact'``
+* :py:class:`ColumnarRows`: all rows of an event stored column by column,
+  for ``row_format='columnar'``
+"""
+import array
+import numbers
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:  # Python 2
+    from collections import Mapping, Sequence
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'tarzan'
+
+
+class LazyRow(dict):
+    """ A row dict whose some items are computed on first access
+
+    Items such as *updated_values* and *keys* are costly on wide tables and
+    not every receiver reads them. They are given as ``key => (func, args)``
+    and are computed, then cached, when they are accessed the first time.
+
+    The row is a real dict: iterating, comparing, printing, copying or
+    pickling it computes all pending items first, so it looks exactly like
+    the eager dict it replaces.
+    """
+    __slots__ = ('_lazy', )
+
+    def __init__(self, items, lazy):
+        """ Create a LazyRow
+
+        Args:
+            items (dict): items which are known already
+            lazy (dict): key => (func, args) of lazy items
+        """
+        dict.__init__(self, items)
+        self._lazy = lazy
+
+    def __missing__(self, key):
+        lazy = self._lazy
+        if key in lazy:
+            func, args = lazy.pop(key)
+            value = func(*args)
+            dict.__setitem__(self, key, value)
+            return value
+        raise KeyError(key)
+
+    def _materialize(self):
+        lazy = self._lazy
+        while lazy:
+            self.__missing__(next(iter(lazy)))
+
+    def __setitem__(self, key, value):
+        self._lazy.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._lazy.pop(key, None) is None:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._lazy or dict.__contains__(self, key)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._lazy)
+
+    def __iter__(self):
+        self._materialize()
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        self._materialize()
+        if isinstance(other, LazyRow):
+            other._materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        self._materialize()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        # pickled and copied as a plain dict
+        return dict, (dict(self.items()), )
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        self._materialize()
+        return dict.keys(self)
+
+    def values(self):
+        self._materialize()
+        return dict.values(self)
+
+    def items(self):
+        self._materialize()
+        return dict.items(self)
+
+    def copy(self):
+        return dict(self.items())
+
+    def pop(self, key, *default):
+        if key in self._lazy:
+            self.__missing__(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._materialize()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key in self._lazy:
+            return self[key]
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        for key in items:
+            self._lazy.pop(key, None)
+        dict.update(self, items)
+
+
+class TableColumns(object):
+    """ Column index of a table, shared by all compact rows of the table """
+    __slots__ = ('names', 'index', 'pk')
+
+    def __init__(self, names, pk_cols=()):
+        """ Create a TableColumns
+
+        Args:
+            names (tuple[str]): the column names, in the order of values
+            pk_cols (tuple[str]): the primary key's columns
+        """
+        self.names = tuple(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.pk = tuple((name, self.index[name]) for name in pk_cols
+                        if name in self.index)
+
+    def __repr__(self):
+        return 'TableColumns(%r)' % (self.names, )
+
+
+class CompactValues(Mapping):
+    """ Read only mapping of column name => value backed by a tuple """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._columns.index[key]]
+        except KeyError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._columns.index
+
+    def __iter__(self):
+        return iter(self._columns.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(dict(zip(self._columns.names, self._values)))
+
+    def __reduce__(self):
+        return dict, (dict(zip(self._columns.names, self._values)), )
+
+
+class CompactRow(Mapping):
+    """ Read only row which looks like the row dicts of the rows signals
+
+    It holds the row's values (and the values before an update) as tuples
+    and points to the :py:class:`TableColumns` of its table, so a row costs
+    one small object and one or two tuples instead of up to four dicts.
+
+    ``row['values']`` is a :py:class:`CompactValues`, ``row['keys']`` and
+    ``row['updated_values']`` are dicts computed on access, the latter is
+    cached.
+    """
+    __slots__ = ('_columns', '_values', '_before', '_updated_values')
+
+    def __init__(self, columns, values, before=None):
+        """ Create a CompactRow
+
+        Args:
+            columns (TableColumns): the table's columns
+            values (tuple): the row's values (after the update)
+            before (tuple|None): the values before the update, for updates
+        """
+        self._columns = columns
+        self._values = values
+        self._before = before
+        self._updated_values = None
+
+    def _item_keys(self):
+        if self._before is None:
+            return 'keys', 'values'
+        return 'keys', 'updated_values', 'values'
+
+    def __getitem__(self, key):
+        if key == 'values':
+            return CompactValues(self._columns, self._values)
+        if key == 'keys':
+            values = self._values
+            return dict((name, values[i]) for name, i in self._columns.pk)
+        if key == 'updated_values' and self._before is not None:
+            if self._updated_values is None:
+                names = self._columns.names
+                self._updated_values = dict(
+                    (names[i], [b, a]) for i, (b, a)
+                    in enumerate(zip(self._before, self._values)) if b != a
+                )
+            return self._updated_values
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._item_keys()
+
+    def __iter__(self):
+        return iter(self._item_keys())
+
+    def __len__(self):
+        return len(self._item_keys())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        return dict, (dict((k, dict(v)) for k, v in self.items()), )
+
+
+def _int64(value):
+    return isinstance(value, numbers.Integral) and \
+        -0x8000000000000000 <= value <= 0x7fffffffffffffff
+
+
+def _column_typecode(values):
+    """ Get the :py:mod:`array` typecode of a column's values, ``q`` when
+    they are all 64-bit integers, ``d`` when they are all floats, else None
+    """
+    if values and not isinstance(values[0], bool):
+        if all(_int64(v) for v in values):
+            return 'q'
+        if all(isinstance(v, float) for v in values):
+            return 'd'
+    return None
+
+
+def _make_column(values):
+    """ Make an array of a column's values
+
+    With numpy, 64-bit integer and float columns are numeric arrays and the
+    others are object arrays, holding the values as they are. Without numpy,
+    they are :py:mod:`array` arrays and lists.
+    """
+    typecode = _column_typecode(values)
+    if numpy is not None:
+        if typecode is not None:
+            return numpy.array(values,
+                               dtype=numpy.int64 if typecode == 'q'
+                               else numpy.float64)
+        # not asarray, which would turn lists into more dimensions
+        column = numpy.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+    if typecode is not None:
+        return array.array(typecode, values)
+    return list(values)
+
+
+def _item(value):
+    """ Turn a numpy scalar into the python value """
+    return value.item() if numpy is not None and \
+        isinstance(value, numpy.generic) else value
+
+
+def _take(column, indexes):
+    """ Get the values of a column at *indexes*, in an array alike """
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        return column[numpy.asarray(indexes, dtype=numpy.intp)]
+    values = [column[i] for i in indexes]
+    if isinstance(column, array.array):
+        return array.array(column.typecode, values)
+    return values
+
+
+class ColumnarRows(Sequence):
+    """ Rows of an event stored column by column
+
+    Every column is an array (a numpy array when numpy is available, an
+    :py:mod:`array` array or a list otherwise), so receivers can process the
+    rows of bulk events column-wise, and vectorized with numpy.
+
+    It is still a sequence of rows: ``rows[i]`` and iterating build the
+    row dicts that the rows signals usually carry, so receivers which are
+    not aware of this format keep working (without the gain).
+    """
+    def __init__(self, names, columns, before_columns=None, pk_cols=()):
+        """ Create a ColumnarRows
+
+        Args:
+            names (tuple[str]): the column names
+            columns (list[sequence]): the values, one sequence per column
+            before_columns (list[sequence]|None): the values before the
+                update, for updates
+            pk_cols (tuple[str]): the primary key's columns
+        """
+        self.names = tuple(names)
+        self.columns = dict(zip(self.names,
+                                [_make_column(c) for c in columns]))
+        self.before_columns = None if before_columns is None else \
+            dict(zip(self.names, [_make_column(c) for c in before_columns]))
+        self.pk_cols = tuple(name for name in pk_cols if name in self.columns)
+        self._length = len(columns[0]) if columns else 0
+        self._changed_masks = {}
+
+    def column(self, name):
+        """ Get values of a column (after the update for updates) """
+        return self.columns[name]
+
+    def before_column(self, name):
+        """ Get values of a column before the update """
+        if self.before_columns is None:
+            raise ValueError('Only rows of updates have before values')
+        return self.before_columns[name]
+
+    def changed_mask(self, name):
+        """ Get whether the column's value was changed, for each row
+
+        Returns:
+            numpy.ndarray|array.array: booleans (0/1 without numpy)
+        """
+        mask = self._changed_masks.get(name)
+        if mask is None:
+            before, after = self.before_column(name), self.columns[name]
+            if numpy is not None:
+                mask = numpy.asarray(before != after, dtype=bool)
+            else:
+                mask = array.array('b', [b != a for b, a
+                                         in zip(before, after)])
+            self._changed_masks[name] = mask
+        return mask
+
+    def changed_masks(self):
+        """ Get the changed mask of every column, as a dict """
+        return dict((name, self.changed_mask(name)) for name in self.names)
+
+    def key_values(self):
+        """ Get the primary key of each row, as the sorted items of its
+        *keys*
+
+        Returns:
+            list[tuple]: ``tuple(sorted(row['keys'].items()))`` of each row
+        """
+        pk_cols = sorted(self.pk_cols)
+        columns = [self.columns[name] for name in pk_cols]
+        return [tuple(zip(pk_cols, [_item(c[i]) for c in columns]))
+                for i in range(self._length)]
+
+    def take(self, indexes):
+        """ Get some of the rows, still column by column
+
+        Args:
+            indexes (list[int]): indexes of the rows, in the wanted order
+
+        Returns:
+            ColumnarRows: the rows
+        """
+        rows = ColumnarRows.__new__(ColumnarRows)
+        rows.names = self.names
+        rows.columns = dict((name, _take(column, indexes))
+                            for name, column in self.columns.items())
+        rows.before_columns = None if self.before_columns is None else \
+            dict((name, _take(column, indexes))
+                 for name, column in self.before_columns.items())
+        rows.pk_cols = self.pk_cols
+        rows._length = len(indexes)
+        rows._changed_masks = {}
+        return rows
+
+    def __len__(self):
+        return self._length
+
+    def _row(self, i):
+        values = dict((name, _item(self.columns[name][i]))
+                      for name in self.names)
+        row = {
+            'values': values,
+            'keys': dict((name, values[name]) for name in self.pk_cols),
+        }
+        if self.before_columns is not None:
+            updated_values = {}
+            for name in self.names:
+                before = _item(self.before_columns[name][i])
+                if before != values[name]:
+                    updated_values[name] = [before, values[name]]
+            row['updated_values'] = updated_values
+        return row
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._row(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        return self._row(index)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ColumnarRows(%d rows of %r)' % (len(self), self.names)
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+""" Keep table column definitions on disk across restarts
+
+Each time a table shows up for the first time after a start, the binlog
+stream queries its columns from ``information_schema``, which slows down
+startup and catch-up when there are hundreds of tables. With a
+:py:class:`SchemaCache`, the definitions are read from a JSON file instead,
+and only the tables that are missing from it are queried (then added):
+
+    start_replication(mysql_settings, schema_cache=True)
+
+which keeps the cache next to the position file, or:
+
+    start_replication(mysql_settings,
+                      schema_cache=SchemaCache('/path/to/schema.json'))
+
+A DDL ``QueryEvent`` read from the binlog drops the definitions of its
+table (of its whole schema when the table can not be told), and the file is
+saved right away. At startup, tables whose fingerprint (the names, ordinal
+positions and types of their columns in ``information_schema.COLUMNS``)
+changed while nothing was reading the binlog are dropped too, as well as
+tables whose fingerprint is not known.
+
+With pymysqlreplication 1.0+, column names come from the binlog itself
+(``binlog_row_metadata=FULL``) and ``information_schema`` is only queried
+with ``use_column_name_cache=True``, the cache then preloads and collects
+those names.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+
+import pymysql
+import pymysqlreplication
+from pymysqlreplication import event as binlog_event, row_event
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+# os.rename does not replace an existing file on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+_VERSION = 2
+
+# column names cache of pymysqlreplication 1.0+, "schema.table" => names
+_COLUMN_NAME_CACHE = getattr(row_event, '_COLUMN_NAME_CACHE', None)
+
+_COMMENTS = r'(?:\s|/\*.*?\*/)*'
+_DDL = re.compile(_COMMENTS + r'(?:ALTER|CREATE|DROP|RENAME)\b',
+                  re.I | re.S)
+_NAME = r'(`[^`]+`|[\w$]+(?![\w$]))'
+# statements on one table or one schema, whose name is known
+_TABLE_DDL = re.compile(
+    _COMMENTS +
+    r'(?:ALTER|CREATE|DROP)\s+(?:ONLINE\s+|OFFLINE\s+|IGNORE\s+|'
+    r'TEMPORARY\s+)*(TABLE|DATABASE|SCHEMA)\s+'
+    r'(?:IF\s+(?:NOT\s+)?EXISTS\s+)?' +
+    _NAME + r'(?:\s*\.\s*' + _NAME + r')?(?!\s*[,.])',
+    re.I | re.S)
+_QUALIFIED_NAME = re.compile(_NAME + r'\s*\.\s*' + _NAME)
+
+
+def _fingerprint(columns):
+    """ Fingerprint of a table's (ordinal position, name, type) columns
+    """
+    data = json.dumps([list(column) for column in columns], default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _has_names_of(entry, columns):
+    """ Get whether *entry* only has the column names collected from the
+    binlog, and they are the names of *columns*
+    """
+    return 'columns' not in entry and bool(columns) and \
+        entry.get('names') == [column[1] for column in columns]
+
+
+def _unquote(name):
+    return name[1:-1] if name.startswith('`') else name
+
+
+def ddl_tables(query, schema):
+    """ Get the tables whose columns a query may change
+
+    Args:
+        query (str|bytes): query of a QueryEvent
+        schema (str): default schema of the query
+
+    Returns:
+        list[tuple]|None: (schema, table) pairs, where table is None for all
+            tables of the schema, None when it is not a DDL
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    if not _DDL.match(query):
+        return None
+    match = _TABLE_DDL.match(query)
+    if match is None:
+        # e.g. RENAME TABLE or DROP TABLE of several tables
+        return [(schema, None)] + [
+            (_unquote(first), _unquote(second))
+            for first, second in _QUALIFIED_NAME.findall(query)]
+    kind, first, second = match.group(1, 2, 3)
+    if kind.upper() != 'TABLE':
+        return [(_unquote(first), None)]
+    if second is None:
+        return [(schema, _unquote(first))]
+    return [(_unquote(first), _unquote(second))]
+
+
+class SchemaCache(object):
+    """ Column definitions of tables, saved to a JSON file """
+    def __init__(self, filename):
+        """ Create a SchemaCache, loading *filename* if it exists
+
+        Args:
+            filename (str): JSON file of the cache
+        """
+        self.filename = filename
+        # schema.table => {'fingerprint': str|None, 'columns': list}
+        self._tables = {}
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, OSError):
+            return
+        except ValueError:
+            _logger.warning('Ignore corrupted schema cache %s', self.filename)
+            return
+        if data.get('version') == _VERSION:
+            self._tables = data['tables']
+        if _COLUMN_NAME_CACHE is not None:
+            for key, entry in self._tables.items():
+                names = entry.get('names')
+                if names:
+                    _COLUMN_NAME_CACHE.setdefault(key, names)
+        _logger.debug('Loaded %d tables from schema cache %s',
+                      len(self._tables), self.filename)
+
+    def save(self):
+        """ Save the cache, if it changed, into its file atomically """
+        self._collect_column_names()
+        if not self._dirty:
+            return
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'version': _VERSION, 'tables': self._tables}, f,
+                      default=str)
+        _replace(tmp_filename, self.filename)
+        self._dirty = False
+
+    def _collect_column_names(self):
+        if _COLUMN_NAME_CACHE is None:
+            return
+        for key, names in list(_COLUMN_NAME_CACHE.items()):
+            entry = self._tables.setdefault(key, {'fingerprint': None})
+            if entry.get('names') != names:
+                entry['names'] = list(names)
+                self._dirty = True
+
+    def get(self, schema, table):
+        """ Get the cached columns of a table, None when it is missing """
+        entry = self._tables.get('%s.%s' % (schema, table))
+        columns = entry.get('columns') if entry is not None else None
+        if columns is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return columns
+
+    def put(self, schema, table, columns):
+        """ Cache the columns of a table, as queried from
+        ``information_schema.columns``
+        """
+        entry = self._tables.setdefault('%s.%s' % (schema, table), {})
+        entry['columns'] = columns
+        entry['fingerprint'] = _fingerprint(
+            (column.get('ORDINAL_POSITION', i + 1), column['COLUMN_NAME'],
+             column.get('COLUMN_TYPE'))
+            for i, column in enumerate(columns))
+        self._dirty = True
+
+    def invalidate(self, schema, table=None):
+        """ Drop a table, or all tables of a schema when *table* is None,
+        and save the cache
+        """
+        if table is None:
+            prefix = '%s.' % schema
+            keys = [key for key in self._tables if key.startswith(prefix)]
+            if _COLUMN_NAME_CACHE is not None:
+                keys += [key for key in list(_COLUMN_NAME_CACHE)
+                         if key.startswith(prefix)]
+        else:
+            keys = ['%s.%s' % (schema, table)]
+        changed = False
+        for key in keys:
+            if self._tables.pop(key, None) is not None:
+                changed = True
+            if _COLUMN_NAME_CACHE is not None:
+                _COLUMN_NAME_CACHE.pop(key, None)
+        if changed:
+            _logger.info('Schema of %s.%s changed', schema, table or '*')
+            self._dirty = True
+            self.save()
+
+    def handle_query(self, event):
+        """ Invalidate the tables that a DDL QueryEvent changes """
+        schema = event.schema
+        if isinstance(schema, bytes):
+            schema = schema.decode('utf-8', 'replace')
+        tables = ddl_tables(event.query, schema)
+        for schema, table in tables or ():
+            self.invalidate(schema, table)
+
+    def validate(self, connection):
+        """ Drop tables whose fingerprint changed or is not known
+
+        Column names collected from the binlog, which have no fingerprint,
+        are kept when they are still the server's.
+
+        Args:
+            connection (pymysql.connections.Connection): connection to the
+                server, one query is run on ``information_schema.COLUMNS``
+        """
+        schemas = sorted(set(key.split('.', 1)[0] for key in self._tables))
+        if not schemas:
+            return
+        # schema.table => its (ordinal position, name, type) columns
+        server_columns = {}
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                'SELECT TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION, '
+                'COLUMN_NAME, COLUMN_TYPE FROM information_schema.COLUMNS '
+                'WHERE TABLE_SCHEMA IN (%s) '
+                'ORDER BY TABLE_SCHEMA, TABLE_NAME, ORDINAL_POSITION'
+                % ', '.join(['%s'] * len(schemas)), schemas)
+            for row in cursor.fetchall():
+                server_columns.setdefault('%s.%s' % (row[0], row[1]),
+                                          []).append(tuple(row[2:]))
+        finally:
+            cursor.close()
+        for key, entry in list(self._tables.items()):
+            columns = server_columns.get(key)
+            fingerprint = _fingerprint(columns) if columns else None
+            if entry.get('fingerprint') is None and \
+                    _has_names_of(entry, columns):
+                entry['fingerprint'] = fingerprint
+            elif fingerprint is None or \
+                    entry.get('fingerprint') != fingerprint:
+                _logger.info('Schema of %s changed since it was cached, or '
+                             'is not known', key)
+                del self._tables[key]
+                if _COLUMN_NAME_CACHE is not None:
+                    _COLUMN_NAME_CACHE.pop(key, None)
+            else:
+                continue
+            self._dirty = True
+        self.save()
+
+    def validate_server(self, mysql_settings):
+        """ :py:meth:`validate` with a short lived connection """
+        if not self._tables:
+            return
+        connection = pymysql.connect(**mysql_settings)
+        try:
+            self.validate(connection)
+        finally:
+            connection.close()
+
+
+class CachingBinLogStreamReader(pymysqlreplication.BinLogStreamReader):
+    """ A BinLogStreamReader which takes table columns from a SchemaCache,
+    and gives it the DDL QueryEvents
+    """
+    def __init__(self, connection_settings, schema_cache, only_events=None,
+                 **kwargs):
+        self.schema_cache = schema_cache
+        # QueryEvents are only yielded when they are asked for
+        self._yield_queries = only_events is None or \
+            binlog_event.QueryEvent in only_events
+        if not self._yield_queries:
+            only_events = list(only_events) + [binlog_event.QueryEvent]
+        super(CachingBinLogStreamReader, self).__init__(
+            connection_settings, only_events=only_events, **kwargs)
+
+    def fetchone(self):
+        while True:
+            event = super(CachingBinLogStreamReader, self).fetchone()
+            if isinstance(event, binlog_event.QueryEvent):
+                self.schema_cache.handle_query(event)
+                if not self._yield_queries:
+                    continue
+            return event
+
+    # pymysqlreplication < 1.0 queries columns of tables through this
+    def _BinLogStreamReader__get_table_information(self, schema, table):
+        columns = self.schema_cache.get(schema, table)
+        if columns is None:
+            columns = pymysqlreplication.BinLogStreamReader.\
+                _BinLogStreamReader__get_table_information(self, schema,
+                                                           table)
+            if columns:
+                self.schema_cache.put(schema, table, list(columns))
+        return columns
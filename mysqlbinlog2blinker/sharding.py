@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+""" Split the replicated tables across processes
+
+One replicating process decodes the whole binlog on one core. A
+:py:class:`ShardCoordinator` splits the tables across *shards* child
+processes instead. Each child runs :py:func:`mysqlbinlog2blinker.
+start_replication` with its own ``server_id``, ``only_schemas``/
+``only_tables`` and position file, so it only decodes the rows of its
+tables:
+
+    coordinator = ShardCoordinator(
+        {'host': 'localhost', 'user': 'root'}, shards=4,
+        tables=['db.orders', 'db.order_items', 'db.users'],
+        setup=myapp.receivers.connect_all)
+    coordinator.run()
+
+A table goes to shard ``crc32(schema.table) % shards``, unless *table_map*
+says otherwise, so the split is the same in every run. Changing *shards* or
+*table_map* moves tables to shards whose position files are at another
+position: remove the position files, or make sure they are all at the same
+position, first.
+
+Children are forked with the receivers connected in the coordinator, or
+*setup*, an importable function, connects them in each child. Events of a
+transaction which touches tables of several shards are published by
+several children, independently.
+
+The coordinator restarts children which exit, after *restart_delay*
+seconds, doubled each time a child exits shortly after being started, up to
+*max_restart_delay*. A restarted child resumes from its position file.
+"""
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+import zlib
+
+import mysqlbinlog2blinker as _publisher
+from mysqlbinlog2blinker import _subscribers
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+# children which ran at least this long before exiting restart after
+# restart_delay again
+_STABLE_SECONDS = 60.0
+
+
+def shard_of(table, shards, table_map=None):
+    """ Get the shard of a table
+
+    Args:
+        table (str): schema.table
+        shards (int): number of shards
+        table_map (dict|None): schema.table => shard, for tables that are
+            not sharded by hash
+
+    Returns:
+        int: the shard, from 0 to *shards* - 1
+    """
+    if table_map and table in table_map:
+        shard = table_map[table]
+        if not 0 <= shard < shards:
+            raise ValueError('Invalid shard %s of %s' % (shard, table))
+        return shard
+    return (zlib.crc32(table.encode('utf-8')) & 0xffffffff) % shards
+
+
+def split_tables(tables, shards, table_map=None):
+    """ Split tables into shards, see :py:func:`shard_of`
+
+    Returns:
+        list[list[str]]: sorted tables of each shard
+    """
+    split = [[] for _ in range(shards)]
+    for table in sorted(set(tables)):
+        split[shard_of(table, shards, table_map)].append(table)
+    return split
+
+
+def _child_main(index, mysql_settings, tables, pos_filename, interval,
+                setup, kwargs):
+    """ Entry of child processes: replicate the rows of *tables* """
+    # stop cleanly on terminate(), so the position file is saved
+    def on_sigterm(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    if setup is not None:
+        setup()
+    # only_tables does not tell schemas, so tables of other shards which
+    # have the same name in another schema may still come
+    _subscribers.set_only_tables(tables)
+    schemas_and_tables = [t.split('.', 1) for t in tables]
+    kwargs.setdefault('only_schemas',
+                      sorted(set(s for s, _ in schemas_and_tables)))
+    kwargs.setdefault('only_tables',
+                      sorted(set(t for _, t in schemas_and_tables)))
+    _logger.info('Shard %d replicates %s', index, tables)
+    _publisher.start_replication(mysql_settings, (pos_filename, interval),
+                                 **kwargs)
+
+
+class _Child(object):
+    """ A shard's child process, as supervised by the coordinator """
+    def __init__(self, index, tables, server_id, pos_filename):
+        self.index = index
+        self.tables = tables
+        self.server_id = server_id
+        self.pos_filename = pos_filename
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.restart_delay = None
+        self.restart_at = None
+
+
+def _shard_pos_filename(pos_filename, index):
+    """ Position file of shard *index*, see :py:class:`ShardCoordinator`
+    """
+    if '%d' in pos_filename:
+        return pos_filename % index
+    return '%s.%d' % (pos_filename, index)
+
+
+class ShardCoordinator(object):
+    """ Run and supervise shard processes, see module's doc """
+    def __init__(self, mysql_settings, shards=2, tables=None,
+                 table_map=None, setup=None, pos_filename=None, interval=2,
+                 server_id=None, restart_delay=1.0, max_restart_delay=60.0,
+                 **kwargs):
+        """ Create a ShardCoordinator
+
+        Args:
+            mysql_settings (dict): information to connect to mysql via
+                pymysql
+            shards (int): number of child processes
+            tables (list[str]|None): schema.table names to replicate, None
+                takes the tables that the rows signals' receivers subscribe
+                to
+            table_map (dict|None): schema.table => shard, see
+                :py:func:`shard_of`
+            setup (callable|None): importable function called at the start
+                of each child, e.g. to connect receivers
+            pos_filename (str|None): position file of each shard, formatted
+                with the shard when it has a ``%d``, else suffixed with
+                ``.<shard>``, None makes
+                *mysqlbinlog2blinker.shard<shard>.binlog.pos* at current
+                working dir
+            interval (float): see
+                :py:class:`binlog_pos_memory.FileBasedBinlogPosMemory`
+            server_id (int|None): server id of shard 0, shard *i* uses
+                *server_id* + *i*, None picks a random one
+            restart_delay (float): seconds to wait before restarting a
+                child which exited
+            max_restart_delay (float): max seconds to wait, see module's
+                doc
+            **kwargs: passed to
+                :py:func:`mysqlbinlog2blinker.start_replication` in each
+                child
+        """
+        assert shards > 0
+        if tables is None:
+            tables = _subscribers.subscribed_tables()
+            if not tables:
+                raise ValueError('Tables to replicate can not be guessed '
+                                 'from the receivers, give them')
+        if pos_filename is None:
+            pos_filename = os.path.join(
+                os.getcwd(), 'mysqlbinlog2blinker.shard%d.binlog.pos')
+        if server_id is None:
+            server_id = random.randint(1000000000, 4294967295 - shards)
+
+        self.mysql_settings = mysql_settings
+        self.shards = shards
+        self.setup = setup
+        self.interval = interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.kwargs = kwargs
+
+        self._children = []
+        for i, shard_tables in enumerate(split_tables(tables, shards,
+                                                      table_map)):
+            if not shard_tables:
+                _logger.warning('Shard %d has no table', i)
+                continue
+            child_pos_filename = _shard_pos_filename(pos_filename, i)
+            self._children.append(_Child(i, shard_tables, server_id + i,
+                                         child_pos_filename))
+        self._stop_flag = threading.Event()
+        # children are not restarted while they are being stopped
+        self._lock = threading.Lock()
+
+    def assignments(self):
+        """ Get the tables of each shard
+
+        Returns:
+            dict: shard => list of schema.table
+        """
+        return dict((child.index, child.tables) for child in self._children)
+
+    def stats(self):
+        """ Get the state of each child
+
+        Returns:
+            list[dict]: shard, tables, server_id, pos_filename, pid, alive
+                and restarts of each child
+        """
+        stats = []
+        for child in self._children:
+            process = child.process
+            stats.append(dict(
+                shard=child.index,
+                tables=child.tables,
+                server_id=child.server_id,
+                pos_filename=child.pos_filename,
+                pid=process.pid if process is not None else None,
+                alive=process is not None and process.is_alive(),
+                restarts=child.restarts,
+            ))
+        return stats
+
+    def _start_child(self, child):
+        kwargs = dict(self.kwargs)
+        kwargs['server_id'] = child.server_id
+        child.process = multiprocessing.Process(
+            target=_child_main,
+            args=(child.index, self.mysql_settings, child.tables,
+                  child.pos_filename, self.interval, self.setup, kwargs),
+            name='mysqlbinlog2blinker-shard-%d' % child.index,
+        )
+        child.process.daemon = True
+        child.process.start()
+        child.started = time.time()
+        child.restart_at = None
+        _logger.debug('Started shard %d (pid %s, server_id %d)',
+                      child.index, child.process.pid, child.server_id)
+
+    def start(self):
+        """ Start the children """
+        self._stop_flag.clear()
+        for child in self._children:
+            self._start_child(child)
+
+    def supervise(self, poll_interval=0.5):
+        """ Restart children which exit, until :py:meth:`stop` is called
+
+        Args:
+            poll_interval (float): seconds between checks of the children
+        """
+        while not self._stop_flag.wait(poll_interval):
+            with self._lock:
+                if not self._stop_flag.is_set():
+                    self._check_children()
+
+    def _check_children(self):
+        now = time.time()
+        for child in self._children:
+            if child.restart_at is not None:
+                if now >= child.restart_at:
+                    child.restarts += 1
+                    self._start_child(child)
+                continue
+            if child.process.is_alive():
+                continue
+            if now - child.started >= _STABLE_SECONDS or \
+                    child.restart_delay is None:
+                child.restart_delay = self.restart_delay
+            else:
+                child.restart_delay = min(child.restart_delay * 2,
+                                          self.max_restart_delay)
+            _logger.error('Shard %d exited with code %s, restarting in '
+                          '%.1fs', child.index, child.process.exitcode,
+                          child.restart_delay)
+            child.restart_at = now + child.restart_delay
+
+    def stop(self, timeout=10):
+        """ Stop the supervision and the children
+
+        Args:
+            timeout (float): seconds to wait for each child to save its
+                position before killing it
+        """
+        self._stop_flag.set()
+        with self._lock:
+            for child in self._children:
+                if child.process is not None and child.process.is_alive():
+                    child.process.terminate()
+        for child in self._children:
+            if child.process is None:
+                continue
+            child.process.join(timeout)
+            if child.process.is_alive():
+                _logger.warning('Shard %d did not stop, killing it',
+                                child.index)
+                os.kill(child.process.pid, getattr(signal, 'SIGKILL',
+                                                   signal.SIGTERM))
+                child.process.join()
+
+    def run(self, poll_interval=0.5):
+        """ Start the children and supervise them until :py:meth:`stop` is
+        called from another thread or the coordinator is interrupted
+        """
+        self.start()
+        try:
+            self.supervise(poll_interval)
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -29,7 +29,29 @@ sender, so if you want to subscribe for one table only, just specify it via
 sender argument of *connect* method.
 
 There are 3 signals: rows_inserted, rows_updated, rows_deleted
+
+Their *on_xxx* helpers also accept the columns that the receiver needs, then
+rows of that table only carry (and only diff) the union of the columns that
+its receivers need, plus the primary key:
+
+    @on_rows_updated(sender='db.orders', columns=['id', 'status'])
+    def subscriber(table_name, rows, meta):
+        pass
+
+**Transaction signal**
+
+Will be sent once per committed transaction when publishing with
+:py:class:`mysqlbinlog2blinker.dispatchers.TransactionDispatcher`.
+
+    def subscriber(changes, meta):
+        pass
+
+Where changes is a list of (table_name, rows, meta), one per rows event of the
+transaction, and meta describes the transaction (xid, time, log_file,
+log_pos, begin_log_file, begin_log_pos).
 """
+import weakref
+
 import blinker
 
 __author__ = 'tarzan'
@@ -37,6 +59,139 @@ __author__ = 'tarzan'
 
 _signals = blinker.Namespace()
 
+# (signal name, sender, receiver key) => receiver ref, for the receivers of
+# the signals given to _track_connections, dead ones are removed
+_connections = {}
+
+# (signal name, sender, receiver key) => needed columns
+_receiver_columns = {}
+
+# changed on each connection, disconnection or death of a tracked receiver
+_version = [0]
+
+
+def _receiver_key(receiver):
+    # bound methods are recreated on each access, identify them by parts
+    if hasattr(receiver, '__self__') and hasattr(receiver, '__func__'):
+        return id(receiver.__self__), id(receiver.__func__)
+    return id(receiver)
+
+
+def _receiver_ref(receiver, callback=None):
+    """ Make a reference to check that a key still belongs to *receiver*,
+    *callback* is called with it when the receiver dies
+    """
+    obj = getattr(receiver, '__self__', receiver)
+    try:
+        return weakref.ref(obj, callback)
+    except TypeError:
+        return lambda: obj
+
+
+def _forget_connection(key, ref=None):
+    if ref is None or _connections.get(key) is ref:
+        _connections.pop(key, None)
+        _receiver_columns.pop(key, None)
+        _version[0] += 1
+
+
+def _on_receiver_connected(sig, receiver=None, sender=blinker.ANY, **kwargs):
+    key = (sig.name, sender, _receiver_key(receiver))
+    _connections[key] = _receiver_ref(
+        receiver, lambda ref: _forget_connection(key, ref))
+    _version[0] += 1
+
+
+def _on_receiver_disconnected(sig, receiver=None, sender=blinker.ANY,
+                              **kwargs):
+    key = _receiver_key(receiver)
+    for k in list(_connections):
+        if k[0] == sig.name and k[2] == key and \
+                (sender is blinker.ANY or k[1] == sender):
+            _forget_connection(k)
+    _version[0] += 1
+
+
+def _track_connections(sig):
+    """ Keep which receivers are connected to *sig*, for which senders """
+    sig.receiver_connected.connect(_on_receiver_connected, sender=sig)
+    sig.receiver_disconnected.connect(_on_receiver_disconnected, sender=sig)
+
+
+def _get_receiver_columns(sig, sender, receiver):
+    key = (sig.name, sender, _receiver_key(receiver))
+    ref = _connections.get(key)
+    # a dead receiver's id may be reused by another one
+    if ref is None or ref() is not getattr(receiver, '__self__', receiver):
+        return None
+    return _receiver_columns.get(key)
+
+
+def connected_senders(sig):
+    """ Get the senders which receivers of a rows or transaction signal are
+    connected for
+
+    Returns:
+        set: the senders, :py:data:`blinker.ANY` for receivers of any sender
+    """
+    return set(key[1] for key, ref in list(_connections.items())
+               if key[0] == sig.name and ref() is not None)
+
+
+def connections_version():
+    """ Get a number which changes whenever a receiver of a rows or
+    transaction signal is connected, disconnected or garbage collected
+    """
+    return _version[0]
+
+
+def _connect_with_columns(sig):
+    """ Make a *connect* of *sig* which also accepts the needed columns """
+    def connect(receiver=None, sender=blinker.ANY, weak=True, columns=None):
+        """ Connect *receiver* to the signal, or return a decorator doing it
+        when *receiver* is not given
+
+        Args:
+            receiver (callable): the receiver
+            sender: the sender, schema.table for the rows signals
+            weak (bool): keep a weak reference to the receiver
+            columns (list[str]|None): the columns the receiver needs, None
+                means all columns
+        """
+        if receiver is None:
+            def decorator(fn):
+                connect(fn, sender=sender, weak=weak, columns=columns)
+                return fn
+            return decorator
+        result = sig.connect(receiver, sender=sender, weak=weak)
+        key = (sig.name, sender, _receiver_key(receiver))
+        if columns is None:
+            _receiver_columns.pop(key, None)
+        else:
+            _receiver_columns[key] = frozenset(columns)
+        _version[0] += 1
+        return result
+    _track_connections(sig)
+    return connect
+
+
+def subscribed_columns(sig, sender):
+    """ Get the union of columns that receivers of *sig* for *sender* need
+
+    Returns:
+        frozenset|None: the columns, None if a receiver needs all columns
+    """
+    columns = set()
+    for receiver in sig.receivers_for(sender):
+        receiver_columns = _get_receiver_columns(sig, sender, receiver)
+        if receiver_columns is None:
+            receiver_columns = _get_receiver_columns(sig, blinker.ANY,
+                                                     receiver)
+            if receiver_columns is None:
+                return None
+        columns.update(receiver_columns)
+    return frozenset(columns)
+
 
 # position signal
 binlog_position_signal = _signals.signal(
@@ -59,7 +214,7 @@ rows_inserted = _signals.signal(
     doc='fired on each WriteRowsEvent come, after convert data into dict',
 )
 """:type: blinker.NamedSignal"""
-on_rows_inserted = rows_inserted.connect
+on_rows_inserted = _connect_with_columns(rows_inserted)
 
 # def subscriber(table_name, rows, meta)
 rows_updated = _signals.signal(
@@ -67,7 +222,7 @@ rows_updated = _signals.signal(
     doc='fired on each UpdateRowsEvent come, after convert data into dict',
 )
 """:type: blinker.NamedSignal"""
-on_rows_updated = rows_updated.connect
+on_rows_updated = _connect_with_columns(rows_updated)
 
 # def subscriber(table_name, rows, meta)
 rows_deleted = _signals.signal(
@@ -75,4 +230,23 @@ rows_deleted = _signals.signal(
     doc='fired on each DeleteRowsEvent come, after convert data into dict',
 )
 """:type: blinker.NamedSignal"""
-on_rows_deleted = rows_deleted.connect
+on_rows_deleted = _connect_with_columns(rows_deleted)
+
+# name => rows signal
+ROWS_SIGNALS = dict((sig.name, sig) for sig in (rows_inserted, rows_updated,
+                                                rows_deleted))
+# action of meta => name of its rows signal
+ACTION_SIGNAL_NAMES = {
+    'insert': rows_inserted.name,
+    'update': rows_updated.name,
+    'delete': rows_deleted.name,
+}
+
+# def subscriber(changes, meta)
+transaction_signal = _signals.signal(
+    'transaction',
+    doc='fired on each committed transaction, with the changes of all tables',
+)
+""":type: blinker.NamedSignal"""
+on_transaction = transaction_signal.connect
+_track_connections(transaction_signal)
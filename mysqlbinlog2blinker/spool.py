@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+""" Keep converted changes in a local log that consumers replay
+
+A :py:class:`SpoolDispatcher` appends the rows of every event to a
+:py:class:`Spool`, a directory of append-only segments, instead of (or
+before) sending the rows signals:
+
+    spool = Spool('/var/spool/binlog', retention_bytes=10 * 1024 ** 3)
+    start_replication(mysql_settings, dispatcher=SpoolDispatcher(spool))
+
+Each change gets a sequential offset. Any number of processes read the spool
+at their own pace with a :py:class:`SpoolReader`, which remembers its offset
+in a file and sends the rows signals again:
+
+    reader = SpoolReader('/var/spool/binlog', '/var/lib/app/spool.offset')
+    reader.replay(follow=True)
+
+so a slow or restarted consumer replays from the local disk, while one
+replication connection serves them all.
+
+A segment ``<base offset>.log`` holds records (length, crc32, payload) and
+its ``<base offset>.idx`` the file position of each record, as 8 bytes. A
+record is only visible to readers once its index entry is written, which is
+after the record itself. Payloads are :py:mod:`codec` messages, whose
+table schemas are defined again in each segment, and readers map segments
+into memory. Whole segments are deleted, oldest first, once the spool is
+over *retention_bytes* or their last write is older than
+*retention_seconds*; readers which were behind then skip to the oldest
+offset left.
+
+The position of the binlog stream is published once the changes before it
+are written to the spool (and synced, as often as *fsync_interval* says),
+changes are then delivered at least once: the ones spooled after the last
+saved position are spooled again after a crash.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from mysqlbinlog2blinker import (
+    binlog_pos_memory as _bpm,
+    codec,
+    signals,
+    stats as _stats,
+)
+from mysqlbinlog2blinker.dispatchers import BaseDispatcher
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+# os.rename does not replace an existing file on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+#: payload length, crc32 of the payload
+_HEADER = struct.Struct('<II')
+#: file position of a record in its segment
+_INDEX = struct.Struct('<Q')
+
+_LOG_SUFFIX = '.log'
+_INDEX_SUFFIX = '.idx'
+
+
+def _segment_filename(directory, base, suffix):
+    return os.path.join(directory, '%020d%s' % (base, suffix))
+
+
+def _segment_bases(directory):
+    """ Get the base offsets of the segments in a directory, sorted """
+    bases = []
+    for name in os.listdir(directory):
+        if name.endswith(_LOG_SUFFIX) and name[:-len(_LOG_SUFFIX)].isdigit():
+            bases.append(int(name[:-len(_LOG_SUFFIX)]))
+    return sorted(bases)
+
+
+class Spool(object):
+    """ Writer of a segmented append-only log, see module's doc
+
+    Only one process may write to a spool directory.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024,
+                 retention_bytes=None, retention_seconds=None,
+                 fsync_interval=None):
+        """ Open or create a spool
+
+        Args:
+            directory (str): where segments are, created if needed
+            segment_bytes (int): size after which a new segment is started
+            retention_bytes (int|None): delete the oldest segments when
+                the spool is larger, None to keep them
+            retention_seconds (float|None): delete segments whose last write
+                is older, None to keep them
+            fsync_interval (float|None): fsync on flush when the last fsync is
+                older than this in seconds, 0 syncs every flush, None never
+                syncs explicitly
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.fsync_interval = fsync_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._log = None
+        self._index = None
+        # index entries are written after their records are flushed
+        self._pending_index = []
+        self._last_fsync = 0.0
+        bases = _segment_bases(directory)
+        if bases:
+            self._base = bases[-1]
+            self._count, self._size = self._recover(self._base)
+        else:
+            self._base = 0
+            self._count = self._size = 0
+        self._open_segment()
+        self.apply_retention()
+
+    def _recover(self, base):
+        """ Drop the records of the last segment which were not completely
+        written
+
+        Returns:
+            tuple: (records, size of the log) of the segment
+        """
+        log_filename = _segment_filename(self.directory, base, _LOG_SUFFIX)
+        index_filename = _segment_filename(self.directory, base,
+                                           _INDEX_SUFFIX)
+        with open(index_filename, 'ab+') as f:
+            f.seek(0)
+            index = f.read()
+        count = len(index) // _INDEX.size
+        log_size = os.path.getsize(log_filename)
+        with open(log_filename, 'rb') as f:
+            while count:
+                pos, = _INDEX.unpack_from(index, (count - 1) * _INDEX.size)
+                f.seek(pos)
+                header = f.read(_HEADER.size)
+                if len(header) == _HEADER.size:
+                    length, crc = _HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length and \
+                            zlib.crc32(payload) & 0xffffffff == crc:
+                        break
+                count -= 1
+        size = 0
+        if count:
+            size = pos + _HEADER.size + length
+        if size != log_size or count * _INDEX.size != len(index):
+            _logger.warning('Truncate spool segment %s to %d records',
+                            log_filename, count)
+            with open(log_filename, 'rb+') as f:
+                f.truncate(size)
+            with open(index_filename, 'rb+') as f:
+                f.truncate(count * _INDEX.size)
+        return count, size
+
+    def _open_segment(self):
+        self._log = open(_segment_filename(self.directory, self._base,
+                                           _LOG_SUFFIX), 'ab')
+        self._index = open(_segment_filename(self.directory, self._base,
+                                             _INDEX_SUFFIX), 'ab')
+
+    @property
+    def next_offset(self):
+        """ Offset of the next appended record """
+        return self._base + self._count
+
+    def append(self, payload):
+        """ Append a record
+
+        Args:
+            payload (bytes): the record
+
+        Returns:
+            int: offset of the record
+        """
+        self.roll_if_full()
+        offset = self._base + self._count
+        self._log.write(_HEADER.pack(len(payload),
+                                     zlib.crc32(payload) & 0xffffffff))
+        self._log.write(payload)
+        self._pending_index.append(_INDEX.pack(self._size))
+        self._size += _HEADER.size + len(payload)
+        self._count += 1
+        return offset
+
+    def roll_if_full(self):
+        """ Start a new segment if the current one is full
+
+        Returns:
+            int: base offset of the current segment
+        """
+        if self._size >= self.segment_bytes and self._count:
+            self._roll()
+        return self._base
+
+    def flush(self):
+        """ Make appended records visible to readers, and durable as
+        *fsync_interval* says
+        """
+        # records first, readers trust the index
+        self._log.flush()
+        self._index.write(b''.join(self._pending_index))
+        del self._pending_index[:]
+        interval = self.fsync_interval
+        if interval is not None and \
+                time.time() - self._last_fsync >= interval:
+            os.fsync(self._log.fileno())
+            self._index.flush()
+            os.fsync(self._index.fileno())
+            self._last_fsync = time.time()
+        else:
+            self._index.flush()
+
+    def _roll(self):
+        self.flush()
+        self._log.close()
+        self._index.close()
+        self._base += self._count
+        self._count = self._size = 0
+        self._open_segment()
+        _logger.debug('Start spool segment %d', self._base)
+        self.apply_retention()
+
+    def apply_retention(self):
+        """ Delete the oldest segments beyond the retention limits, the
+        current segment is always kept
+        """
+        bases = _segment_bases(self.directory)[:-1]
+        if not bases or (self.retention_bytes is None and
+                         self.retention_seconds is None):
+            return
+        sizes = []
+        for base in bases:
+            stat = os.stat(_segment_filename(self.directory, base,
+                                             _LOG_SUFFIX))
+            sizes.append((base, stat.st_size, stat.st_mtime))
+        total = sum(size for _, size, _ in sizes) + self._size
+        now = time.time()
+        for base, size, mtime in sizes:
+            if (self.retention_bytes is None or
+                    total <= self.retention_bytes) and \
+                    (self.retention_seconds is None or
+                     now - mtime <= self.retention_seconds):
+                break
+            _logger.info('Delete spool segment %d', base)
+            for suffix in (_LOG_SUFFIX, _INDEX_SUFFIX):
+                os.remove(_segment_filename(self.directory, base, suffix))
+            total -= size
+
+    def close(self):
+        if self._log is None:
+            return
+        self.flush()
+        self._log.close()
+        self._index.close()
+        self._log = self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SpoolDispatcher(BaseDispatcher):
+    """ Append the rows of every event to a :py:class:`Spool`
+
+    Rows of every table are spooled, whether they have receivers in this
+    process or not. With a *dispatcher*, the rows are also handed to it, and
+    it decides when the position is published.
+    """
+    all_rows = True
+
+    def __init__(self, spool, dispatcher=None):
+        """ Create a SpoolDispatcher
+
+        Args:
+            spool (Spool): where changes are appended, closed with the
+                dispatcher
+            dispatcher (dispatchers.BaseDispatcher|None): also delivers the
+                rows signals in this process, None to only spool them
+        """
+        self.spool = spool
+        self.dispatcher = dispatcher
+        self.only_events = getattr(dispatcher, 'only_events', ())
+        # schemas are defined again in each segment
+        self._encoder = codec.Encoder()
+        self._segment_base = None
+
+    def dispatch(self, sig, table_name, rows, meta):
+        started = _stats._timer()
+        base = self.spool.roll_if_full()
+        if base != self._segment_base:
+            self._encoder.reset()
+            self._segment_base = base
+        self.spool.append(self._encoder.encode(table_name, rows, meta))
+        _stats.observe('spool_append_seconds', table_name,
+                       _stats._timer() - started)
+        if self.dispatcher is not None:
+            self.dispatcher.dispatch(sig, table_name, rows, meta)
+
+    def position(self, log_file, log_pos):
+        self.spool.flush()
+        if self.dispatcher is not None:
+            self.dispatcher.position(log_file, log_pos)
+        else:
+            _bpm.publish_position(log_file, log_pos)
+
+    def handle_event(self, event, stream):
+        if self.dispatcher is not None:
+            self.dispatcher.handle_event(event, stream)
+
+    def flush(self):
+        self.spool.flush()
+        if self.dispatcher is not None:
+            self.dispatcher.flush()
+
+    def close(self):
+        try:
+            if self.dispatcher is not None:
+                self.dispatcher.close()
+        finally:
+            self.spool.close()
+
+
+class _Segment(object):
+    """ Memory mapped log and index of a segment, remapped as they grow """
+    def __init__(self, directory, base):
+        self.base = base
+        self._log = open(_segment_filename(directory, base, _LOG_SUFFIX),
+                         'rb')
+        self._index = open(_segment_filename(directory, base, _INDEX_SUFFIX),
+                           'rb')
+        self._log_map = self._index_map = None
+        self.decoder = None
+
+    @staticmethod
+    def _remap(f, current, needed):
+        if current is not None and len(current) >= needed:
+            return current
+        size = os.fstat(f.fileno()).st_size
+        if size < needed or size == 0:
+            return current
+        if current is not None:
+            current.close()
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def count(self):
+        """ Get how many records are visible """
+        size = os.fstat(self._index.fileno()).st_size
+        return size // _INDEX.size
+
+    def read(self, i):
+        """ Get the payload of the i-th record, None if it is not visible """
+        end = (i + 1) * _INDEX.size
+        self._index_map = self._remap(self._index, self._index_map, end)
+        if self._index_map is None or len(self._index_map) < end:
+            return None
+        pos, = _INDEX.unpack_from(self._index_map, i * _INDEX.size)
+        self._log_map = self._remap(self._log, self._log_map,
+                                    pos + _HEADER.size)
+        if self._log_map is None or len(self._log_map) < pos + _HEADER.size:
+            return None
+        length, crc = _HEADER.unpack_from(self._log_map, pos)
+        start = pos + _HEADER.size
+        self._log_map = self._remap(self._log, self._log_map, start + length)
+        if len(self._log_map) < start + length:
+            return None
+        payload = self._log_map[start:start + length]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise ValueError('Corrupted record %d of spool segment %d' %
+                             (i, self.base))
+        return payload
+
+    def close(self):
+        for m in (self._log_map, self._index_map):
+            if m is not None:
+                m.close()
+        self._log.close()
+        self._index.close()
+
+
+class SpoolReader(object):
+    """ Read a :py:class:`Spool`, from any process, see module's doc """
+    def __init__(self, directory, offset_filename=None, offset=None):
+        """ Create a SpoolReader
+
+        Args:
+            directory (str): directory of the spool
+            offset_filename (str|None): file keeping the offset to read next
+                across restarts, see :py:meth:`commit`
+            offset (int|None): offset to read first, by default the one in
+                *offset_filename*, else the oldest in the spool
+        """
+        self.directory = directory
+        self.offset_filename = offset_filename
+        if offset is None and offset_filename is not None:
+            try:
+                with open(offset_filename) as f:
+                    offset = int(f.read().strip())
+            except (IOError, OSError, ValueError):
+                offset = None
+        self.offset = offset
+        #: records deleted by retention before they were read
+        self.skipped = 0
+        self._segment = None
+
+    def _find_segment(self):
+        """ Open the segment holding the current offset, False if there is
+        none yet
+        """
+        bases = _segment_bases(self.directory)
+        if not bases:
+            return False
+        if self.offset is None:
+            self.offset = bases[0]
+        if self.offset < bases[0]:
+            _logger.warning('Spool offsets %d to %d were deleted before they '
+                            'were read', self.offset, bases[0] - 1)
+            self.skipped += bases[0] - self.offset
+            self.offset = bases[0]
+        base = max(b for b in bases if b <= self.offset)
+        if self._segment is not None:
+            if self._segment.base == base:
+                return True
+            self._segment.close()
+        self._segment = _Segment(self.directory, base)
+        return True
+
+    def read(self, max_records=1000):
+        """ Read the next records that are visible
+
+        Returns:
+            list[tuple]: (offset, payload) pairs, empty at the end
+        """
+        return self._read(max_records, lambda segment, payload: payload)
+
+    def changes(self, max_records=1000):
+        """ Like :py:meth:`read`, with the changes decoded
+
+        Returns:
+            list[tuple]: (offset, sig, table_name, rows, meta)
+        """
+        return [(offset, ) + change
+                for offset, change in self._read(max_records, self._decode)]
+
+    def _decode(self, segment, payload):
+        if segment.decoder is None:
+            # schemas are defined by the earlier records of the segment
+            segment.decoder = codec.Decoder()
+            for i in range(self.offset - segment.base):
+                segment.decoder.learn(segment.read(i))
+        table_name, rows, meta = segment.decoder.decode(payload)
+        sig_name = signals.ACTION_SIGNAL_NAMES[meta['action']]
+        sig = signals.ROWS_SIGNALS[sig_name]
+        return sig, table_name, rows, meta
+
+    def _read(self, max_records, convert):
+        records = []
+        if self._segment is None and not self._find_segment():
+            return records
+        while len(records) < max_records:
+            segment = self._segment
+            payload = segment.read(self.offset - segment.base)
+            if payload is None:
+                # the end, unless the writer moved to a newer segment
+                if not self._find_segment() or self._segment is segment:
+                    break
+                continue
+            records.append((self.offset, convert(segment, payload)))
+            self.offset += 1
+        return records
+
+    def lag(self):
+        """ Get how many records are visible but not read yet """
+        bases = _segment_bases(self.directory)
+        if not bases:
+            return 0
+        last = _Segment(self.directory, bases[-1])
+        try:
+            end = bases[-1] + last.count()
+        finally:
+            last.close()
+        return max(0, end - max(self.offset or 0, bases[0]))
+
+    def commit(self):
+        """ Save the offset to read next into *offset_filename* """
+        if self.offset_filename is None or self.offset is None:
+            return
+        tmp_filename = self.offset_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write('%d' % self.offset)
+        _replace(tmp_filename, self.offset_filename)
+
+    def replay(self, follow=False, poll_interval=0.1, max_records=1000):
+        """ Send the rows signals of the changes, committing the offset after
+        each read. Meta of the signals also carries *spool_offset*
+
+        Args:
+            follow (bool): wait for new changes instead of returning at the
+                end
+            poll_interval (float): seconds between reads at the end
+            max_records (int): records read at once
+        """
+        while True:
+            changes = self.changes(max_records)
+            for offset, sig, table_name, rows, meta in changes:
+                meta['spool_offset'] = offset
+                _stats.send(sig, table_name, rows=rows, meta=meta)
+            if changes:
+                self.commit()
+            elif follow:
+                time.sleep(poll_interval)
+            else:
+                return
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+""" Throughput, latency and replication lag metrics
+
+Stats are off by default, publishing then only pays a check per event.
+Once enabled, they are collected into a :py:class:`Stats`:
+
+    from mysqlbinlog2blinker import stats
+
+    collector = stats.enable()
+    stats.serve(port=9108)  # optional, text exposition at /metrics
+    start_replication(mysql_settings)
+
+    # from another thread
+    collector.snapshot()
+
+It collects:
+
+* *events* and *rows*: counters per table and action
+* *convert_seconds*: histogram of the time converting an event, per table
+* *signal_seconds*: histogram of the time sending a signal, per signal
+* *receiver_seconds*: histogram of the time in a receiver, per signal and
+  receiver
+* *position_save_seconds*: histogram of the time saving a position, per
+  position memory class
+* *spool_append_seconds*: histogram of the time appending an event to a
+  spool, per table
+* *lag_seconds*: gauge, wall clock minus the timestamp of the last event
+
+Counters and histograms are kept per thread, so recording takes no lock,
+and are summed up by :py:meth:`Stats.snapshot`. Histograms have fixed
+buckets, their quantiles are the upper bound of the bucket they fall in.
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+__author__ = 'tarzan'
+_logger = logging.getLogger(__name__)
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+#: default upper bounds of histograms' buckets, in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+           0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+# metric => names of the parts of its labels
+LABELS = {
+    'events': ('table', 'action'),
+    'rows': ('table', 'action'),
+    'convert_seconds': ('table', ),
+    'signal_seconds': ('signal', ),
+    'receiver_seconds': ('signal', 'receiver'),
+    'position_save_seconds': ('memory', ),
+    'spool_append_seconds': ('table', ),
+    'lag_seconds': (),
+}
+
+#: the enabled Stats, None when stats are off
+current = None
+
+
+class _Histogram(object):
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class _ThreadStats(object):
+    """ Counters and histograms recorded by one thread """
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+def _label_key(label):
+    if label is None:
+        return ''
+    if isinstance(label, tuple):
+        return ':'.join(str(part) for part in label)
+    return str(label)
+
+
+class Stats(object):
+    """ Collected metrics, see module's doc """
+    def __init__(self, buckets=BUCKETS):
+        """ Create a Stats
+
+        Args:
+            buckets (tuple[float]): sorted upper bounds of the histograms'
+                buckets, a last bucket takes larger values
+        """
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._local = threading.local()
+        self._threads = []
+        # only taken when a thread records for the first time
+        self._lock = threading.Lock()
+        # (name, label) => last value
+        self._gauges = {}
+
+    def _thread_stats(self):
+        try:
+            return self._local.stats
+        except AttributeError:
+            stats = self._local.stats = _ThreadStats()
+            with self._lock:
+                self._threads.append(stats)
+            return stats
+
+    def incr(self, name, label=None, value=1):
+        """ Add *value* to a counter """
+        counters = self._thread_stats().counters
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, label, value):
+        """ Record *value* in a histogram """
+        histograms = self._thread_stats().histograms
+        key = (name, label)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(self.buckets)
+        histogram.counts[bisect.bisect_left(self.buckets, value)] += 1
+        histogram.count += 1
+        histogram.sum += value
+        if value > histogram.max:
+            histogram.max = value
+
+    def set_gauge(self, name, label, value):
+        """ Set the value of a gauge """
+        self._gauges[(name, label)] = value
+
+    def send(self, sig, sender, **kwargs):
+        """ Send a signal like :py:meth:`blinker.Signal.send`, timing it and
+        each of its receivers
+        """
+        results = []
+        started = _timer()
+        # an installed profiling.ReceiverProfiler wraps the receivers
+        profiler = getattr(sig, '_profiler', None)
+        if profiler is None:
+            receivers = sig.receivers_for(sender)
+        else:
+            receivers = profiler.receivers_for(sig, sender)
+        for receiver in receivers:
+            receiver_started = _timer()
+            if profiler is None:
+                result = receiver(sender, **kwargs)
+            else:
+                result = profiler.call(sig, receiver, sender, kwargs)
+            results.append((receiver, result))
+            self.observe('receiver_seconds',
+                         (sig.name, _receiver_name(receiver)),
+                         _timer() - receiver_started)
+        self.observe('signal_seconds', sig.name, _timer() - started)
+        return results
+
+    def snapshot(self):
+        """ Get the metrics
+
+        Returns:
+            dict: *uptime_seconds*, *counters*, *gauges* and *histograms*,
+                each metric maps its labels, parts joined by ``:``, to the
+                value. A histogram's value has *count*, *sum*, *mean*,
+                *max*, quantiles (*p50*, *p90*, *p99*) and *buckets*, the
+                cumulative count of each upper bound
+        """
+        counters = {}
+        merged = {}
+        with self._lock:
+            threads = list(self._threads)
+        for stats in threads:
+            for (name, label), value in list(stats.counters.items()):
+                values = counters.setdefault(name, {})
+                key = _label_key(label)
+                values[key] = values.get(key, 0) + value
+            for key, histogram in list(stats.histograms.items()):
+                total = merged.get(key)
+                if total is None:
+                    total = merged[key] = _Histogram(self.buckets)
+                for i, count in enumerate(histogram.counts):
+                    total.counts[i] += count
+                total.count += histogram.count
+                total.sum += histogram.sum
+                total.max = max(total.max, histogram.max)
+
+        histograms = {}
+        for (name, label), histogram in merged.items():
+            histograms.setdefault(name, {})[_label_key(label)] = \
+                self._summary(histogram)
+        gauges = {}
+        for (name, label), value in list(self._gauges.items()):
+            gauges.setdefault(name, {})[_label_key(label)] = value
+        return dict(uptime_seconds=time.time() - self.started,
+                    counters=counters, gauges=gauges, histograms=histograms)
+
+    def _summary(self, histogram):
+        bounds = self.buckets + (float('inf'), )
+        cumulative = []
+        total = 0
+        for count in histogram.counts:
+            total += count
+            cumulative.append(total)
+        summary = dict(
+            count=histogram.count,
+            sum=histogram.sum,
+            mean=histogram.sum / histogram.count if histogram.count else 0.0,
+            max=histogram.max,
+            buckets=list(zip(bounds, cumulative)),
+        )
+        for q in QUANTILES:
+            i = bisect.bisect_left(cumulative, q * histogram.count)
+            summary['p%d' % (q * 100)] = \
+                min(bounds[min(i, len(bounds) - 1)], histogram.max)
+        return summary
+
+    def render_text(self, prefix='mysqlbinlog2blinker_'):
+        """ Get the metrics in the Prometheus text exposition format """
+        snapshot = self.snapshot()
+        lines = ['%suptime_seconds %r' % (prefix,
+                                          snapshot['uptime_seconds'])]
+        for kind, suffix in (('counters', '_total'), ('gauges', '')):
+            for name, values in sorted(snapshot[kind].items()):
+                lines.append('# TYPE %s%s%s %s' % (
+                    prefix, name, suffix,
+                    'counter' if kind == 'counters' else 'gauge'))
+                for key, value in sorted(values.items()):
+                    lines.append('%s%s%s%s %r' % (prefix, name, suffix,
+                                                  _labels(name, key), value))
+        for name, values in sorted(snapshot['histograms'].items()):
+            lines.append('# TYPE %s%s histogram' % (prefix, name))
+            for key, summary in sorted(values.items()):
+                for bound, count in summary['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s%s_bucket%s %d' % (
+                        prefix, name, _labels(name, key, le=le), count))
+                labels = _labels(name, key)
+                lines.append('%s%s_sum%s %r' % (prefix, name, labels,
+                                                summary['sum']))
+                lines.append('%s%s_count%s %d' % (prefix, name, labels,
+                                                  summary['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _receiver_name(receiver):
+    name = getattr(receiver, '__qualname__', None) or \
+        getattr(receiver, '__name__', None)
+    if name is None:
+        return repr(receiver)
+    return '%s.%s' % (getattr(receiver, '__module__', None), name)
+
+
+def _labels(name, key, **extra):
+    parts = LABELS.get(name, ('key', ))
+    values = key.split(':', len(parts) - 1) if parts else []
+    labels = list(zip(parts, values)) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (label, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for label, value in labels)
+
+
+def enable(stats=None):
+    """ Start collecting stats
+
+    Args:
+        stats (Stats|None): where to collect them, None makes a new one
+
+    Returns:
+        Stats: the enabled stats
+    """
+    global current
+    current = stats or Stats()
+    return current
+
+
+def disable():
+    """ Stop collecting stats """
+    global current
+    current = None
+
+
+def observe(name, label, value):
+    """ Record *value* in a histogram of the enabled stats, if any """
+    stats = current
+    if stats is not None:
+        stats.observe(name, label, value)
+
+
+def send(sig, sender, **kwargs):
+    """ Send a signal, timed when stats are enabled """
+    stats = current
+    if stats is None:
+        return sig.send(sender, **kwargs)
+    return stats.send(sig, sender, **kwargs)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stats = current
+        if stats is None:
+            self.send_error(503, 'Stats are not enabled')
+            return
+        if self.path.split('?')[0] == '/metrics':
+            body = stats.render_text()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] == '/stats.json':
+            body = json.dumps(stats.snapshot(), default=str)
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+def serve(port=9108, host='127.0.0.1'):
+    """ Serve the enabled stats over HTTP, from a daemon thread
+
+    ``/metrics`` is in the text exposition format, ``/stats.json`` is the
+    snapshot as JSON.
+
+    Args:
+        port (int): the port, 0 picks a free one
+        host (str): the interface, local only by default
+
+    Returns:
+        HTTPServer: the server, ``server_address`` tells the port and
+            ``shutdown()`` stops it
+    """
+    server = HTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='mysqlbinlog2blinker-stats')
+    thread.daemon = True
+    thread.start()
+    _logger.info('Serving stats on http://%s:%d/metrics',
+                 *server.server_address[:2])
+    return server
@@ -9,6 +9,7 @@ import os
 
 import pymysql
 import pytest
+from pymysqlreplication import row_event
 
 
 @pytest.fixture(scope="session")
@@ -58,4 +59,84 @@ def mysql_settings(conf):
 @pytest.fixture(scope="class")
 def class_mysql_settings(request, mysql_settings):
     # set a class attribute on the invoking test context
-    request.cls.mysql_settings = mysql_settings
\ No newline at end of file
+    request.cls.mysql_settings = mysql_settings
+
+
+_ROWS_EVENTS = {
+    'insert': row_event.WriteRowsEvent,
+    'update': row_event.UpdateRowsEvent,
+    'delete': row_event.DeleteRowsEvent,
+}
+
+
+class FakeStream(object):
+    """Replay events like a BinLogStreamReader, without any MySQL server
+    """
+    def __init__(self, events, log_file='mysql-bin.000001'):
+        self.events = events
+        self.log_file = log_file
+        self.log_pos = 4
+        self.table_map = {}
+
+    def __iter__(self):
+        for event in self.events:
+            self.log_pos += 100
+            yield event
+
+
+@pytest.fixture
+def make_rows_event():
+    """Factory of RowsEvent whose rows are given instead of being decoded
+    """
+    def make(action, rows, schema='testdb', table='tbl0', primary_key='id',
+             timestamp=1451606400):
+        cls = _ROWS_EVENTS[action]
+        event = cls.__new__(cls)
+        event.schema = schema
+        event.table = table
+        event.primary_key = primary_key
+        event.timestamp = timestamp
+        event._RowsEvent__rows = rows
+        return event
+    return make
+
+
+@pytest.fixture
+def make_insert(make_rows_event):
+    """Factory of an insert event of *count* rows, ids from *first_id*
+    """
+    def make(first_id, count=1, table='tbl0'):
+        return make_rows_event('insert', [
+            {'values': {'id': i, 'data': 'v%d' % i}}
+            for i in range(first_id, first_id + count)
+        ], table=table)
+    return make
+
+
+@pytest.fixture
+def make_inserts(make_insert):
+    """Factory of *count* insert events of one row, ids from *first_id*
+    """
+    def make(count, first_id=1, table='tbl0'):
+        return [make_insert(i, table=table)
+                for i in range(first_id, first_id + count)]
+    return make
+
+
+@pytest.fixture
+def make_binlog_event():
+    """Factory of non rows events (QueryEvent, XidEvent...) whose attributes
+    are given instead of being decoded
+    """
+    def make(cls, timestamp=1451606400, **attrs):
+        event = cls.__new__(cls)
+        event.timestamp = timestamp
+        for name, value in attrs.items():
+            setattr(event, name, value)
+        return event
+    return make
+
+
+@pytest.fixture
+def fake_stream():
+    return FakeStream
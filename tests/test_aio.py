@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import sys
+
+import pytest
+
+from mysqlbinlog2blinker import signals
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 5),
+                                reason='asyncio publishing needs Python 3.5+')
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from mysqlbinlog2blinker import aio
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class CountingStream(object):
+    """ A FakeStream which records how many events have been read """
+    def __init__(self, stream):
+        self.stream = stream
+        self.read = 0
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        for event in self.stream:
+            self.read += 1
+            yield event
+
+
+def test_async_receivers_keep_table_order(fake_stream, make_insert):
+    received = []
+    positions = []
+
+    async def on_tbl0(table_name, rows, meta):
+        await asyncio.sleep(0.01)
+        received.append((table_name, rows[0]['keys']['id']))
+
+    def on_tbl1(table_name, rows, meta):
+        received.append((table_name, rows[0]['keys']['id']))
+
+    def on_position(pos):
+        positions.append(pos)
+
+    events = [make_insert(1), make_insert(2),
+              make_insert(3, table='tbl1'),
+              make_insert(4)]
+    signals.rows_inserted.connect(on_tbl0, sender='testdb.tbl0')
+    signals.rows_inserted.connect(on_tbl1, sender='testdb.tbl1')
+    signals.binlog_position_signal.connect(on_position)
+    try:
+        _run(aio._publish_async(fake_stream(events), concurrency=10))
+    finally:
+        signals.rows_inserted.disconnect(on_tbl0)
+        signals.rows_inserted.disconnect(on_tbl1)
+        signals.binlog_position_signal.disconnect(on_position)
+
+    # tbl1 does not wait for the slow tbl0, tbl0 stays in order
+    assert received[0] == ('testdb.tbl1', 3)
+    assert [i for t, i in received if t == 'testdb.tbl0'] == [1, 2, 4]
+    # positions only move forward, once everything before them is delivered
+    log_positions = [p for _, p in positions]
+    assert log_positions == sorted(set(log_positions))
+    assert log_positions[-1] == 404
+
+
+def test_backpressure_pauses_reading(fake_stream, make_insert):
+    stream = CountingStream(fake_stream(
+        [make_insert(i) for i in range(1, 21)]))
+    read_ahead = []
+
+    async def on_rows(table_name, rows, meta):
+        await asyncio.sleep(0.005)
+        read_ahead.append(stream.read - rows[0]['keys']['id'])
+
+    signals.rows_inserted.connect(on_rows)
+    try:
+        _run(aio._publish_async(stream, concurrency=1, queue_size=2))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+
+    assert len(read_ahead) == 20
+    # rows and positions of at most a few events are pending
+    assert max(read_ahead) <= 4
+
+
+def test_receiver_error_is_raised(fake_stream, make_insert):
+    async def on_rows(table_name, rows, meta):
+        raise ValueError('boom')
+
+    signals.rows_inserted.connect(on_rows)
+    try:
+        with pytest.raises(ValueError):
+            _run(aio._publish_async(fake_stream(
+                [make_insert(i) for i in range(1, 5)])))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
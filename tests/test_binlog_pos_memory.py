@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import binascii
+import json
+import logging
+import time
+
+from pymysqlreplication import event as binlog_event
+
+from mysqlbinlog2blinker import _publish, signals
+from mysqlbinlog2blinker.binlog_pos_memory import (
+    AckTracker,
+    EventDrivenBinlogPosMemory,
+    GtidBinlogPosMemory,
+    MmapBinlogPosMemory,
+    publish_position,
+)
+
+
+def test_ack_tracker_low_watermark():
+    published = []
+    tracker = AckTracker(publish=published.append)
+
+    first = tracker.ticket()
+    tracker.position('mysql-bin.000001', 100)
+    second = tracker.ticket(acks=2)
+    tracker.position('mysql-bin.000001', 200)
+    tracker.position('mysql-bin.000001', 300)
+    assert tracker.pending == 2 and published == []
+
+    second.ack()
+    second.ack()
+    assert published == []
+    first.ack()
+    assert published == [('mysql-bin.000001', 300)]
+    assert tracker.low_watermark == ('mysql-bin.000001', 300)
+
+    tracker.position('mysql-bin.000002', 4)
+    assert published[-1] == ('mysql-bin.000002', 4)
+    assert tracker.pending == 0
+
+
+def test_ack_tracker_publish_may_ack_and_warns_on_backlog(caplog):
+    published = []
+
+    def publish(pos):
+        published.append(pos)
+        # would deadlock if it was called under the tracker's lock
+        if not second.done:
+            second.ack()
+
+    tracker = AckTracker(publish=publish)
+    first = tracker.ticket()
+    tracker.position('mysql-bin.000001', 100)
+    second = tracker.ticket()
+    tracker.position('mysql-bin.000001', 200)
+    first.ack()
+    assert published == [('mysql-bin.000001', 100),
+                         ('mysql-bin.000001', 200)]
+
+    tracker = AckTracker(publish=lambda pos: None, warn_backlog=3)
+    with caplog.at_level(logging.WARNING):
+        for _ in range(6):
+            tracker.ticket()
+    assert caplog.text.count('wait for acknowledgements') == 2
+
+
+def test_mmap_memory_keeps_last_valid_record(tmpdir):
+    filename = str(tmpdir.join('pos.mmap'))
+    memory = MmapBinlogPosMemory(filename, msync_interval=0)
+    with memory:
+        assert memory.log_file is None
+        signals.binlog_position_signal.send(('mysql-bin.000001', 104))
+        signals.binlog_position_signal.send(('mysql-bin.000002', 4))
+
+    memory = MmapBinlogPosMemory(filename)
+    with memory:
+        assert (memory.log_file, memory.log_pos) == ('mysql-bin.000002', 4)
+        signals.binlog_position_signal.send(('mysql-bin.000002', 204))
+
+    # tear the latest record, the previous one is used
+    with open(filename, 'r+b') as f:
+        f.seek(MmapBinlogPosMemory.RECORD_SIZE + 20)
+        f.write(b'torn')
+    memory = MmapBinlogPosMemory(filename)
+    with memory:
+        assert (memory.log_file, memory.log_pos) == ('mysql-bin.000002', 4)
+
+
+def test_event_driven_memory_saves_on_thresholds(tmpdir):
+    filename = tmpdir.join('pos')
+    memory = EventDrivenBinlogPosMemory(str(filename), max_events=3,
+                                        max_bytes=1000, max_time=None)
+
+    def saved():
+        for _ in range(100):
+            if filename.check() and filename.read():
+                return filename.read()
+            time.sleep(0.01)
+
+    with memory:
+        publish_position('mysql-bin.000001', 4)  # first position
+        assert saved() == 'mysql-bin.000001:4'
+        publish_position('mysql-bin.000001', 104)
+        publish_position('mysql-bin.000001', 204)
+        time.sleep(0.05)
+        assert filename.read() == 'mysql-bin.000001:4'
+        filename.write('')
+        publish_position('mysql-bin.000001', 304)  # 3 events
+        assert saved() == 'mysql-bin.000001:304'
+        filename.write('')
+        publish_position('mysql-bin.000001', 2000)  # > 1000 bytes
+        assert saved() == 'mysql-bin.000001:2000'
+        publish_position('mysql-bin.000001', 2100)
+    # the last position is saved at stop
+    assert filename.read() == 'mysql-bin.000001:2100'
+    publish_position('mysql-bin.000001', 2200)
+    assert memory.log_pos == 2100
+
+
+def test_event_driven_memory_stops_when_not_started(tmpdir):
+    filename = tmpdir.join('pos')
+    EventDrivenBinlogPosMemory(str(filename)).stop()
+    assert not filename.exists()
+
+
+def test_gtid_memory_tracks_committed_transactions(tmpdir, make_rows_event,
+                                                   fake_stream,
+                                                   make_binlog_event):
+    uuid = '3e11fa47-71ca-11e1-9e33-c80aa9429562'
+    sid = binascii.unhexlify(uuid.replace('-', ''))
+
+    def transaction(gno):
+        return [
+            make_binlog_event(binlog_event.GtidEvent, sid=sid, gno=gno),
+            make_binlog_event(binlog_event.QueryEvent, query='BEGIN'),
+            make_rows_event('insert', [{'values': {'id': gno, 'data': ''}}]),
+            make_binlog_event(binlog_event.XidEvent, xid=gno),
+        ]
+
+    filename = str(tmpdir.join('gtid.pos'))
+    memory = GtidBinlogPosMemory(filename, gtid_set='%s:1-5' % uuid)
+    with memory:
+        assert memory.resume_kwargs() == {'auto_position': '%s:1-5' % uuid}
+        # the last transaction is not committed
+        _publish(fake_stream(transaction(6) + transaction(7) +
+                             transaction(9)[:-1]))
+    with open(filename) as f:
+        saved = json.load(f)
+    assert saved['gtid_set'] == '%s:1-7' % uuid
+    assert saved['log_pos'] == 1104
+
+    memory = GtidBinlogPosMemory(filename)
+    with memory:
+        assert str(memory.gtid_set) == '%s:1-7' % uuid
+
+
+def test_gtid_memory_savepoints_and_first_transaction(tmpdir, make_rows_event,
+                                                      fake_stream,
+                                                      make_binlog_event):
+    uuid = '3e11fa47-71ca-11e1-9e33-c80aa9429562'
+    sid = binascii.unhexlify(uuid.replace('-', ''))
+    events = [
+        make_binlog_event(binlog_event.GtidEvent, sid=sid, gno=1000),
+        make_binlog_event(binlog_event.QueryEvent, query='BEGIN'),
+        make_rows_event('insert', [{'values': {'id': 1, 'data': ''}}]),
+        make_binlog_event(binlog_event.QueryEvent, query=b'SAVEPOINT `sa1`'),
+        make_rows_event('insert', [{'values': {'id': 2, 'data': ''}}]),
+    ]
+    memory = GtidBinlogPosMemory(str(tmpdir.join('gtid.pos')))
+    with memory:
+        _publish(fake_stream(events))
+        # the transaction is still open
+        assert not memory.gtid_set
+        _publish(fake_stream([make_binlog_event(binlog_event.XidEvent,
+                                                xid=1)]))
+        # only the transactions read are executed
+        assert memory.resume_kwargs() == {'auto_position': '%s:1000' % uuid}
+
+
+def test_gtid_memory_orders_binlog_files_numerically(tmpdir, fake_stream,
+                                                     make_binlog_event):
+    uuid = '3e11fa47-71ca-11e1-9e33-c80aa9429562'
+    other = '4e11fa47-71ca-11e1-9e33-c80aa9429562'
+    sid = binascii.unhexlify(uuid.replace('-', ''))
+    filename = tmpdir.join('gtid.pos')
+    filename.write(json.dumps({'gtid_set': '%s:1-3:5' % uuid}))
+
+    memory = GtidBinlogPosMemory(str(filename), gtid_set='%s:1-2' % other)
+    with memory:
+        # the set read is merged, its gap is kept
+        assert str(memory.gtid_set) == '%s:1-3:5,%s:1-2' % (uuid, other)
+        memory.handle_event(
+            make_binlog_event(binlog_event.GtidEvent, sid=sid, gno=6),
+            fake_stream([], log_file='mysql-bin.999999'))
+        memory.handle_event(make_binlog_event(binlog_event.XidEvent, xid=6),
+                            fake_stream([], log_file='mysql-bin.999999'))
+        memory.set_binlog_pos('mysql-bin.1000000', 4)
+        assert str(memory.gtid_set) == '%s:1-3:5-6,%s:1-2' % (uuid, other)
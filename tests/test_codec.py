@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import datetime
+import decimal
+
+import pytest
+
+from mysqlbinlog2blinker import _subscribers, binlog_pos_memory
+from mysqlbinlog2blinker.codec import Decoder, Encoder
+
+_VALUES = {
+    'id': 1,
+    'text': u'h\xe9llo',
+    'big': -2 ** 70,
+    'float': 0.25,
+    'price': decimal.Decimal('-12.340'),
+    'created': datetime.datetime(2016, 2, 29, 23, 59, 59, 999999),
+    'day': datetime.date(2016, 1, 1),
+    'at': datetime.time(12, 30, 1, 5),
+    'duration': datetime.timedelta(days=-1, seconds=5, microseconds=7),
+    'blob': b'\x00\xff',
+    'flags': set(['a', 'b']),
+    'json': {'a': [1, None, True, False], 'b': (2, 3)},
+    'missing': None,
+}
+
+
+def test_round_trip():
+    encoder, decoder = Encoder(), Decoder()
+    rows = [{'values': dict(_VALUES, id=i), 'keys': {'id': i}}
+            for i in range(3)]
+    log_file = binlog_pos_memory.SourceLogFile('mysql-bin.000001', 'a')
+    meta = {'log_file': log_file, 'log_pos': 4, 'action': 'insert',
+            'ticket': object()}
+    data = encoder.encode('db.t', rows, meta)
+    del meta['ticket']
+    assert decoder.decode(data) == ('db.t', rows, meta)
+
+    updates = [{'values': {'id': 1, 'data': 'y'}, 'keys': {'id': 1},
+                'updated_values': {'data': ['x', 'y']}}]
+    assert decoder.decode(encoder.encode('db.t', updates, {})) == \
+        ('db.t', updates, {})
+    assert decoder.decode(encoder.encode('db.t', [], {})) == ('db.t', [], {})
+
+
+def test_schema_is_sent_once():
+    encoder = Encoder()
+    rows = [{'values': {'id': 1, 'a_long_column_name': 2}, 'keys': {'id': 1}}]
+    first = encoder.encode('db.t', rows, {})
+    second = encoder.encode('db.t', rows, {})
+    assert b'a_long_column_name' in first
+    assert b'a_long_column_name' not in second
+
+    # a decoder must see the definition first
+    with pytest.raises(ValueError):
+        Decoder().decode(second)
+    decoder = Decoder()
+    decoder.learn(first)
+    assert decoder.decode(second) == ('db.t', rows, {})
+
+
+def test_stream_is_split(make_rows_event, fake_stream):
+    stream = fake_stream([])
+    encoder, decoder = Encoder(), Decoder()
+    changes = []
+    data = b''
+    for i in range(5):
+        event = make_rows_event('update', [{
+            'before_values': {'id': i, 'data': 'x'},
+            'after_values': {'id': i, 'data': 'y%d' % i}}])
+        rows, meta = _subscribers._rows_event_to_dict(event, stream)
+        changes.append(('testdb.tbl0', rows, meta))
+        data += encoder.encode('testdb.tbl0', rows, meta)
+
+    decoded = []
+    for i in range(0, len(data), 7):
+        decoded.extend(decoder.feed(data[i:i + 7]))
+    assert decoded == changes
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import time
+
+import pytest
+
+from mysqlbinlog2blinker import _publish, dispatchers, signals
+
+
+@pytest.fixture
+def received():
+    """Connect to the rows and position signals, collect what is sent
+    """
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        received.append((meta['action'], table_name, rows, meta))
+
+    def on_position(pos):
+        received.append(('position', pos))
+
+    signals.rows_inserted.connect(on_rows)
+    signals.rows_updated.connect(on_rows)
+    signals.rows_deleted.connect(on_rows)
+    signals.binlog_position_signal.connect(on_position)
+    yield received
+    signals.rows_inserted.disconnect(on_rows)
+    signals.rows_updated.disconnect(on_rows)
+    signals.rows_deleted.disconnect(on_rows)
+    signals.binlog_position_signal.disconnect(on_position)
+
+
+def test_immediate_dispatcher(fake_stream, received, make_insert):
+    _publish(fake_stream([make_insert(1), make_insert(2, 2)]))
+    assert [r[0] for r in received] == \
+        ['insert', 'position', 'insert', 'position']
+    assert received[1][1] == ('mysql-bin.000001', 104)
+    assert [row['keys'] for row in received[2][2]] == [{'id': 2}, {'id': 3}]
+
+
+def test_batching_coalesces_same_table_and_action(make_rows_event, fake_stream,
+                                                  received, make_insert):
+    events = [make_insert(1), make_insert(2, 2),
+              make_insert(4, table='tbl1'),
+              make_rows_event('delete', [{'values': {'id': 9, 'data': 'x'}}],
+                              table='tbl1')]
+    _publish(fake_stream(events),
+             dispatchers.BatchingDispatcher(max_rows=100, max_time=None))
+
+    assert [r[0] for r in received] == \
+        ['insert', 'position', 'insert', 'position', 'delete', 'position']
+
+    action, table_name, rows, meta = received[0]
+    assert table_name == 'testdb.tbl0'
+    assert [row['keys']['id'] for row in rows] == [1, 2, 3]
+    assert meta['events'] == 2
+    assert (meta['first_log_pos'], meta['last_log_pos'], meta['log_pos']) \
+        == (104, 204, 204)
+    # position is held back until the batch is sent
+    assert received[1][1] == ('mysql-bin.000001', 204)
+    assert received[2][1] == 'testdb.tbl1'
+    assert received[-1][1] == ('mysql-bin.000001', 404)
+
+
+def test_batching_flushes_on_max_rows(fake_stream, received, make_insert):
+    events = [make_insert(i) for i in range(1, 6)]
+    _publish(fake_stream(events),
+             dispatchers.BatchingDispatcher(max_rows=2, max_time=None))
+    assert [len(r[2]) for r in received if r[0] == 'insert'] == [2, 2, 1]
+
+
+def test_batching_flushes_on_max_bytes(fake_stream, received, make_insert):
+    events = [make_insert(i) for i in range(1, 4)]
+    _publish(fake_stream(events),
+             dispatchers.BatchingDispatcher(max_rows=None, max_bytes=1,
+                                            max_time=None))
+    assert [len(r[2]) for r in received if r[0] == 'insert'] == [1, 1, 1]
+
+
+def test_batching_flushes_on_max_time(received):
+    dispatcher = dispatchers.BatchingDispatcher(max_time=0.05)
+    try:
+        dispatcher.dispatch(signals.rows_inserted, 'testdb.tbl0',
+                            [{'values': {'id': 1}}],
+                            {'time': 0, 'action': 'insert',
+                             'log_file': 'f', 'log_pos': 1})
+        dispatcher.position('f', 1)
+        assert received == []
+        deadline = time.time() + 2
+        while len(received) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert [r[0] for r in received] == ['insert', 'position']
+    finally:
+        dispatcher.close()
+
+
+def test_transaction_dispatcher(make_rows_event, fake_stream, received,
+                                make_insert, make_binlog_event):
+    from pymysqlreplication import event as binlog_event
+
+    transactions = []
+
+    def on_transaction(changes, meta):
+        transactions.append((changes, meta))
+
+    signals.transaction_signal.connect(on_transaction)
+    try:
+        events = [
+            make_binlog_event(binlog_event.QueryEvent, query='BEGIN'),
+            make_insert(1, 2),
+            make_rows_event('delete', [{'values': {'id': 9, 'data': 'x'}}],
+                            table='tbl1'),
+            make_binlog_event(binlog_event.XidEvent, xid=42),
+            make_binlog_event(binlog_event.QueryEvent, query='BEGIN'),
+            make_insert(3),
+        ]
+        _publish(fake_stream(events), dispatchers.TransactionDispatcher())
+    finally:
+        signals.transaction_signal.disconnect(on_transaction)
+
+    # the unfinished transaction is not published
+    assert len(transactions) == 1
+    changes, meta = transactions[0]
+    assert [(t, len(rows)) for t, rows, _ in changes] == \
+        [('testdb.tbl0', 2), ('testdb.tbl1', 1)]
+    assert (meta['xid'], meta['log_pos'], meta['begin_log_pos']) == \
+        (42, 404, 104)
+    # rows signals are sent at commit, position only moves at commit
+    assert [r[0] for r in received] == ['insert', 'delete', 'position']
+    assert received[-1][1] == ('mysql-bin.000001', 404)
+
+
+def test_transaction_dispatcher_keeps_savepoints_in(fake_stream, received,
+                                                    make_insert,
+                                                    make_binlog_event):
+    from pymysqlreplication import event as binlog_event
+
+    transactions = []
+
+    def on_transaction(changes, meta):
+        transactions.append((changes, meta))
+
+    def query(text):
+        return make_binlog_event(binlog_event.QueryEvent, query=text)
+
+    signals.transaction_signal.connect(on_transaction)
+    try:
+        events = [
+            query('BEGIN'),
+            make_insert(1),
+            query(b'SAVEPOINT `sa1`'),
+            make_insert(2),
+            query('ROLLBACK TO SAVEPOINT `sa1`'),
+            make_insert(3),
+            query('RELEASE SAVEPOINT `sa1`'),
+            make_binlog_event(binlog_event.XidEvent, xid=7),
+        ]
+        _publish(fake_stream(events), dispatchers.TransactionDispatcher())
+    finally:
+        signals.transaction_signal.disconnect(on_transaction)
+
+    assert [len(changes) for changes, _ in transactions] == [3]
+    assert transactions[0][1]['xid'] == 7
+    assert [r[1] for r in received if r[0] == 'position'] == \
+        [('mysql-bin.000001', 804)]
+
+
+def test_thread_pool_keeps_order_per_key(make_rows_event, fake_stream):
+    import threading
+
+    delivered = []
+    threads = set()
+    lock = threading.Lock()
+
+    def on_rows(table_name, rows, meta):
+        time.sleep(0.001)
+        with lock:
+            threads.add(threading.current_thread().name)
+            delivered.extend((row['keys']['id'], row['values']['data'])
+                             for row in rows)
+
+    events = [make_rows_event('update', [{
+        'before_values': {'id': i, 'data': v},
+        'after_values': {'id': i, 'data': v + 1},
+    } for i in range(8)]) for v in range(20)]
+    signals.rows_updated.connect(on_rows)
+    try:
+        _publish(fake_stream(events),
+                 dispatchers.ThreadPoolDispatcher(workers=4, queue_size=2))
+    finally:
+        signals.rows_updated.disconnect(on_rows)
+
+    assert len(delivered) == 8 * 20
+    for i in range(8):
+        assert [d for _id, d in delivered if _id == i] == \
+            list(range(1, 21))
+    assert len(threads) > 1
+
+
+def test_thread_pool_keeps_columnar_rows(make_rows_event, fake_stream):
+    import threading
+
+    from mysqlbinlog2blinker.rows import ColumnarRows
+
+    delivered = []
+    lock = threading.Lock()
+
+    def on_rows(table_name, rows, meta):
+        assert isinstance(rows, ColumnarRows)
+        with lock:
+            delivered.extend(zip(rows.column('id'), rows.column('data')))
+
+    events = [make_rows_event('update', [{
+        'before_values': {'id': i, 'data': v},
+        'after_values': {'id': i, 'data': v + 1},
+    } for i in range(8)]) for v in range(5)]
+    signals.rows_updated.connect(on_rows)
+    try:
+        _publish(fake_stream(events),
+                 dispatchers.ThreadPoolDispatcher(workers=3),
+                 row_format='columnar')
+    finally:
+        signals.rows_updated.disconnect(on_rows)
+    for i in range(8):
+        assert [d for _id, d in delivered if _id == i] == [1, 2, 3, 4, 5]
+
+
+def test_thread_pool_close_delivers_queued_rows():
+    import threading
+
+    delivered = []
+    blocked = threading.Event()
+
+    def on_rows(table_name, rows, meta):
+        blocked.wait(1)
+        delivered.extend(row['keys']['id'] for row in rows)
+
+    dispatcher = dispatchers.ThreadPoolDispatcher(workers=2)
+    signals.rows_inserted.connect(on_rows)
+    try:
+        for i in range(10):
+            dispatcher.dispatch(signals.rows_inserted, 'testdb.tbl0',
+                                [{'values': {'id': i}, 'keys': {'id': i}}],
+                                {'action': 'insert'})
+        blocked.set()
+        dispatcher.close()
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+    assert sorted(delivered) == list(range(10))
+
+
+def test_thread_pool_reraises_receiver_error(fake_stream, make_insert):
+    def on_rows(table_name, rows, meta):
+        raise ValueError('boom')
+
+    events = [make_insert(i) for i in range(50)]
+    signals.rows_inserted.connect(on_rows)
+    try:
+        with pytest.raises(ValueError):
+            _publish(fake_stream(events),
+                     dispatchers.ThreadPoolDispatcher(workers=2))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+
+
+def test_thread_pool_positions_wait_for_delivery(fake_stream, make_insert):
+    import threading
+
+    delivered = set()
+    early = []
+    lock = threading.Lock()
+
+    def on_rows(table_name, rows, meta):
+        # rows of id 0 are much slower than the others
+        time.sleep(0.005 if rows[0]['keys']['id'] == 0 else 0)
+        with lock:
+            delivered.add(meta['log_pos'])
+
+    def on_position(pos):
+        with lock:
+            early.extend(p for p in range(104, pos[1] + 1, 100)
+                         if p not in delivered)
+
+    events = [make_insert(i % 4) for i in range(40)]
+    signals.rows_inserted.connect(on_rows)
+    signals.binlog_position_signal.connect(on_position)
+    try:
+        _publish(fake_stream(events),
+                 dispatchers.ThreadPoolDispatcher(workers=4))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+        signals.binlog_position_signal.disconnect(on_position)
+    assert len(delivered) == 40
+    assert early == []
+
+
+@pytest.fixture
+def positions():
+    """Collect the positions sent to the position signal
+    """
+    positions = []
+    signals.binlog_position_signal.connect(positions.append, weak=False)
+    yield positions
+    signals.binlog_position_signal.disconnect(positions.append)
+
+
+def test_receiver_acks(fake_stream, positions, make_insert):
+    tickets = []
+
+    def on_rows(table_name, rows, meta):
+        tickets.append(meta['ticket'])
+
+    signals.rows_inserted.connect(on_rows)
+    try:
+        _publish(fake_stream([make_insert(1), make_insert(2)]),
+                 dispatchers.ImmediateDispatcher(receiver_acks=True))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+
+    assert len(tickets) == 2 and positions == []
+    tickets[1].ack()
+    assert positions == []
+    tickets[0].ack()
+    # the low-watermark jumps to the last acknowledged event
+    assert positions == [('mysql-bin.000001', 204)]
+    with pytest.raises(ValueError):
+        tickets[0].ack()
+
+
+def test_receiver_acks_waits_for_every_receiver(fake_stream, positions,
+                                                make_insert):
+    first, second = [], []
+
+    def on_first(table_name, rows, meta):
+        first.append(meta['ticket'])
+
+    def on_second(table_name, rows, meta):
+        second.append(meta['ticket'])
+
+    signals.rows_inserted.connect(on_first)
+    signals.rows_inserted.connect(on_second, sender='testdb.tbl0')
+    try:
+        _publish(fake_stream([make_insert(1)]),
+                 dispatchers.ImmediateDispatcher(receiver_acks=True))
+    finally:
+        signals.rows_inserted.disconnect(on_first)
+        signals.rows_inserted.disconnect(on_second, sender='testdb.tbl0')
+
+    assert first == second
+    first[0].ack()
+    assert positions == []
+    second[0].ack()
+    assert positions == [('mysql-bin.000001', 104)]
+
+
+def _update(make_rows_event, changes, table='tbl0'):
+    return make_rows_event('update', [
+        {'before_values': {'id': i, 'data': before, 'n': 0},
+         'after_values': {'id': i, 'data': after, 'n': 0}}
+        for i, before, after in changes
+    ], table=table)
+
+
+def test_compacting_sends_net_changes(make_rows_event, fake_stream, received,
+                                      make_insert):
+    def delete(i, data):
+        return make_rows_event('delete', [{'values': {'id': i, 'data': data,
+                                                      'n': 0}}])
+
+    events = [
+        _update(make_rows_event, [(1, 'a', 'b'), (2, 'a', 'b')]),
+        make_insert(3),
+        _update(make_rows_event, [(1, 'b', 'c'), (3, 'v3', 'x')]),
+        _update(make_rows_event, [(2, 'b', 'a')]),
+        make_insert(4),
+        delete(4, 'v4'),
+        delete(5, 'x'),
+        make_rows_event('insert', [{'values': {'id': 5, 'data': 'y',
+                                               'n': 0}}]),
+        _update(make_rows_event, [(1, 'a', 'b')], table='tbl1'),
+    ]
+    _publish(fake_stream(events),
+             dispatchers.CompactingDispatcher(window=None))
+
+    assert [r[0] for r in received] == \
+        ['update', 'insert', 'update', 'update', 'position']
+    assert received[0][2] == [{'values': {'id': 1, 'data': 'c', 'n': 0},
+                               'keys': {'id': 1},
+                               'updated_values': {'data': ['a', 'c']}}]
+    # an insert stays an insert, with the latest values
+    assert received[1][2] == [{'values': {'id': 3, 'data': 'x', 'n': 0},
+                               'keys': {'id': 3}}]
+    # deleted then inserted again
+    assert received[2][2] == [{'values': {'id': 5, 'data': 'y', 'n': 0},
+                               'keys': {'id': 5},
+                               'updated_values': {'data': ['x', 'y']}}]
+    assert received[3][1] == 'testdb.tbl1'
+
+    meta = received[0][3]
+    assert (meta['first_log_pos'], meta['last_log_pos'],
+            meta['compacted_rows']) == (104, 304, 2)
+    # only sent once the window is
+    assert received[-1][1] == ('mysql-bin.000001', 904)
+
+
+def test_compacting_reinserting_the_row_before_the_window(make_rows_event,
+                                                          fake_stream,
+                                                          received):
+    events = [
+        _update(make_rows_event, [(1, 'a', 'b')]),
+        make_rows_event('delete', [{'values': {'id': 1, 'data': 'b',
+                                               'n': 0}}]),
+        make_rows_event('insert', [{'values': {'id': 1, 'data': 'a',
+                                               'n': 0}}]),
+    ]
+    _publish(fake_stream(events),
+             dispatchers.CompactingDispatcher(window=None))
+    assert [r[0] for r in received] == ['position']
+
+
+def test_compacting_flushes_on_window_and_max_keys(make_rows_event,
+                                                   fake_stream, received):
+    events = [_update(make_rows_event, [(i, 'a', 'b')]) for i in range(5)] + \
+        [_update(make_rows_event, [(0, 'b', 'c')])]
+    _publish(fake_stream(events),
+             dispatchers.CompactingDispatcher(window=None, max_keys=2))
+    assert [[row['keys']['id'] for row in r[2]]
+            for r in received if r[0] == 'update'] == [[0, 1], [2, 3], [4, 0]]
+
+    del received[:]
+    dispatcher = dispatchers.CompactingDispatcher(window=0.05)
+    try:
+        for i in range(3):
+            dispatcher.dispatch(signals.rows_updated, 'testdb.tbl0',
+                                [{'values': {'id': 1, 'n': i + 1},
+                                  'keys': {'id': 1},
+                                  'updated_values': {'n': [i, i + 1]}}],
+                                {'time': 0, 'action': 'update',
+                                 'log_file': 'f', 'log_pos': i})
+            dispatcher.position('f', i)
+        assert received == []
+        deadline = time.time() + 2
+        while len(received) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert [r[0] for r in received] == ['update', 'position']
+        assert received[1][1] == ('f', 2)
+        assert received[0][2][0]['updated_values'] == {'n': [0, 3]}
+    finally:
+        dispatcher.close()
+
+
+def test_compacting_passes_rows_without_primary_key(make_rows_event,
+                                                    fake_stream, received,
+                                                    make_insert):
+    def insert(msg):
+        return make_rows_event('insert', [{'values': {'msg': msg}}],
+                               table='log', primary_key=None)
+
+    events = [make_insert(1), insert('a'), insert('b'),
+              _update(make_rows_event, [(1, 'v1', 'x')])]
+    _publish(fake_stream(events),
+             dispatchers.CompactingDispatcher(window=None))
+
+    # nothing to merge them by, each is sent as is, after the window
+    assert [(r[0], r[1]) for r in received if r[0] != 'position'] == [
+        ('insert', 'testdb.tbl0'), ('insert', 'testdb.log'),
+        ('insert', 'testdb.log'), ('update', 'testdb.tbl0')]
+    assert [r[2] for r in received if r[1] == 'testdb.log'] == \
+        [[{'values': {'msg': 'a'}, 'keys': {}}],
+         [{'values': {'msg': 'b'}, 'keys': {}}]]
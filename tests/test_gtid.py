@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import pytest
+
+from mysqlbinlog2blinker.gtid import GtidSet
+
+UUID = '3e11fa47-71ca-11e1-9e33-c80aa9429562'
+UUID2 = '4e11fa47-71ca-11e1-9e33-c80aa9429562'
+
+
+def test_parse_and_format():
+    text = '%s:1-5:7,\n%s:3' % (UUID2.upper(), UUID)
+    gtids = GtidSet(text)
+    assert str(gtids) == '%s:3,%s:1-5:7' % (UUID, UUID2)
+    assert GtidSet(str(gtids)) == gtids
+    assert len(gtids) == 7
+    assert not GtidSet() and gtids
+
+
+def test_add_merges_intervals():
+    gtids = GtidSet()
+    for gno in [1, 2, 3, 10, 5, 4, 9, 7, 6, 8, 20]:
+        gtids.add(UUID, gno)
+    assert gtids.intervals(UUID) == [(1, 10), (20, 20)]
+    gtids.add_interval(UUID, 11, 19)
+    assert str(gtids) == '%s:1-20' % UUID
+    assert gtids.contains(UUID, 15) and not gtids.contains(UUID, 21)
+    assert not gtids.contains(UUID2, 1)
+    with pytest.raises(ValueError):
+        gtids.add_interval(UUID, 5, 4)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import time
+
+import pytest
+
+from mysqlbinlog2blinker import binlog_pos_memory as _bpm, dispatchers, signals
+from mysqlbinlog2blinker.multi_source import (
+    Source,
+    _publish_sources,
+    start_multi_source_replication,
+)
+
+
+class RecordingMemory(_bpm.BaseBinlogPosMemory):
+    def __init__(self, source):
+        self.source = source
+        self.positions = []
+
+    def set_binlog_pos(self, log_file, log_pos):
+        self.positions.append((str(log_file), log_pos))
+
+
+def test_sources_are_taken_in_turn(fake_stream, make_inserts):
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        if not received:
+            # let every reader fill its queue
+            time.sleep(0.2)
+        received.append((meta['source'], rows[0]['keys']['id']))
+
+    signals.rows_inserted.connect(on_rows)
+    try:
+        _publish_sources([
+            ('a', fake_stream(make_inserts(6))),
+            ('b', fake_stream(make_inserts(2))),
+        ])
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+
+    assert sorted(received) == [('a', i) for i in range(1, 7)] + \
+        [('b', 1), ('b', 2)]
+    # a busy source does not hold back the other one
+    assert [s for s, _ in received[1:5]] in (['b', 'a', 'b', 'a'],
+                                             ['a', 'b', 'a', 'b'])
+    for source in 'ab':
+        ids = [i for s, i in received if s == source]
+        assert ids == sorted(ids)
+
+
+@pytest.mark.parametrize('dispatcher', [
+    dispatchers.ImmediateDispatcher,
+    lambda: dispatchers.ThreadPoolDispatcher(workers=3),
+    lambda: dispatchers.BatchingDispatcher(max_rows=2, max_time=None),
+])
+def test_positions_go_to_the_memory_of_their_source(fake_stream, dispatcher,
+                                                    make_inserts):
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        received.append((meta['source'], len(rows)))
+
+    memories = [RecordingMemory('a'), RecordingMemory('b'),
+                RecordingMemory(None)]
+    for memory in memories:
+        _bpm.attach(memory)
+    signals.rows_inserted.connect(on_rows)
+    try:
+        _publish_sources([
+            ('a', fake_stream(make_inserts(5), 'a-bin.000001')),
+            ('b', fake_stream(make_inserts(3), 'b-bin.000007')),
+        ], dispatcher())
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+        for memory in memories:
+            _bpm.detach(memory)
+
+    # rows of different sources are never mixed
+    assert sum(n for s, n in received if s == 'a') == 5
+    assert sum(n for s, n in received if s == 'b') == 3
+    a, b, default = memories
+    assert set(f for f, _ in a.positions) == set(['a-bin.000001'])
+    assert a.positions[-1] == ('a-bin.000001', 504)
+    assert set(f for f, _ in b.positions) == set(['b-bin.000007'])
+    assert b.positions[-1] == ('b-bin.000007', 304)
+    assert default.positions == []
+
+
+def test_reader_error_is_raised(fake_stream, make_inserts):
+    class BrokenStream(object):
+        log_file = 'mysql-bin.000001'
+        log_pos = 4
+
+        def __iter__(self):
+            raise IOError('lost connection')
+
+    with pytest.raises(IOError):
+        _publish_sources([
+            ('a', fake_stream(make_inserts(3))),
+            ('b', BrokenStream()),
+        ])
+
+
+def test_source_names_must_be_unique():
+    sources = [Source('a', {}, RecordingMemory(None)),
+               Source('a', {}, RecordingMemory(None))]
+    with pytest.raises(ValueError):
+        start_multi_source_replication(sources)
+    assert sources[0].binlog_pos_memory.source == 'a'
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import threading
+
+import pytest
+
+from mysqlbinlog2blinker import _publish, _subscribers, dispatchers, signals
+from mysqlbinlog2blinker.pipeline import Pipeline
+
+
+def _events(make_rows_event):
+    return [
+        make_rows_event('insert', [{'values': {'id': 1, 'data': 'a'}}]),
+        make_rows_event('update', [{'before_values': {'id': 1, 'data': 'a'},
+                                    'after_values': {'id': 1, 'data': 'b'}}]),
+        make_rows_event('insert', [{'values': {'id': 2, 'data': 'c'}}],
+                        table='tbl1'),
+        make_rows_event('delete', [{'values': {'id': 1, 'data': 'b'}}]),
+    ]
+
+
+def _record(events, fake_stream, **kwargs):
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        received.append((table_name, [dict(r) for r in rows], meta))
+
+    def on_position(pos):
+        received.append(pos)
+
+    sigs = (signals.rows_inserted, signals.rows_updated, signals.rows_deleted)
+    for sig in sigs:
+        sig.connect(on_rows, sender='testdb.tbl0')
+    signals.binlog_position_signal.connect(on_position)
+    try:
+        _publish(fake_stream(events), **kwargs)
+    finally:
+        for sig in sigs:
+            sig.disconnect(on_rows)
+        signals.binlog_position_signal.disconnect(on_position)
+    return received
+
+
+def test_pipeline_publishes_like_sequential(make_rows_event, fake_stream):
+    expected = _record(_events(make_rows_event), fake_stream)
+    pipeline = Pipeline(queue_size=1)
+    assert _record(_events(make_rows_event), fake_stream,
+                   pipeline=pipeline) == expected
+
+    stats = pipeline.stats()
+    assert stats['read']['items'] == 5  # with the end of stream
+    assert stats['dispatch']['items'] == 4
+    assert stats['convert']['max_queue_depth'] <= 1
+    assert not _subscribers._precomputed
+
+
+def test_pipeline_converts_off_the_dispatch_thread(make_rows_event,
+                                                   fake_stream, monkeypatch):
+    threads = []
+    rows_event_to_dict = _subscribers._rows_event_to_dict
+
+    def recording(*args):
+        threads.append(threading.current_thread())
+        return rows_event_to_dict(*args)
+
+    monkeypatch.setattr(_subscribers, '_rows_event_to_dict', recording)
+    _record(_events(make_rows_event), fake_stream, pipeline=Pipeline(),
+            dispatcher=dispatchers.BatchingDispatcher(max_time=None))
+    assert len(threads) == 3  # tbl1 is not subscribed
+    assert threading.current_thread() not in threads
+
+
+def test_pipeline_raises_receiver_error(make_rows_event, fake_stream):
+    def on_rows(table_name, rows, meta):
+        raise ValueError('boom')
+
+    signals.rows_inserted.connect(on_rows)
+    try:
+        with pytest.raises(ValueError):
+            _publish(fake_stream(_events(make_rows_event) * 10),
+                     pipeline=Pipeline(queue_size=2))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
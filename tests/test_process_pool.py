@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+import os
+
+from mysqlbinlog2blinker import _publish, dispatchers, process_pool, signals
+
+_OUTPUT_ENV = 'MYSQLBINLOG2BLINKER_TEST_OUTPUT'
+
+
+def record_rows(table_name, rows, meta):
+    """Receiver running in worker processes, it appends to a file
+    """
+    with open(os.environ[_OUTPUT_ENV], 'a') as f:
+        for row in rows:
+            f.write(json.dumps([os.getpid(), table_name, row['keys']['id'],
+                                row['values']['data'],
+                                row.get('updated_values')]) + '\n')
+
+
+def test_process_pool_fanout(make_rows_event, fake_stream, tmpdir,
+                             monkeypatch):
+    output = str(tmpdir.join('rows.jsonl'))
+    monkeypatch.setenv(_OUTPUT_ENV, output)
+
+    fanout = process_pool.ProcessPoolFanout(workers=2, partition='key')
+    fanout.on_rows_updated(record_rows, sender='testdb.tbl0')
+    events = [make_rows_event('update', [{
+        'before_values': {'id': i, 'data': v},
+        'after_values': {'id': i, 'data': v + 1},
+    } for i in range(6)]) for v in range(5)]
+
+    positions = []
+    signals.binlog_position_signal.connect(positions.append, weak=False)
+    try:
+        with fanout:
+            # the fanout acknowledges tickets when workers are done
+            _publish(fake_stream(events),
+                     dispatchers.ImmediateDispatcher(receiver_acks=True))
+    finally:
+        signals.binlog_position_signal.disconnect(positions.append)
+
+    with open(output) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 30
+    for i in range(6):
+        assert [data for _, _, _id, data, _ in lines if _id == i] == \
+            [1, 2, 3, 4, 5]
+    assert all(updated == {'data': [data - 1, data]}
+               for _, _, _, data, updated in lines)
+    stats = fanout.stats()
+    assert stats['rows'] == 30 and stats['bytes'] > 0
+    assert stats['errors'] == 0
+    assert positions[-1] == ('mysql-bin.000001', 504)
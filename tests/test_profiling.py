@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+import time
+
+import pytest
+
+from mysqlbinlog2blinker import _publish, signals, stats
+from mysqlbinlog2blinker.profiling import ReceiverProfiler, tracemalloc
+
+slow_calls = []
+
+
+def on_slow(table_name, rows, meta):
+    slow_calls.append(meta['log_pos'])
+    time.sleep(0.02)
+
+
+def on_fast(table_name, rows, meta):
+    pass
+
+
+@pytest.fixture
+def receivers():
+    del slow_calls[:]
+    signals.rows_inserted.connect(on_slow)
+    signals.rows_inserted.connect(on_fast)
+    try:
+        yield
+    finally:
+        signals.rows_inserted.disconnect(on_slow)
+        signals.rows_inserted.disconnect(on_fast)
+
+
+@pytest.mark.parametrize('with_stats', [False, True])
+def test_slowest_calls_are_kept(fake_stream, receivers, with_stats,
+                                make_inserts):
+    if with_stats:
+        stats.enable()
+    try:
+        with ReceiverProfiler(slowest=2) as profiler:
+            _publish(fake_stream(make_inserts(3)))
+    finally:
+        stats.disable()
+    assert 'send' not in vars(signals.rows_inserted)
+
+    slowest = profiler.slowest()
+    assert len(slowest) == 2
+    assert [call['receiver'] for call in slowest] == \
+        ['%s.on_slow' % __name__] * 2
+    assert slowest[0]['seconds'] >= slowest[1]['seconds'] >= 0.02
+    assert slowest[0]['table'] == 'testdb.tbl0'
+    assert slowest[0]['signal'] == 'rows_inserted'
+    assert slowest[0]['log_pos'] in slow_calls
+
+    receivers_stats = profiler.stats()
+    assert receivers_stats['%s.on_slow' % __name__]['calls'] == 3
+    assert receivers_stats['%s.on_fast' % __name__]['calls'] == 3
+    # rows conversion receiver of binlog_signal is not wrapped
+    assert len(receivers_stats) == 2
+
+
+def test_slow_receiver_is_quarantined(fake_stream, receivers, caplog,
+                                      make_inserts):
+    profiler = ReceiverProfiler(budgets={on_slow: 0.01}, max_overruns=2,
+                                on_overrun='quarantine')
+    with caplog.at_level(logging.ERROR), profiler:
+        _publish(fake_stream(make_inserts(4)))
+    assert len(slow_calls) == 2
+    assert profiler.quarantined() == ['%s.on_slow' % __name__]
+    assert profiler.stats()['%s.on_fast' % __name__]['calls'] == 4
+    assert 'Quarantine receiver %s.on_slow' % __name__ in caplog.text
+
+    profiler.release(on_slow)
+    with profiler:
+        _publish(fake_stream(make_inserts(1)))
+    assert len(slow_calls) == 3
+
+
+class _Receiver(object):
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    def on_rows(self, table_name, rows, meta):
+        self.calls += 1
+        time.sleep(self.delay)
+
+
+def test_receivers_with_same_name_are_apart(fake_stream, make_inserts):
+    slow, fast = _Receiver(0.02), _Receiver(0)
+    signals.rows_inserted.connect(slow.on_rows)
+    signals.rows_inserted.connect(fast.on_rows)
+    try:
+        with ReceiverProfiler(budget=0.01, max_overruns=1,
+                              on_overrun='quarantine') as profiler:
+            _publish(fake_stream(make_inserts(3)))
+    finally:
+        signals.rows_inserted.disconnect(slow.on_rows)
+        signals.rows_inserted.disconnect(fast.on_rows)
+    assert (slow.calls, fast.calls) == (1, 3)
+
+    name = '%s._Receiver.on_rows' % __name__
+    assert profiler.quarantined() == ['%s at 0x%x' % (name, id(slow))]
+    receivers_stats = profiler.stats()
+    assert receivers_stats['%s at 0x%x' % (name, id(fast))]['calls'] == 3
+    assert not receivers_stats['%s at 0x%x' % (name, id(fast))][
+        'quarantined']
+    profiler.release(slow.on_rows)
+    assert profiler.quarantined() == []
+
+
+def test_slow_receiver_is_warned(fake_stream, receivers, caplog, make_inserts):
+    profiler = ReceiverProfiler(budget=0.01, max_overruns=2)
+    with caplog.at_level(logging.WARNING), profiler:
+        _publish(fake_stream(make_inserts(4)))
+    assert len(slow_calls) == 4
+    assert profiler.quarantined() == []
+    assert profiler.stats()['%s.on_slow' % __name__]['overruns'] == 4
+    assert caplog.text.count('Receiver %s.on_slow' % __name__) == 2
+
+
+@pytest.mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+def test_allocations_are_sampled(fake_stream, make_inserts):
+    kept = []
+
+    def on_rows(table_name, rows, meta):
+        kept.append(bytearray(100000))
+
+    signals.rows_inserted.connect(on_rows)
+    try:
+        with ReceiverProfiler(tracemalloc_every=2) as profiler:
+            _publish(fake_stream(make_inserts(4)))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+    receiver_stats = list(profiler.stats().values())[0]
+    assert receiver_stats['alloc_samples'] == 2
+    assert receiver_stats['alloc_max_bytes'] >= 100000
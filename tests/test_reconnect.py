@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import pymysql
+import pytest
+
+from mysqlbinlog2blinker import _publish, signals
+from mysqlbinlog2blinker.reconnect import Reconnect, ReconnectingStream
+
+
+class StreamFactory(object):
+    """ Make FakeStreams from a shared list of events, which drop the
+    connection after some events, or before the first one
+    """
+    def __init__(self, fake_stream, events, drops):
+        self.fake_stream = fake_stream
+        self.events = events
+        self.drops = list(drops)
+        self.made = []
+
+    def __call__(self, log_file='mysql-bin.000001', log_pos=4, **kwargs):
+        start = (log_pos - 4) // 100
+        drop_after = self.drops.pop(0) if self.drops else None
+
+        class DroppingStream(self.fake_stream):
+            def __iter__(self):
+                for i, event in enumerate(self.events):
+                    if i == drop_after:
+                        raise pymysql.err.OperationalError(2013, 'Lost')
+                    self.log_pos += 100
+                    yield event
+                if drop_after is not None:
+                    raise pymysql.err.OperationalError(2013, 'Lost')
+
+        stream = DroppingStream(self.events[start:], log_file)
+        stream.log_pos = log_pos
+        stream.table_map = {}
+        self.made.append((stream, dict(kwargs, log_file=log_file,
+                                       log_pos=log_pos)))
+        return stream
+
+
+def test_resumes_after_the_last_event(fake_stream, make_inserts):
+    received = []
+    positions = []
+
+    def on_rows(table_name, rows, meta):
+        received.append(rows[0]['keys']['id'])
+
+    def on_position(pos):
+        positions.append(pos[1])
+
+    # drops after 3 events, fails to connect once, then drops after 2
+    factory = StreamFactory(fake_stream, make_inserts(8),
+                            [3, 0, 2])
+    reconnect = Reconnect(initial_delay=0.01, max_delay=0.02)
+    stream = ReconnectingStream(factory, reconnect, auto_position='x:1-5')
+    factory.made[0][0].table_map[1] = 'tbl0'
+
+    signals.rows_inserted.connect(on_rows)
+    signals.binlog_position_signal.connect(on_position)
+    try:
+        _publish(stream)
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+        signals.binlog_position_signal.disconnect(on_position)
+
+    assert received == list(range(1, 9))
+    assert positions == [104 + 100 * i for i in range(8)]
+    assert [kwargs['log_pos'] for _, kwargs in factory.made] == \
+        [4, 304, 304, 504]
+    assert 'auto_position' not in factory.made[-1][1]
+    assert factory.made[-1][1]['resume_stream'] is True
+    assert all(s.table_map == {1: 'tbl0'} for s, _ in factory.made)
+
+    stats = reconnect.stats()
+    assert stats['reconnects'] == 2
+    assert stats['failed_attempts'] == 1
+    assert stats['downtime_seconds'] > 0
+    assert 'Lost' in stats['last_error']
+
+
+def test_gives_up_after_max_attempts(fake_stream, make_inserts):
+    factory = StreamFactory(fake_stream, make_inserts(3),
+                            [1, 0, 0, 0])
+    stream = ReconnectingStream(factory, Reconnect(initial_delay=0.001,
+                                                   max_attempts=2))
+    with pytest.raises(pymysql.err.OperationalError):
+        list(stream)
+    assert len(factory.made) == 3
+
+
+def test_delays_grow_with_jitter():
+    reconnect = Reconnect(initial_delay=1, max_delay=5, multiplier=2,
+                          jitter=0.5)
+    for attempt, delay in enumerate([1, 2, 4, 5, 5]):
+        for _ in range(20):
+            assert delay * 0.5 <= reconnect.delay(attempt) <= delay
+    assert Reconnect(initial_delay=1, jitter=0).delay(1) == 2
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+
+import pymysqlreplication
+import pytest
+from pymysqlreplication import event as binlog_event, row_event
+
+from mysqlbinlog2blinker import schema_cache
+from mysqlbinlog2blinker.schema_cache import (
+    CachingBinLogStreamReader,
+    SchemaCache,
+    ddl_tables,
+)
+
+_COLUMNS = [{'COLUMN_NAME': 'id', 'COLUMN_KEY': 'PRI',
+             'COLUMN_TYPE': 'int(11)', 'ORDINAL_POSITION': 1},
+            {'COLUMN_NAME': 'data', 'COLUMN_KEY': '',
+             'COLUMN_TYPE': 'varchar(10)', 'ORDINAL_POSITION': 2}]
+
+
+def _server_columns(schema, table, data_type='varchar(10)'):
+    """Rows of information_schema.COLUMNS of a table like _COLUMNS
+    """
+    return [(schema, table, 1, 'id', 'int(11)'),
+            (schema, table, 2, 'data', data_type)]
+
+
+@pytest.mark.parametrize('query, tables', [
+    ('BEGIN', None),
+    (b'INSERT INTO t VALUES (1)', None),
+    ('ALTER TABLE t ADD c INT', [('db', 't')]),
+    ('/* x */ alter table `db2`.`t` add c int', [('db2', 't')]),
+    ('DROP TABLE IF EXISTS db2.t', [('db2', 't')]),
+    ('DROP DATABASE db2', [('db2', None)]),
+    ('DROP TABLE ab, c', [('db', None)]),
+    ('RENAME TABLE a TO b, d1.x TO d2.y',
+     [('db', None), ('d1', 'x'), ('d2', 'y')]),
+])
+def test_ddl_tables(query, tables):
+    assert ddl_tables(query, 'db') == tables
+
+
+class FakeConnection(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, args):
+        self.queries.append((query, args))
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def query_event(make_binlog_event):
+    def make(query, schema=b'db'):
+        return make_binlog_event(binlog_event.QueryEvent, query=query,
+                                 schema=schema)
+    return make
+
+
+def test_cache_is_saved_and_invalidated(tmpdir, query_event):
+    filename = str(tmpdir.join('schema.json'))
+    cache = SchemaCache(filename)
+    assert cache.get('db', 't') is None
+    cache.put('db', 't', _COLUMNS)
+    cache.put('db', 'u', _COLUMNS)
+    cache.put('db2', 't', _COLUMNS)
+    cache.save()
+
+    cache = SchemaCache(filename)
+    assert cache.get('db', 't') == _COLUMNS
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    # DDLs are saved right away
+    cache.handle_query(query_event(b'ALTER TABLE t ADD c INT'))
+    assert SchemaCache(filename).get('db', 't') is None
+    cache.handle_query(query_event(b'CREATE INDEX i ON u (c)'))
+    assert SchemaCache(filename).get('db', 'u') is None
+    assert SchemaCache(filename).get('db2', 't') == _COLUMNS
+
+
+def test_validate_drops_changed_tables(tmpdir):
+    filename = str(tmpdir.join('schema.json'))
+    cache = SchemaCache(filename)
+    for table in ('t', 'u', 'v'):
+        cache.put('db', table, _COLUMNS)
+    cache.save()
+
+    cache = SchemaCache(filename)
+    connection = FakeConnection(_server_columns('db', 't') +
+                                _server_columns('db', 'u', 'text'))
+    cache.validate(connection)
+    assert connection.queries[0][1] == ['db']
+    assert cache.get('db', 't') == _COLUMNS
+    # its type changed
+    assert cache.get('db', 'u') is None
+    # it is not on the server anymore
+    assert cache.get('db', 'v') is None
+    assert SchemaCache(filename).get('db', 'u') is None
+
+
+def test_validate_drops_tables_without_fingerprint(tmpdir):
+    filename = tmpdir.join('schema.json')
+    filename.write(json.dumps({'version': schema_cache._VERSION, 'tables': {
+        'db.t': {'fingerprint': None, 'columns': _COLUMNS},
+        'db.u': {'fingerprint': None, 'names': ['id', 'data']},
+        'db.v': {'fingerprint': None, 'names': ['id']},
+    }}))
+    cache = SchemaCache(str(filename))
+    cache.validate(FakeConnection(_server_columns('db', 't') +
+                                  _server_columns('db', 'u') +
+                                  _server_columns('db', 'v')))
+    assert cache.get('db', 't') is None
+    # column names collected from the binlog are checked against the server
+    assert sorted(json.loads(filename.read())['tables']) == ['db.u']
+
+
+def test_reader_takes_columns_from_cache(tmpdir, monkeypatch, query_event):
+    cache = SchemaCache(str(tmpdir.join('schema.json')))
+    cache.put('db', 't', _COLUMNS)
+    queried = []
+
+    def get_table_information(self, schema, table):
+        queried.append((schema, table))
+        return _COLUMNS
+
+    events = [query_event(b'BEGIN'), query_event(b'DROP TABLE t'),
+              'rows', None]
+    monkeypatch.setattr(pymysqlreplication.BinLogStreamReader,
+                        '_BinLogStreamReader__get_table_information',
+                        get_table_information, raising=False)
+    monkeypatch.setattr(pymysqlreplication.BinLogStreamReader, 'fetchone',
+                        lambda self: events.pop(0))
+
+    stream = CachingBinLogStreamReader(
+        {'host': '127.0.0.1'}, cache, server_id=1,
+        only_events=[row_event.WriteRowsEvent])
+    get = stream._BinLogStreamReader__get_table_information
+    assert get('db', 't') == _COLUMNS
+    assert queried == []
+
+    # query events are not asked for, they only invalidate the cache
+    assert list(stream) == ['rows']
+    assert get('db', 't') == _COLUMNS
+    assert queried == [('db', 't')]
+    assert cache.get('db', 't') == _COLUMNS
+
+
+@pytest.mark.skipif(schema_cache._COLUMN_NAME_CACHE is None,
+                    reason='pymysqlreplication < 1.0 has no column names '
+                           'cache')
+def test_column_names_cache_is_kept(tmpdir, monkeypatch):
+    monkeypatch.setattr(schema_cache, '_COLUMN_NAME_CACHE', {})
+    filename = str(tmpdir.join('schema.json'))
+    schema_cache._COLUMN_NAME_CACHE['db.t'] = ['id', 'data']
+    SchemaCache(filename).save()
+
+    schema_cache._COLUMN_NAME_CACHE.clear()
+    cache = SchemaCache(filename)
+    assert schema_cache._COLUMN_NAME_CACHE == {'db.t': ['id', 'data']}
+    cache.invalidate('db')
+    assert schema_cache._COLUMN_NAME_CACHE == {}
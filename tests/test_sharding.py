@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import threading
+import time
+
+import pytest
+
+from mysqlbinlog2blinker import _publish, _subscribers, sharding, signals
+
+_TABLES = ['db.t%d' % i for i in range(20)]
+
+
+def test_split_tables_by_hash_and_map():
+    split = sharding.split_tables(_TABLES, 3)
+    assert sorted(sum(split, [])) == sorted(_TABLES)
+    assert split == sharding.split_tables(list(reversed(_TABLES)), 3)
+    assert all(split)
+
+    split = sharding.split_tables(_TABLES, 3, {'db.t1': 2, 'db.t2': 2})
+    assert 'db.t1' in split[2] and 'db.t2' in split[2]
+    with pytest.raises(ValueError):
+        sharding.shard_of('db.t1', 3, {'db.t1': 3})
+
+
+def test_only_tables_are_published(make_rows_event, fake_stream):
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        received.append(table_name)
+
+    events = [make_rows_event('insert', [{'values': {'id': 1}}], table=t)
+              for t in ('tbl0', 'tbl1', 'tbl0')]
+    signals.rows_inserted.connect(on_rows)
+    previous = _subscribers.set_only_tables(['testdb.tbl0'])
+    try:
+        _publish(fake_stream(events))
+    finally:
+        _subscribers.set_only_tables(previous)
+        signals.rows_inserted.disconnect(on_rows)
+
+    assert received == ['testdb.tbl0', 'testdb.tbl0']
+
+
+def test_pos_filename_without_shard_format(tmpdir):
+    coordinator = sharding.ShardCoordinator(
+        {'host': '127.0.0.1', 'port': 1, 'user': 'root'}, shards=2,
+        tables=_TABLES, pos_filename=str(tmpdir.join('binlog.pos')))
+    assert [s['pos_filename'] for s in coordinator.stats()] == [
+        str(tmpdir.join('binlog.pos.0')), str(tmpdir.join('binlog.pos.1'))]
+
+
+def test_children_are_restarted(tmpdir):
+    # nothing listens there, children fail to connect and exit
+    coordinator = sharding.ShardCoordinator(
+        {'host': '127.0.0.1', 'port': 1, 'user': 'root'}, shards=2,
+        tables=_TABLES, pos_filename=str(tmpdir.join('shard%d.pos')),
+        server_id=100, restart_delay=0.05, max_restart_delay=0.2)
+    supervisor = threading.Thread(target=coordinator.run,
+                                  kwargs={'poll_interval': 0.05})
+    supervisor.start()
+    try:
+        deadline = time.time() + 20
+        while time.time() < deadline and \
+                min(s['restarts'] for s in coordinator.stats()) < 2:
+            time.sleep(0.05)
+    finally:
+        coordinator.stop()
+        supervisor.join()
+
+    stats = coordinator.stats()
+    assert [s['restarts'] >= 2 for s in stats] == [True, True]
+    assert sorted(s['server_id'] for s in stats) == [100, 101]
+    assert len(set(s['pos_filename'] for s in stats)) == 2
+    assert not any(s['alive'] for s in stats)
+    assert coordinator.assignments() == dict(
+        enumerate(sharding.split_tables(_TABLES, 2)))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import os
+
+from mysqlbinlog2blinker import _publish, signals
+from mysqlbinlog2blinker.spool import Spool, SpoolDispatcher, SpoolReader
+
+
+def test_changes_are_spooled_and_replayed(tmpdir, make_rows_event, fake_stream,
+                                          make_inserts):
+    directory = str(tmpdir.join('spool'))
+    positions = []
+
+    def on_position(position):
+        positions.append(position)
+
+    signals.binlog_position_signal.connect(on_position)
+    try:
+        events = make_inserts(2) + [make_rows_event(
+            'update', [{'before_values': {'id': 1, 'data': 'v1'},
+                        'after_values': {'id': 1, 'data': 'y'}}])]
+        _publish(fake_stream(events), SpoolDispatcher(Spool(directory)))
+    finally:
+        signals.binlog_position_signal.disconnect(on_position)
+    assert positions == [('mysql-bin.000001', 104),
+                         ('mysql-bin.000001', 204),
+                         ('mysql-bin.000001', 304)]
+
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        received.append((table_name, rows, meta['log_pos'],
+                         meta['spool_offset']))
+
+    offset_filename = str(tmpdir.join('offset'))
+    signals.rows_inserted.connect(on_rows)
+    signals.rows_updated.connect(on_rows)
+    try:
+        with SpoolReader(directory, offset_filename) as reader:
+            reader.replay()
+        with SpoolReader(directory, offset_filename) as reader:
+            reader.replay()
+            assert reader.offset == 3
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+        signals.rows_updated.disconnect(on_rows)
+
+    assert received == [
+        ('testdb.tbl0', [{'values': {'id': 1, 'data': 'v1'},
+                          'keys': {'id': 1}}], 104, 0),
+        ('testdb.tbl0', [{'values': {'id': 2, 'data': 'v2'},
+                          'keys': {'id': 2}}], 204, 1),
+        ('testdb.tbl0', [{'values': {'id': 1, 'data': 'y'},
+                          'keys': {'id': 1},
+                          'updated_values': {'data': ['v1', 'y']}}], 304, 2),
+    ]
+
+
+def test_readers_follow_segments_and_retention(tmpdir):
+    directory = str(tmpdir)
+    spool = Spool(directory, segment_bytes=100, retention_bytes=250)
+    reader = SpoolReader(directory)
+    late_reader = SpoolReader(directory, offset=0)
+    assert reader.read() == []
+
+    for i in range(5):
+        spool.append(b'%02d' % i + b'x' * 48)
+    spool.flush()
+    assert [offset for offset, _ in reader.read()] == [0, 1, 2, 3, 4]
+    # not flushed, not visible
+    spool.append(b'05' + b'x' * 48)
+    assert reader.read() == []
+    spool.flush()
+    assert reader.read()[0][1][:2] == b'05'
+
+    for i in range(6, 10):
+        spool.append(b'%02d' % i + b'x' * 48)
+    spool.flush()
+    assert sorted(os.listdir(directory)) == [
+        '%020d.%s' % (base, suffix) for base in (4, 6, 8)
+        for suffix in ('idx', 'log')]
+    assert late_reader.lag() == 6
+    assert [payload[:2] for _, payload in late_reader.read()] == \
+        [b'04', b'05', b'06', b'07', b'08', b'09']
+    assert late_reader.skipped == 4
+    assert [offset for offset, _ in reader.read(max_records=2)] == [6, 7]
+    assert reader.lag() == 2
+    spool.close()
+
+
+def test_torn_writes_are_dropped(tmpdir):
+    directory = str(tmpdir)
+    with Spool(directory) as spool:
+        spool.append(b'first')
+        spool.append(b'second')
+    with open(os.path.join(directory, '%020d.log' % 0), 'ab') as f:
+        f.write(b'\x10\x00')
+
+    with Spool(directory) as spool:
+        assert spool.next_offset == 2
+        assert spool.append(b'third') == 2
+    with SpoolReader(directory) as reader:
+        assert [payload for _, payload in reader.read()] == \
+            [b'first', b'second', b'third']
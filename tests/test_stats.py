@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+import threading
+
+import pytest
+
+from mysqlbinlog2blinker import _publish, binlog_pos_memory, signals, stats
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+
+
+@pytest.fixture
+def collector():
+    try:
+        yield stats.enable()
+    finally:
+        stats.disable()
+
+
+def on_rows(table_name, rows, meta):
+    pass
+
+
+def test_publishing_is_measured(make_rows_event, fake_stream, collector):
+    events = [
+        make_rows_event('insert', [{'values': {'id': i, 'data': 'x'}}
+                                   for i in range(3)]),
+        make_rows_event('insert', [{'values': {'id': 3, 'data': 'x'}}]),
+        make_rows_event('delete', [{'values': {'id': 3, 'data': 'x'}}]),
+        make_rows_event('insert', [{'values': {'id': 1, 'data': 'x'}}],
+                        table='tbl1'),
+    ]
+    signals.rows_inserted.connect(on_rows, sender='testdb.tbl0')
+    signals.rows_deleted.connect(on_rows, sender='testdb.tbl0')
+    try:
+        _publish(fake_stream(events))
+    finally:
+        signals.rows_inserted.disconnect(on_rows)
+        signals.rows_deleted.disconnect(on_rows)
+
+    snapshot = collector.snapshot()
+    counters = snapshot['counters']
+    assert counters['events'] == {'testdb.tbl0:insert': 2,
+                                  'testdb.tbl0:delete': 1,
+                                  'testdb.tbl1:insert': 1}
+    # rows of unsubscribed tables are not converted
+    assert counters['rows'] == {'testdb.tbl0:insert': 4,
+                                'testdb.tbl0:delete': 1}
+    histograms = snapshot['histograms']
+    assert histograms['convert_seconds']['testdb.tbl0']['count'] == 3
+    assert histograms['signal_seconds']['rows_inserted']['count'] == 2
+    receiver = 'rows_inserted:%s.on_rows' % __name__
+    assert histograms['receiver_seconds'][receiver]['count'] == 2
+    assert snapshot['gauges']['lag_seconds'][''] > 0
+
+
+def test_histograms_are_merged_across_threads():
+    collector = stats.Stats(buckets=(1, 2, 5))
+
+    def record(values):
+        for value in values:
+            collector.observe('latency', 'x', value)
+            collector.incr('calls', 'x')
+
+    threads = [threading.Thread(target=record, args=([0.5] * 50, )),
+               threading.Thread(target=record, args=([1.5] * 40 + [9] * 10,
+                                                     ))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = collector.snapshot()
+    assert snapshot['counters']['calls'] == {'x': 100}
+    summary = snapshot['histograms']['latency']['x']
+    assert summary['count'] == 100
+    assert summary['sum'] == pytest.approx(25 + 60 + 90)
+    assert summary['buckets'] == [(1, 50), (2, 90), (5, 90),
+                                  (float('inf'), 100)]
+    assert (summary['p50'], summary['p90'], summary['p99']) == (1, 2, 9)
+
+
+def test_position_saves_are_measured(tmpdir, collector):
+    memory = binlog_pos_memory.FileBasedBinlogPosMemory(
+        str(tmpdir.join('pos')), 60)
+    memory.set_binlog_pos('mysql-bin.000001', 4)
+    memory._save_file_and_pos()
+    summary = collector.snapshot()['histograms']['position_save_seconds']
+    assert summary['FileBasedBinlogPosMemory']['count'] == 1
+
+
+def test_stats_are_served(collector):
+    collector.incr('events', ('db.t', 'insert'), 3)
+    collector.observe('receiver_seconds', ('rows_inserted', 'm.f'), 0.002)
+    collector.set_gauge('lag_seconds', None, 1.5)
+    server = stats.serve(port=0)
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        text = urlopen(url + '/metrics').read().decode('utf-8')
+        snapshot = json.loads(urlopen(url + '/stats.json').read()
+                              .decode('utf-8'))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    lines = text.splitlines()
+    assert 'mysqlbinlog2blinker_events_total{table="db.t",action="insert"} 3' \
+        in lines
+    assert 'mysqlbinlog2blinker_lag_seconds 1.5' in lines
+    assert 'mysqlbinlog2blinker_receiver_seconds_count' \
+           '{signal="rows_inserted",receiver="m.f"} 1' in lines
+    assert 'mysqlbinlog2blinker_receiver_seconds_bucket' \
+           '{signal="rows_inserted",receiver="m.f",le="0.0025"} 1' in lines
+    assert snapshot['counters']['events'] == {'db.t:insert': 3}
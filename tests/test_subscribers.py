@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import pytest
+
+from mysqlbinlog2blinker import _publish, _subscribers, signals
+
+
+def _update_event(make_rows_event, table='tbl0'):
+    return make_rows_event('update', [{
+        'before_values': {'id': 1, 'data': 'a', 'n': 1},
+        'after_values': {'id': 1, 'data': 'b', 'n': 1},
+    }], table=table)
+
+
+def test_skip_conversion_of_unsubscribed_tables(make_rows_event, fake_stream,
+                                                monkeypatch):
+    converted = []
+    _convert = _subscribers._rows_event_to_dict
+
+    def _rows_event_to_dict(e, *args):
+        converted.append(e.table)
+        return _convert(e, *args)
+
+    monkeypatch.setattr(_subscribers, '_rows_event_to_dict',
+                        _rows_event_to_dict)
+    received = []
+
+    def on_tbl1(table_name, rows, meta):
+        received.append(table_name)
+
+    events = [_update_event(make_rows_event, 'tbl0'),
+              _update_event(make_rows_event, 'tbl1')]
+    _publish(fake_stream(events))
+    assert converted == []
+
+    signals.rows_updated.connect(on_tbl1, sender='testdb.tbl1')
+    try:
+        _publish(fake_stream(events))
+    finally:
+        signals.rows_updated.disconnect(on_tbl1, sender='testdb.tbl1')
+    assert converted == ['tbl1']
+    assert received == ['testdb.tbl1']
+
+    # the cached answer is dropped on disconnect
+    _publish(fake_stream(events))
+    assert converted == ['tbl1']
+
+
+def test_subscribed_tables():
+    def receiver(table_name, rows, meta):
+        pass
+
+    assert not _subscribers.subscribed_tables()
+    signals.rows_updated.connect(receiver, sender='db0.orders')
+    signals.rows_inserted.connect(receiver, sender='db1.users')
+    try:
+        assert _subscribers.subscribed_tables() == \
+            {'db0.orders', 'db1.users'}
+        signals.rows_deleted.connect(receiver)
+        assert _subscribers.subscribed_tables() is None
+    finally:
+        signals.rows_updated.disconnect(receiver)
+        signals.rows_inserted.disconnect(receiver)
+        signals.rows_deleted.disconnect(receiver)
+
+
+def test_dead_receivers_are_forgotten(make_rows_event, fake_stream):
+    import gc
+
+    received = []
+
+    def on_n(table_name, rows, meta):
+        received.append(sorted(rows[0]['values']))
+
+    def on_data(table_name, rows, meta):
+        pass
+
+    signals.on_rows_updated(on_n, sender='testdb.tbl0', columns=['n'])
+    signals.on_rows_updated(on_data, sender='testdb.tbl0', columns=['data'])
+    signals.on_rows_updated(on_data, sender='testdb.tbl1', columns=['data'])
+    try:
+        _publish(fake_stream([_update_event(make_rows_event)]))
+        assert _subscribers.subscribed_tables() == \
+            {'testdb.tbl0', 'testdb.tbl1'}
+        # weakly referenced, it goes away with its last reference
+        del on_data
+        gc.collect()
+        assert _subscribers.subscribed_tables() == {'testdb.tbl0'}
+        assert len(signals._receiver_columns) == 1
+
+        _publish(fake_stream([_update_event(make_rows_event)]))
+        # the projection cached for both receivers is not used anymore
+        assert received == [['data', 'id', 'n'], ['id', 'n']]
+    finally:
+        signals.rows_updated.disconnect(on_n)
+    assert not signals._receiver_columns
+
+
+def test_update_rows_are_lazy(make_rows_event, fake_stream, monkeypatch):
+    import copy
+    import json
+    import pickle
+
+    diffs = []
+    _get_updated_values = _subscribers._get_updated_values
+
+    def get_updated_values(before_values, after_values):
+        diffs.append(1)
+        return _get_updated_values(before_values, after_values)
+
+    monkeypatch.setattr(_subscribers, '_get_updated_values',
+                        get_updated_values)
+    rows, meta = _subscribers._rows_event_to_dict(
+        _update_event(make_rows_event), fake_stream([]))
+    row = rows[0]
+
+    assert row['values'] == {'id': 1, 'data': 'b', 'n': 1}
+    assert 'updated_values' in row and len(row) == 3
+    assert diffs == []
+
+    assert row['updated_values'] == {'data': ['a', 'b']}
+    assert row['updated_values'] is row['updated_values']
+    assert diffs == [1]
+
+    expected = {
+        'keys': {'id': 1},
+        'values': {'id': 1, 'data': 'b', 'n': 1},
+        'updated_values': {'data': ['a', 'b']},
+    }
+    assert row == expected and expected == row
+    assert isinstance(row, dict)
+    assert dict(row) == expected
+    assert json.loads(json.dumps(row)) == expected
+    assert pickle.loads(pickle.dumps(row)) == expected
+    assert copy.deepcopy(row) == expected
+    assert diffs == [1]
+
+
+def test_write_rows_keys_are_lazy(make_rows_event, fake_stream):
+    rows, meta = _subscribers._rows_event_to_dict(
+        make_rows_event('insert', [{'values': {'id': 3, 'data': 'c'}}]),
+        fake_stream([]))
+    assert rows[0].get('keys') == {'id': 3}
+    assert sorted(rows[0]) == ['keys', 'values']
+
+
+def test_column_projection(make_rows_event, fake_stream):
+    received = []
+
+    @signals.on_rows_updated(sender='testdb.tbl0', columns=['n'])
+    def on_n(table_name, rows, meta):
+        received.append(('n', rows))
+
+    def on_all(table_name, rows, meta):
+        received.append(('all', rows))
+
+    events = [_update_event(make_rows_event)]
+    try:
+        _publish(fake_stream(events))
+        assert received == [('n', [{'keys': {'id': 1},
+                                    'values': {'id': 1, 'n': 1},
+                                    'updated_values': {}}])]
+
+        @signals.on_rows_updated(sender='testdb.tbl0', columns=['data'])
+        def on_data(table_name, rows, meta):
+            received.append(('data', rows))
+
+        del received[:]
+        _publish(fake_stream([_update_event(make_rows_event)]))
+        assert sorted(received[0][1][0]['values']) == ['data', 'id', 'n']
+        assert received[0][1][0]['updated_values'] == {'data': ['a', 'b']}
+
+        # a receiver without columns needs all of them
+        signals.rows_updated.connect(on_all, sender='testdb.tbl0')
+        del received[:]
+        _publish(fake_stream([_update_event(make_rows_event)]))
+        assert all(len(rows[0]['values']) == 3 for _, rows in received)
+    finally:
+        signals.rows_updated.disconnect(on_n)
+        signals.rows_updated.disconnect(on_data)
+        signals.rows_updated.disconnect(on_all)
+    assert not signals._receiver_columns
+
+
+def test_compact_rows(make_rows_event, fake_stream):
+    import pickle
+
+    received = []
+
+    def on_rows(table_name, rows, meta):
+        received.extend(rows)
+
+    signals.rows_updated.connect(on_rows)
+    signals.rows_inserted.connect(on_rows)
+    try:
+        _publish(fake_stream([
+            _update_event(make_rows_event),
+            make_rows_event('insert', [{'values': {'id': 2, 'data': 'c',
+                                                   'n': 3}}]),
+        ]), row_format='compact')
+    finally:
+        signals.rows_updated.disconnect(on_rows)
+        signals.rows_inserted.disconnect(on_rows)
+
+    updated, inserted = received
+    assert updated == {
+        'keys': {'id': 1},
+        'values': {'id': 1, 'data': 'b', 'n': 1},
+        'updated_values': {'data': ['a', 'b']},
+    }
+    assert updated['values']['data'] == 'b'
+    assert 'updated_values' not in inserted
+    assert dict(inserted['values']) == {'id': 2, 'data': 'c', 'n': 3}
+    assert pickle.loads(pickle.dumps(inserted)) == \
+        {'keys': {'id': 2}, 'values': {'id': 2, 'data': 'c', 'n': 3}}
+    # rows of a table share one column index
+    assert updated._columns is inserted._columns
+
+
+@pytest.mark.parametrize('with_numpy', [True, False])
+def test_columnar_rows(make_rows_event, fake_stream, monkeypatch,
+                       with_numpy):
+    from mysqlbinlog2blinker import rows as _rows
+    from mysqlbinlog2blinker.rows import ColumnarRows
+
+    if not with_numpy:
+        monkeypatch.setattr(_rows, 'numpy', None)
+    elif _rows.numpy is None:
+        pytest.skip('numpy is not installed')
+
+    event = make_rows_event('update', [{
+        'before_values': {'id': i, 'data': 'a%d' % i, 'n': 1.5},
+        'after_values': {'id': i, 'data': 'a%d' % (i % 2), 'n': 1.5},
+    } for i in range(4)])
+    rows, meta = _subscribers._rows_event_to_dict(
+        event, fake_stream([]), row_format='columnar', columnar_min_rows=2)
+
+    assert isinstance(rows, ColumnarRows) and len(rows) == 4
+    assert list(rows.column('id')) == [0, 1, 2, 3]
+    assert list(rows.before_column('data')) == ['a0', 'a1', 'a2', 'a3']
+    assert [bool(c) for c in rows.changed_mask('data')] == \
+        [False, False, True, True]
+    assert not any(rows.changed_mask('n'))
+    assert rows[2] == {
+        'keys': {'id': 2},
+        'values': {'id': 2, 'data': 'a0', 'n': 1.5},
+        'updated_values': {'data': ['a2', 'a0']},
+    }
+    assert rows[-1]['keys'] == {'id': 3}
+
+    # small events are still lists of dicts
+    rows, meta = _subscribers._rows_event_to_dict(
+        make_rows_event('insert', [{'values': {'id': 1}}]), fake_stream([]),
+        row_format='columnar', columnar_min_rows=2)
+    assert rows == [{'keys': {'id': 1}, 'values': {'id': 1}}]
+
+
+@pytest.mark.parametrize('with_numpy', [True, False])
+def test_columnar_rows_keep_values(make_rows_event, fake_stream, monkeypatch,
+                                   with_numpy):
+    from mysqlbinlog2blinker import rows as _rows
+
+    if not with_numpy:
+        monkeypatch.setattr(_rows, 'numpy', None)
+    elif _rows.numpy is None:
+        pytest.skip('numpy is not installed')
+
+    values = [
+        # JSON lists, of different then same lengths; out of int64 range
+        {'id': 1, 'tags': [1, 2, 3], 'pairs': [1, 2], 'big': -1},
+        {'id': 2, 'tags': [4], 'pairs': [3, 4], 'big': 2 ** 63},
+    ]
+    rows, meta = _subscribers._rows_event_to_dict(
+        make_rows_event('insert', [{'values': v} for v in values]),
+        fake_stream([]), row_format='columnar', columnar_min_rows=2)
+
+    assert [row['values'] for row in rows] == values
+    assert type(rows[1]['values']['pairs']) is list
+    assert rows[1]['values']['big'] == 2 ** 63